@@ -2,34 +2,78 @@ __author__ = 'Nitin Pasumarthy'
 
 import psycopg2
 from itertools import islice
+import decimal
 import math
 import os
-from multiprocessing.pool import ThreadPool
-import thread
+import sys
+import time
+import multiprocessing
+
+import numpy as np
 
 import RatingsDAO
 import Globals
 import MetaDataDAO
+import PartitionCatalogDAO
+import ZoneMapDAO
+import ConnectionUtils
+import ExternalSort
+import RatingsParser
+from CopyStream import CopyStream
+from Job import Job, timed
+from PartitionSpool import PartitionSpool
+from QueryCache import QueryCache
 
 
 MAX_LINES_COUNT_READ = 100000  # Maximum number of lines to read into memory.
+LOAD_MODE_COPY = 'copy'  # stream the ratings file through COPY FROM STDIN
+LOAD_MODE_INSERT = 'insert'  # multi row INSERT statements, chunk by chunk
+LOAD_MODE_BLOCKS = 'blocks'  # memory mapped NumPy parser, COPY block by block
+LOAD_MODE_PARALLEL = 'parallel'  # byte ranges of the file parsed and COPYed by worker processes
 LINE_SIZE = 21  # Length of each line in bytes to quickly calculate the percent of file read
 DATABASE_NAME = 'dds_assgn1'
 MAX_RATING = 5.0
+VALID_RATINGS = list(Globals.drange(0, MAX_RATING + 0.1, 0.5))
 RANGE_PARTITION_TABLE_PREFIX = 'range_part'
 RROBIN_PARTITION_TABLE_PREFIX = 'rrobin_part'
-
-
-def getnextchunk(filepath):
+RROBIN_SEQUENCE_SUFFIX = '_rrobin_position'  # sequence of positions of round robin inserts, per ratings table
+LOAD_STAGE_SUFFIX = '_loading'  # table filled by the workers of LOAD_MODE_PARALLEL, per ratings table
+HASH_PARTITION_TABLE_PREFIX = 'hash_part'
+SORT_PARTITION_TABLE_PREFIX = 'sort_part'  # partitions of parallel_sort, apart from those of the ratings
+HASH_COLUMN_TYPES = ('smallint', 'integer', 'bigint')  # types of the columns which can be hash partitioned
+PARTITION_SCHEME_RANGE = 'range'
+PARTITION_SCHEME_RROBIN = 'roundrobin'
+PARTITION_SCHEME_HASH = 'hash'
+PARTITION_SCHEME_SAMPLE = 'sample'  # ranges of (column, ctid) chosen from a sample, see samplesortpartition
+RANGE_SPLIT_EQUIWIDTH = 'equiwidth'  # partitions of equal width between min and max
+RANGE_SPLIT_QUANTILE = 'quantile'  # partitions of about equal number of rows
+RANGE_SPLIT_SAMPLE = 'sample'  # parallel_sort only, equal number of rows even with heavily repeated values
+SORT_SAMPLE_PER_PARTITION = 100  # rows sampled per partition by samplesortpartition
+PARTITION_BACKEND_MANUAL = 'manual'  # partitions are independent tables filled by the application
+PARTITION_BACKEND_NATIVE = 'native'  # ratings table becomes a PostgreSQL partitioned table
+NATIVE_STRATEGIES = {PARTITION_SCHEME_RANGE: 'r', PARTITION_SCHEME_RROBIN: 'h'}  # see RatingsDAO.partitionstrategy
+SORT_ENGINE_MEMORY = 'memory'  # parallel_sort sorts every partition in memory
+SORT_ENGINE_EXTERNAL = 'external'  # parallel_sort sorts every partition with an external merge sort
+SORT_ENGINE_SERVER = 'server'  # parallel_sort numbers the rows of every partition in PostgreSQL
+SORT_ENGINE_SINGLE_STATEMENT = 'singlestatement'  # parallel_sort sorts the table in one statement, unpartitioned
+SORT_EXECUTOR_THREADS = 'threads'  # parallel_sort threads share the connection and return at once
+SORT_EXECUTOR_PROCESSES = 'processes'  # parallel_sort worker processes have a connection each
+QUERY_CACHE_MAX_BYTES = 64 * 1024 * 1024
+QUERY_CACHE = QueryCache(QUERY_CACHE_MAX_BYTES)  # results of rangequery, pointquery and keyquery
+
+
+def getnextchunk(filepath, offset=0):
     """
     Reads files in chunks in an efficient manner using isslice method.
     Uses yield to return the next chunk if an existing file is being read
     :param filepath: relative or abs path of the file to read
+    :param offset: byte offset to start reading from, it has to be at the start of a line
     :return:Chunk of lines using yield
     """
     abs_filepath = os.path.abspath(filepath)
     print(abs_filepath)
     with open(abs_filepath) as f:
+        f.seek(offset)
         linesinfile = os.path.getsize(abs_filepath) / LINE_SIZE
         totallinesread = 0.0
         while True:
@@ -49,7 +93,7 @@ def getopenconnection(user='postgres', password='1234', dbname='postgres'):
     Connects to dds_assgn1 database using postgres user
     :return: Open DB connection
     """
-    return psycopg2.connect("dbname='" + dbname + "' user='" + user + "' host='localhost' password='" + password + "'")
+    return psycopg2.connect(ConnectionUtils.getdsn(user, password, dbname))
 
 
 def create_db(dbname):
@@ -76,26 +120,524 @@ def create_db(dbname):
     con.close()
 
 
-def loadratings(ratingstablename, ratingsfilepath, openconnection):
+def tocopyformat(lines):
+    """
+    Converts lines of the ratings file, UserID::MovieID::Rating::Timestamp, into tab separated rows of
+    UserID, MovieID and Rating which can be fed to COPY. Blank lines are skipped, and the Timestamp is optional
+    :param lines: iterable of lines from the ratings file
+    :return:COPY formatted lines using yield
+    """
+    for line in lines:
+        line = line.strip()  # without a Timestamp, the line break would end up in the Rating
+        if not line: continue
+        yield '\t'.join(line.split('::', 3)[0:3]) + '\n'
+
+
+def loadblock(block, conn, table):
+    """
+    COPYs a block decoded by RatingsParser into a table with the ratings schema
+    :param block: array of RatingsParser.RATINGS_DTYPE
+    :param conn: open connection to DB
+    :param table: name of the table to insert into
+    :return: number of ratings loaded
+    """
+    if len(block) == 0: return 0
+    RatingsDAO.copyfrom(RatingsParser.tocopystream(block), conn, table)
+    return len(block)
+
+
+def splitfile(filepath, numberofsplits):
+    """
+    Splits a file into byte ranges of roughly equal size. Every range starts at the beginning of a line and ends
+    right after a new line character (or at the end of the file), so no line is shared by two ranges
+    :param filepath: relative or abs path of the file to split
+    :param numberofsplits: number of ranges wanted. Fewer ranges are returned for files with fewer lines
+    :return:list of (start, end) byte offsets, end being exclusive
+    """
+    size = os.path.getsize(filepath)
+    offsets = [0]
+    with open(filepath, 'rb') as f:
+        for i in range(1, numberofsplits):
+            target = size * i // numberofsplits
+            if target <= offsets[-1]: continue
+            f.seek(target - 1)
+            f.readline()  # move to the start of the next line
+            if offsets[-1] < f.tell() < size: offsets.append(f.tell())
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if end > start]
+
+
+def loadratingsrange(args):
+    """
+    Worker process body of the parallel load. Decodes one byte range of the ratings file with RatingsParser and
+    COPYs it block by block into the ratings table, using a connection of its own
+    :param args: tuple of (name of the table to load into, ratingsfilepath, start, end, connectionparams)
+    :return: number of ratings loaded
+    """
+    ratingstablename, ratingsfilepath, start, end, connectionparams = args
+    conn = ConnectionUtils.getconnection(connectionparams)
+    try:
+        count = 0
+        for block, _ in RatingsParser.iterblocks(ratingsfilepath, start, end):
+            count += loadblock(block, conn, ratingstablename)
+        if Globals.DEBUG: Globals.printinfo(
+            'Loaded {0} ratings from bytes [{1}, {2}) of {3}'.format(count, start, end, ratingsfilepath))
+        return count
+    finally:
+        conn.close()
+
+
+def loadratingsparallel(ratingstablename, ratingsfilepath, openconnection, workers):
+    """
+    Splits the ratings file into 'workers' byte ranges and loads each one in its own process and connection.
+    Every worker commits on its own, so they load into a staging table, which replaces the ratings table once all of
+    them succeeded. If a worker fails, the staging table is dropped and the ratings table is left as it was
+    :param openconnection: open connection to DB, used to find the database to connect to. It should have no
+    transaction open
+    :param workers: number of worker processes
+    :return: number of ratings loaded
+    """
+    stagetable = ratingstablename + LOAD_STAGE_SUFFIX
+    RatingsDAO.create(openconnection, stagetable)
+    openconnection.commit()  # workers have to see the table, if the connection is not in auto commit mode
+    ranges = splitfile(ratingsfilepath, workers)
+    connectionparams = ConnectionUtils.getconnectionparams(openconnection)
+    tasks = [(stagetable, ratingsfilepath, start, end, connectionparams) for start, end in ranges]
+    try:
+        pool = multiprocessing.Pool(processes=max(len(tasks), 1))
+        try:
+            count = sum(pool.map(loadratingsrange, tasks))
+        finally:
+            pool.close()
+            pool.join()  # the other workers may still be loading when one of them failed
+        with ConnectionUtils.transaction(openconnection):
+            RatingsDAO.replacetable(openconnection, stagetable, ratingstablename)
+        openconnection.commit()
+        return count
+    except Exception:
+        openconnection.rollback()  # the transaction may be aborted, if the connection is not in auto commit mode
+        RatingsDAO.drop_table(openconnection, stagetable)
+        openconnection.commit()
+        raise
+
+
+def getloadwatermark(openconnection, ratingstablename):
+    """
+    Fetches the byte offset in the ratings file and the number of ratings of the last committed chunk of a load
+    :param openconnection: open connection to DB
+    :param ratingstablename: name of the table being loaded
+    :return:(offset, rows) tuple, (0, 0) if nothing was committed yet
+    """
+    offset = MetaDataDAO.select(openconnection, Globals.LOAD_OFFSET_KEY + ratingstablename)
+    rows = MetaDataDAO.select(openconnection, Globals.LOAD_ROWS_KEY + ratingstablename)
+    if offset is None or rows is None: return 0, 0
+    return int(offset), int(rows)
+
+
+def saveloadwatermark(openconnection, ratingstablename, offset, rows):
+    """
+    Saves the byte offset and the number of ratings loaded so far. Call it in the transaction of the chunk
+    :param openconnection: open connection to DB
+    :param ratingstablename: name of the table being loaded
+    :param offset: byte offset in the ratings file right after the last loaded line
+    :param rows: total number of ratings loaded from the file
+    :return:None
+    """
+    MetaDataDAO.upsert(openconnection, Globals.LOAD_OFFSET_KEY + ratingstablename, offset)
+    MetaDataDAO.upsert(openconnection, Globals.LOAD_ROWS_KEY + ratingstablename, rows)
+
+
+def validatepartitionspec(partitionspec):
+    """
+    Checks a partition spec of loadratings, Eg: {PARTITION_SCHEME_RANGE: 5, PARTITION_SCHEME_RROBIN: 3}
+    :param partitionspec: dict of partitioning scheme to number of partitions
+    :return:None
+    """
+    for scheme, numberofpartitions in partitionspec.items():
+        if scheme not in (PARTITION_SCHEME_RANGE, PARTITION_SCHEME_RROBIN): raise AttributeError(
+            "Partition spec can only have {0} and {1} schemes".format(PARTITION_SCHEME_RANGE, PARTITION_SCHEME_RROBIN))
+        if numberofpartitions <= 0 or not isinstance(numberofpartitions, int): raise AttributeError(
+            "Number of partitions should be a positive integer")
+
+
+def ownstransaction(conn):
+    """
+    :return:True if the connection is in auto commit mode or has no transaction open, so that a function can commit
+    the transaction it opens without committing the statements of its caller
+    """
+    return conn.autocommit or conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+def loadratingspartitioned(ratingstablename, ratingsfilepath, openconnection, partitionspec, offset=0, rows=0,
+                           commit=True):
+    """
+    Loads the file into the ratings table and, in the same pass, into the range and / or round robin partitions.
+    Every block decoded by RatingsParser is routed on the client and COPYed into the partitions it has rows for.
+    Rows land in the same partitions as rangepartition and roundrobinpartition would put them in.
+    Each block is committed along with the load watermark
+    :param openconnection: open connection to DB
+    :param partitionspec: dict of partitioning scheme to number of partitions, see validatepartitionspec
+    :param offset: byte offset to start loading from, when resuming a load
+    :param rows: number of ratings already loaded, when resuming a load
+    :param commit: commit every block. If False, the blocks are part of the transaction of the caller
+    :return: number of ratings loaded
+    """
+    rangepartitions = partitionspec.get(PARTITION_SCHEME_RANGE)
+    robinpartitions = partitionspec.get(PARTITION_SCHEME_RROBIN)
+    resuming = offset > 0
+    validatebackend(PARTITION_BACKEND_MANUAL, ratingstablename, openconnection)
+
+    if rangepartitions:
+        boundaries = rangeboundaries(rangepartitions)
+        upper_bounds = np.array([upper_bound for _, upper_bound in boundaries])
+        for i in range(1, rangepartitions + 1):
+            RatingsDAO.create(openconnection, RANGE_PARTITION_TABLE_PREFIX + str(i), not resuming)
+        if not resuming:
+            # the first partition also takes the ratings of (-1, 0], like rangepartition
+            partitions = [(-1 if i == 0 else lower_bound, upper_bound, RANGE_PARTITION_TABLE_PREFIX + str(i + 1))
+                          for i, (lower_bound, upper_bound) in enumerate(boundaries)]
+            PartitionCatalogDAO.save(openconnection, RANGE_PARTITION_TABLE_PREFIX, PARTITION_SCHEME_RANGE,
+                                     ratingstablename, 'rating',
+                                     rangecatalog(RANGE_PARTITION_TABLE_PREFIX, partitions, {}))
+    if robinpartitions:
+        for i in range(0, robinpartitions):
+            RatingsDAO.create(openconnection, RROBIN_PARTITION_TABLE_PREFIX + str(i), not resuming)
+        if not resuming:
+            PartitionCatalogDAO.save(openconnection, RROBIN_PARTITION_TABLE_PREFIX, PARTITION_SCHEME_RROBIN,
+                                     ratingstablename, None,
+                                     [(i, RROBIN_PARTITION_TABLE_PREFIX + str(i), None, None, 0)
+                                      for i in range(0, robinpartitions)])
+            ZoneMapDAO.reset(openconnection,
+                             [RROBIN_PARTITION_TABLE_PREFIX + str(i) for i in range(0, robinpartitions)])
+
+    count = 0
+    for block, offset in RatingsParser.iterblocks(ratingsfilepath, offset):
+        with ConnectionUtils.transaction(openconnection):
+            loadblock(block, openconnection, ratingstablename)
+            counts = {}  # rows of the block saved in each partition
+            if rangepartitions:
+                # index of the first upper bound >= rating, zero ratings falling into the first partition.
+                # Like rangepartition, ratings out of (-1, MAX_RATING] are not saved in any partition
+                indices = np.searchsorted(upper_bounds, block['rating'], side='left')
+                indices[(block['rating'] <= -1) | (block['rating'] > MAX_RATING)] = rangepartitions
+                for i in np.unique(indices[indices < rangepartitions]):
+                    table = RANGE_PARTITION_TABLE_PREFIX + str(i + 1)
+                    counts[table] = loadblock(block[indices == i], openconnection, table)
+            if robinpartitions:
+                # IDs are given in the order of the file, starting from 1
+                indices = np.arange(rows + 1, rows + len(block) + 1) % robinpartitions
+                zones = []
+                for i in np.unique(indices):
+                    table = RROBIN_PARTITION_TABLE_PREFIX + str(i)
+                    counts[table] = loadblock(block[indices == i], openconnection, table)
+                    zones.append(blockzone(table, block[indices == i]))
+                ZoneMapDAO.widen(openconnection, zones)
+            PartitionCatalogDAO.addrows(openconnection, counts)
+            rows += len(block)
+            saveloadwatermark(openconnection, ratingstablename, offset, rows)
+        if commit: openconnection.commit()
+        count += len(block)
+
+    # save the number of partitions in the meta data table
+    if rangepartitions: MetaDataDAO.upsert(openconnection, Globals.RANGE_PARTITIONS_KEY, rangepartitions)
+    if robinpartitions:
+        MetaDataDAO.upsert(openconnection, Globals.RROBIN_PARTITIONS_KEY, robinpartitions)
+        MetaDataDAO.createsequence(openconnection, ratingstablename + RROBIN_SEQUENCE_SUFFIX, rows + 1)
+    return count
+
+
+def loadratings(ratingstablename, ratingsfilepath, openconnection, mode=LOAD_MODE_COPY, workers=None,
+                partitionspec=None, resume=False):
     """
     Loads the file into DB
     :param ratingsfilepath: relative or abs path of the file to load
     :param openconnection: open connection to DB
-    :return: None
+    :param mode: LOAD_MODE_COPY streams the file through COPY FROM STDIN,
+    LOAD_MODE_INSERT uses the multi row INSERT statements in chunks of MAX_LINES_COUNT_READ lines,
+    LOAD_MODE_BLOCKS decodes the file with RatingsParser and COPYs it block by block,
+    LOAD_MODE_PARALLEL splits the file into byte ranges which worker processes decode and COPY.
+    IDs of the ratings follow the order of the file in every mode but LOAD_MODE_PARALLEL
+    :param workers: number of worker processes for LOAD_MODE_PARALLEL. Defaults to the number of cores
+    :param partitionspec: optional dict of partitioning scheme to number of partitions,
+    Eg: {PARTITION_SCHEME_RANGE: 5, PARTITION_SCHEME_RROBIN: 3}. The partitions are filled during the load,
+    instead of calling rangepartition / roundrobinpartition afterwards. Only LOAD_MODE_COPY and LOAD_MODE_BLOCKS
+    support it, the file being decoded with RatingsParser in both cases
+    :param resume: LOAD_MODE_COPY and LOAD_MODE_BLOCKS commit the file chunk by chunk, saving the byte offset and
+    the number of ratings loaded in the meta data table. If True, the tables are kept and the load continues from
+    the last committed offset. Also works to append lines added to the file after the previous load.
+    Nothing is committed if the connection already has a transaction open, the load is then part of it and the
+    caller commits it. LOAD_MODE_PARALLEL needs a connection without an open transaction
+    :return: number of ratings loaded
     """
-    RatingsDAO.create(openconnection, ratingstablename)
+    modes = [LOAD_MODE_COPY, LOAD_MODE_INSERT, LOAD_MODE_BLOCKS, LOAD_MODE_PARALLEL]
+    if mode not in modes: raise AttributeError("Load mode should be one of {0}".format(modes))
+    if partitionspec:
+        validatepartitionspec(partitionspec)
+        if mode not in (LOAD_MODE_COPY, LOAD_MODE_BLOCKS): raise AttributeError(
+            "Partition spec is supported only by {0} and {1} modes".format(LOAD_MODE_COPY, LOAD_MODE_BLOCKS))
+    if resume and mode not in (LOAD_MODE_COPY, LOAD_MODE_BLOCKS): raise AttributeError(
+        "Resuming is supported only by {0} and {1} modes".format(LOAD_MODE_COPY, LOAD_MODE_BLOCKS))
+    if workers is None: workers = multiprocessing.cpu_count()
+    if workers <= 0 or not isinstance(workers, int): raise AttributeError(
+        "Number of workers should be a positive integer")
+    commit = ownstransaction(openconnection)  # the transaction of the caller is left to the caller
+    if not commit and mode == LOAD_MODE_PARALLEL: raise AttributeError(
+        "{0} mode loads on other connections, commit the transaction of the connection first".format(mode))
+
+    ratingsfilepath = os.path.abspath(ratingsfilepath)
+    MetaDataDAO.create(openconnection)  # Create if the table doesnt exist
+    RatingsDAO.create(openconnection, ratingstablename, not resume)
+    offset, rows = 0, 0
+    if resume:
+        offset, rows = getloadwatermark(openconnection, ratingstablename)
+        if offset == 0 and RatingsDAO.numberofratings(openconnection, ratingstablename) > 0: raise AttributeError(
+            'No load watermark found for "{0}" table which already has ratings'.format(ratingstablename))
+        Globals.printinfo('Resuming the load of "{0}" from byte {1}, {2} ratings already loaded'.format(
+            ratingstablename, offset, rows))
+    else:
+        saveloadwatermark(openconnection, ratingstablename, 0, 0)
+    if commit: openconnection.commit()  # workers have to see the table, if the connection is not in auto commit mode
+
+    tic = time.time()
     count = 0
-    for lines in getnextchunk(ratingsfilepath):
-        ratings = []
-        for line in lines:
-            rating = line.split('::')[0:3]
-            ratings.append(rating)
-            count += 1
-        RatingsDAO.insert(ratings, openconnection, ratingstablename)
-    Globals.printinfo("Loaded {0} ratings into DB".format(count))
+    if partitionspec:
+        count = loadratingspartitioned(ratingstablename, ratingsfilepath, openconnection, partitionspec, offset,
+                                       rows, commit)
+    elif mode == LOAD_MODE_COPY:
+        for lines in getnextchunk(ratingsfilepath, offset):
+            stream = CopyStream(tocopyformat(lines))
+            with ConnectionUtils.transaction(openconnection):
+                RatingsDAO.copyfrom(stream, openconnection, ratingstablename)
+                offset += sum(len(line) for line in lines)
+                count += stream.rows
+                saveloadwatermark(openconnection, ratingstablename, offset, rows + count)
+            if commit: openconnection.commit()
+    elif mode == LOAD_MODE_BLOCKS:
+        for block, offset in RatingsParser.iterblocks(ratingsfilepath, offset):
+            with ConnectionUtils.transaction(openconnection):
+                count += loadblock(block, openconnection, ratingstablename)
+                saveloadwatermark(openconnection, ratingstablename, offset, rows + count)
+            if commit: openconnection.commit()
+    elif mode == LOAD_MODE_PARALLEL:
+        count = loadratingsparallel(ratingstablename, ratingsfilepath, openconnection, workers)
+    else:
+        for lines in getnextchunk(ratingsfilepath):
+            ratings = []
+            for line in lines:
+                if not line.strip(): continue
+                rating = line.split('::')[0:3]
+                ratings.append(rating)
+                count += 1
+            if ratings: RatingsDAO.insert(ratings, openconnection, ratingstablename)
+    QUERY_CACHE.invalidatetable(ratingstablename)
+    elapsed = time.time() - tic
+    Globals.printinfo("Loaded {0} ratings into DB in {1:.2f}s using {2} mode ({3:.0f} rows/sec)".format(
+        count, elapsed, mode, count / elapsed if elapsed > 0 else float(count)))
+    return count
+
+
+def rangeboundaries(numberofpartitions, min_value=0.0, max_value=MAX_RATING):
+    """
+    Splits the range of values, min_value to max_value, uniformly into 'numberofpartitions' pieces.
+    Values equal to min_value belong to the first piece, see rangepartition
+    :param numberofpartitions: Number of partitions
+    :param min_value: smallest value, 0 for ratings
+    :param max_value: largest value, MAX_RATING for ratings
+    :return:list of (exclusive lower bound, inclusive upper bound) tuples, one per partition
+    """
+    inc = round(float(max_value - min_value) / numberofpartitions, 10)  # precision restricted to 10 decimal places
+    boundaries = []
+    lower_bound = float(min_value)
+    for i in range(0, numberofpartitions):
+        # the last partition always ends at max_value, so that rounding of 'inc' cannot add or drop a partition
+        upper_bound = max_value if i == numberofpartitions - 1 else lower_bound + inc
+        boundaries.append((lower_bound, upper_bound))
+        lower_bound = upper_bound
+    return boundaries
 
 
-def rangepartition(ratingstablename, numberofpartitions, openconnection):
+def scanandroute(conn, sourcetable, columnname, partitions, cols):
+    """
+    Fills the partition tables reading the source table only once. Each row is tagged with the number of its
+    partition on the server and streamed out with COPY, spooled into one temporary file per partition and COPYed
+    into the partition tables
+    :param conn: open connection to DB
+    :param sourcetable: table to partition
+    :param columnname: column to partition on
+    :param partitions: list of (exclusive lower bound, inclusive upper bound, partition table name) tuples.
+    A table can appear in more than one tuple
+    :param cols: columns to copy from the source table into the partitions, the tables should already exist
+    :return:dict of partition table name to number of rows saved into it
+    """
+    tables = []
+    for _, _, table in partitions:
+        if table not in tables: tables.append(table)
+    cases = ' '.join('WHEN {0} > {1} AND {0} <= {2} THEN {3}'.format(columnname, formatboundary(lower_bound),
+                                                                     formatboundary(upper_bound), tables.index(table))
+                     for lower_bound, upper_bound, table in partitions)
+    query = 'SELECT * FROM (SELECT CASE {0} END AS bucket, {1} FROM {2}) AS T WHERE bucket IS NOT NULL'.format(
+        cases, ','.join(cols), sourcetable)
+    return spoolandcopy(conn, query, tables, cols)
+
+
+def spoolandcopy(conn, query, tables, cols):
+    """
+    Streams the rows of the query out with COPY into one temporary file per partition and COPYs every file into its
+    partition table. Client memory does not grow with the number of rows
+    :param conn: open connection to DB
+    :param query: SELECT returning the partition number, an index into tables, followed by the columns
+    :param tables: partition table names, the tables should already exist
+    :param cols: columns returned by the query after the partition number
+    :return:dict of partition table name to number of rows saved into it
+    """
+    spool = PartitionSpool(len(tables))
+    try:
+        RatingsDAO.copyto(query, spool, conn)
+        counts = {}
+        for i, table in enumerate(tables):
+            if spool.rows[i]: RatingsDAO.copyfrom(spool.open(i), conn, table, cols)
+            counts[table] = spool.rows[i]
+    finally:
+        spool.close()
+    return counts
+
+
+def insertrangepartition(conn, sourcetable, columnname, cols, lower_bound, upper_bound, partition_tablename):
+    """
+    Copies the rows of (lower_bound, upper_bound] from the source table into an existing partition table
+    :return:number of rows saved
+    """
+    return RatingsDAO.insertwithselectgeneric(columnname, cols, formatboundary(lower_bound),
+                                              formatboundary(upper_bound), partition_tablename, conn, sourcetable)
+
+
+def fillpartitions(conn, sourcetable, columnname, partitions, cols, workers=1):
+    """
+    Fills existing range partition tables from the source table. With a single worker the source table is scanned
+    once, see scanandroute. With more workers, every (lower bound, upper bound) pair is filled by its own
+    INSERT ... SELECT, running concurrently on a pool of 'workers' connections
+    :param partitions: list of (exclusive lower bound, inclusive upper bound, partition table name) tuples
+    :param workers: number of partitions filled concurrently
+    :return:dict of partition table name to number of rows saved into it
+    """
+    if workers <= 0 or not isinstance(workers, int): raise AttributeError(
+        "Number of workers should be a positive integer")
+    if workers == 1: return scanandroute(conn, sourcetable, columnname, partitions, cols)
+
+    conn.commit()  # workers have to see the partition tables, if the connection is not in auto commit mode
+    tasks = [(insertrangepartition, (sourcetable, columnname, cols, lower_bound, upper_bound, table))
+             for lower_bound, upper_bound, table in partitions]
+    counts = {}
+    for (_, _, table), count in zip(partitions, ConnectionUtils.runparallel(conn, tasks, workers)):
+        counts[table] = counts.get(table, 0) + count
+    return counts
+
+
+def rangecatalog(tableprefix, partitions, counts=None):
+    """
+    Builds the catalog entries of range partitions. A table appearing in more than one tuple gets the union of
+    their bounds, which are expected to be adjacent
+    :param tableprefix: prefix of the partition tables, followed by the partition number in the table names
+    :param partitions: list of (exclusive lower bound, inclusive upper bound, partition table name) tuples, a bound
+    can be None for no bound
+    :param counts: dict of partition table name to number of rows, see fillpartitions
+    :return:list of (partition index, table name, lower bound, upper bound, row count) tuples, see
+    PartitionCatalogDAO.save
+    """
+    bounds = {}
+    for lower_bound, upper_bound, table in partitions:
+        if table in bounds:
+            lower, upper = bounds[table]
+            lower_bound = None if None in (lower, lower_bound) else min(lower, lower_bound)
+            upper_bound = None if None in (upper, upper_bound) else max(upper, upper_bound)
+        bounds[table] = (lower_bound, upper_bound)
+    entries = []
+    for table, (lower_bound, upper_bound) in bounds.items():
+        entries.append((int(table[len(tableprefix):]), table,
+                        None if lower_bound is None else formatboundary(lower_bound),
+                        None if upper_bound is None else formatboundary(upper_bound),
+                        None if counts is None else counts.get(table, 0)))
+    return sorted(entries)
+
+
+def comparablebound(bound, value):
+    """
+    :param bound: bound of the catalog, a Decimal
+    :param value: value of the partitioning column
+    :return:the bound as a float for float values, which compare with the bounds as floats like in PostgreSQL
+    """
+    return float(bound) if isinstance(value, float) else decimal.Decimal(bound)
+
+
+def findrangepartition(partitions, value):
+    """
+    :param partitions: catalog of range partitions, see PartitionCatalogDAO.select
+    :param value: value of the partitioning column
+    :return:the Partition holding the value, None if no partition does
+    """
+    for partition in partitions:
+        if partition.lowerbound is not None and value <= comparablebound(partition.lowerbound, value): continue
+        if partition.upperbound is not None and value > comparablebound(partition.upperbound, value): continue
+        return partition
+    return None
+
+
+def validatebackend(backend, ratingstablename, openconnection):
+    """
+    Checks the partitioning backend. The native backend partitions the ratings table itself, so it can hold only
+    one partitioning scheme at a time. Manual partitions are refused too while the ratings table is natively
+    partitioned, as its rows would then be saved both in the manual partitions and in the native ones
+    :param backend: PARTITION_BACKEND_MANUAL or PARTITION_BACKEND_NATIVE
+    :return:None
+    """
+    backends = [PARTITION_BACKEND_MANUAL, PARTITION_BACKEND_NATIVE]
+    if backend not in backends: raise AttributeError("Partition backend should be one of {0}".format(backends))
+    if RatingsDAO.ispartitioned(openconnection, ratingstablename):
+        raise AttributeError('"{0}" table is natively partitioned, delete the partitions first'.format(
+            ratingstablename))
+
+
+def isnativelypartitioned(openconnection, ratingstablename, scheme):
+    """
+    Tells from the ratings table itself, not from the meta data, so that each partitioning has its own backend
+    :param openconnection: open connection to DB
+    :param scheme: PARTITION_SCHEME_RANGE or PARTITION_SCHEME_RROBIN
+    :return:True if the partitions of the scheme were created with PARTITION_BACKEND_NATIVE, the ratings table
+    being their parent
+    """
+    return RatingsDAO.partitionstrategy(openconnection, ratingstablename) == NATIVE_STRATEGIES[scheme]
+
+
+def nativerangepartition(ratingstablename, numberofpartitions, openconnection):
+    """
+    Range partitions the ratings table with PostgreSQL declarative partitioning, into the same partitions as
+    rangepartition. PostgreSQL range partitions include their lower bound and exclude their upper bound, while
+    ours are (lower, upper], so the partition key is -rating: -rating in [-upper, -lower) <=> rating in (lower,
+    upper]. For the planner to prune partitions, predicates have to be written on -rating
+    :param numberofpartitions: Number of partitions
+    :param openconnection: open connection to DB
+    :return:list of (exclusive lower bound, inclusive upper bound, partition table name) tuples, None for no bound
+    """
+    partitions = []
+    boundaries = rangeboundaries(numberofpartitions)
+    for i, (lower_bound, upper_bound) in enumerate(boundaries):
+        # first partition also takes zero ratings and the last one takes everything above its lower bound
+        upper = 'MAXVALUE' if i == 0 else -lower_bound
+        lower = 'MINVALUE' if i == len(boundaries) - 1 else -upper_bound
+        partitions.append((RANGE_PARTITION_TABLE_PREFIX + str(i + 1), 'FROM ({0}) TO ({1})'.format(lower, upper)))
+
+    with ConnectionUtils.transaction(openconnection):
+        RatingsDAO.createpartitioned(openconnection, ratingstablename, 'RANGE ((-rating))', partitions)
+
+    # unlike rangepartition, the first and the last partitions have no bounds
+    boundaries[0] = (None, boundaries[0][1])
+    boundaries[-1] = (boundaries[-1][0], None)
+    return [(lower_bound, upper_bound, RANGE_PARTITION_TABLE_PREFIX + str(i + 1))
+            for i, (lower_bound, upper_bound) in enumerate(boundaries)]
+
+
+def rangepartition(ratingstablename, numberofpartitions, openconnection, backend=PARTITION_BACKEND_MANUAL,
+                   workers=1):
     """
     Partitions the ratings table in to the given number of partition using Range based partitioning scheme
     Partitioned table names will be starting from 1. If the number of partitions are N, the range of Rating values,
@@ -106,62 +648,134 @@ def rangepartition(ratingstablename, numberofpartitions, openconnection):
     Partition 3: all movies with a rating => (2, 3]
     Partition 4: all movies with a rating => (3, 4]
     Partition 5: all movies with a rating => (4, 5]
-    As shown, movies with zero rating will be placed in the first partition
+    As shown, movies with zero rating will be placed in the first partition.
+    The ratings table is scanned only once for all the partitions, see scanandroute
     :param numberofpartitions: Number of partitions
     :param openconnection: open connection to DB
+    :param backend: PARTITION_BACKEND_MANUAL copies the ratings into independent partition tables,
+    PARTITION_BACKEND_NATIVE turns the ratings table into a PostgreSQL partitioned table, see nativerangepartition
+    :param workers: number of partitions filled concurrently, each on a connection of its own, see fillpartitions
     :return:None
     """
     if numberofpartitions <= 0 or not isinstance(numberofpartitions, int): raise AttributeError(
         "Number of partitions should be a positive integer")
+    validatebackend(backend, ratingstablename, openconnection)
 
-    inc = round(float(MAX_RATING) / numberofpartitions, 10)  # precision restricted to 10 decimal places
-    lower_bound = 0.0
-    upper_bound = lower_bound + inc
+    counts = None
+    if backend == PARTITION_BACKEND_NATIVE:
+        partitions = nativerangepartition(ratingstablename, numberofpartitions, openconnection)
+    else:
+        partitions = createrangepartitions(numberofpartitions, openconnection)
+        counts = fillpartitions(openconnection, ratingstablename, 'rating', partitions, RatingsDAO.COLUMNS, workers)
+        if Globals.DEBUG: Globals.printinfo('Saved ratings into range partitions => {0}'.format(counts))
+    saverangepartitioning(ratingstablename, numberofpartitions, openconnection, partitions, counts)
 
+
+def createrangepartitions(numberofpartitions, openconnection):
+    """
+    Creates the empty tables of manual range partitions, see rangepartition
+    :param numberofpartitions: Number of partitions
+    :param openconnection: open connection to DB
+    :return:list of (exclusive lower bound, inclusive upper bound, partition table name) tuples to fill them with
+    """
+    partitions = []
     sno = 1
-    while upper_bound <= MAX_RATING:
-        createrangepartitionandinsert(openconnection, lower_bound, sno, upper_bound, ratingstablename)
-        lower_bound += inc
-        upper_bound += inc
+    for lower_bound, upper_bound in rangeboundaries(numberofpartitions):
+        partition_tablename = RANGE_PARTITION_TABLE_PREFIX + str(sno)
+        RatingsDAO.create(openconnection, partition_tablename)
+        partitions.append((lower_bound, upper_bound, partition_tablename))
         sno += 1
 
-    # If number of partitions is not divisible by MAX_RATING, the last partition will be missed due to rounding
-    if lower_bound != MAX_RATING:
-        createrangepartitionandinsert(openconnection, lower_bound, sno, MAX_RATING, ratingstablename)
-
     # save the movies with zero rating in the first partition
-    createrangepartitionandinsert(openconnection, -1, 1, 0, ratingstablename, False)
+    partitions.append((-1, 0, RANGE_PARTITION_TABLE_PREFIX + '1'))
+    return partitions
 
-    # save the number of partitions in the meta data table
+
+def saverangepartitioning(ratingstablename, numberofpartitions, openconnection, partitions, counts):
+    """
+    Saves the number of range partitions in the meta data table, and the partitions in the catalog
+    :param partitions: list of (exclusive lower bound, inclusive upper bound, partition table name) tuples
+    :param counts: dict of partition table name to number of rows, None if unknown
+    :return:None
+    """
     MetaDataDAO.create(openconnection)  # Create if the table doesnt exist
     MetaDataDAO.upsert(openconnection, Globals.RANGE_PARTITIONS_KEY, numberofpartitions)
+    PartitionCatalogDAO.save(openconnection, RANGE_PARTITION_TABLE_PREFIX, PARTITION_SCHEME_RANGE, ratingstablename,
+                             'rating', rangecatalog(RANGE_PARTITION_TABLE_PREFIX, partitions, counts))
+    QUERY_CACHE.invalidatetable(ratingstablename)  # cached for the old layout, never hit again
 
 
-def roundrobinpartition(ratingstablename, numberofpartitions, openconnection):
+def roundrobinpartition(ratingstablename, numberofpartitions, openconnection, backend=PARTITION_BACKEND_MANUAL,
+                        workers=1):
     """
     Partition the ratings table into 'numberofpartitions' pieces in a round robin manner
-    Partitions will be zero indexed.
+    Partitions will be zero indexed. Ratings are numbered from 1 in the order of their IDs, gaps in IDs are skipped.
     Eg: N = 3 partitions
-    Partition 0: IDs = [0,3,6..]
-    Partition 1: IDs = [1,3,7...]
-    Partition 2: IDs = [2,4,8...]
+    Partition 0: ratings = [3,6,9..]
+    Partition 1: ratings = [1,4,7...]
+    Partition 2: ratings = [2,5,8...]
     :param numberofpartitions: Number of partitions
     :param openconnection: open connection to DB
+    :param backend: PARTITION_BACKEND_MANUAL copies the ratings into independent partition tables,
+    PARTITION_BACKEND_NATIVE turns the ratings table into a PostgreSQL table partitioned by HASH (id), which
+    spreads the ratings evenly but not in the exact round robin order
+    :param workers: number of partitions filled concurrently, each on a connection of its own and reading the
+    ratings table directly
     :return:None
     """
     if numberofpartitions <= 0 or not isinstance(numberofpartitions, int): raise AttributeError(
         "Number of partitions should be a positive integer")
-
-    numberofratings = RatingsDAO.numberofratings(openconnection, ratingstablename)
-    # Assumption: IDs are in order from 1 to total number of ratings in Ratings table
-    allids = range(1, numberofratings + 1)
-    for i in range(0, numberofpartitions):
-        ratingids = filter(lambda x: x % numberofpartitions == i, allids)
-        createrobinpartitionandinsert(openconnection, i, ratingids, ratingstablename)
-
-    # save the number of partitions in the meta data table
+    if workers <= 0 or not isinstance(workers, int): raise AttributeError(
+        "Number of workers should be a positive integer")
+    validatebackend(backend, ratingstablename, openconnection)
+
+    tables = [RROBIN_PARTITION_TABLE_PREFIX + str(i) for i in range(0, numberofpartitions)]
+    counts = {}
+    if backend == PARTITION_BACKEND_NATIVE:
+        partitions = [(table, 'WITH (MODULUS {0}, REMAINDER {1})'.format(numberofpartitions, i))
+                      for i, table in enumerate(tables)]
+        with ConnectionUtils.transaction(openconnection):
+            RatingsDAO.createpartitioned(openconnection, ratingstablename, 'HASH (id)', partitions)
+        # PostgreSQL routes the inserted ratings, so zone maps could not be kept up to date
+        ZoneMapDAO.delete(openconnection, tables)
+    else:
+        for table in tables:
+            RatingsDAO.create(openconnection, table)
+        if workers == 1:
+            # single statement and single pass over the ratings, numbered in the order of their IDs on the server
+            query = 'SELECT row_number() OVER (ORDER BY id) % {0} AS bucket, userid, movieid, rating FROM {1}'.format(
+                numberofpartitions, ratingstablename)
+            counts = RatingsDAO.insertrouted(openconnection, query, tables, RatingsDAO.COLUMNS)
+        else:
+            # every worker numbers the ratings along the primary key index and keeps those of its partition, so
+            # that the ratings are written once, straight into the partitions
+            openconnection.commit()  # workers have to see the tables, if the connection is not in auto commit mode
+            tasks = [(RatingsDAO.insertroundrobin, (table, numberofpartitions, i, ratingstablename))
+                     for i, table in enumerate(tables)]
+            counts = dict(zip(tables, ConnectionUtils.runparallel(openconnection, tasks, workers)))
+        if Globals.DEBUG:
+            for table in tables:
+                Globals.printinfo('Partition {0}: saved {1} ratings'.format(table, counts[table]))
+        numberofratings = sum(counts.values())
+        ZoneMapDAO.compute(openconnection, tables)
+        # the position of the next inserted rating decides its partition, see roundrobininsert
+        MetaDataDAO.createsequence(openconnection, ratingstablename + RROBIN_SEQUENCE_SUFFIX, numberofratings + 1)
+
+    saverobinpartitioning(ratingstablename, openconnection, tables, counts)
+
+
+def saverobinpartitioning(ratingstablename, openconnection, tables, counts):
+    """
+    Saves the number of round robin partitions in the meta data table, and the partitions in the catalog
+    :param tables: partition table names, in the order of their partition numbers
+    :param counts: dict of partition table name to number of rows, tables left out are of unknown size
+    :return:None
+    """
     MetaDataDAO.create(openconnection)  # Create if the table doesnt exist
-    MetaDataDAO.upsert(openconnection, Globals.RROBIN_PARTITIONS_KEY, numberofpartitions)
+    MetaDataDAO.upsert(openconnection, Globals.RROBIN_PARTITIONS_KEY, len(tables))
+    PartitionCatalogDAO.save(openconnection, RROBIN_PARTITION_TABLE_PREFIX, PARTITION_SCHEME_RROBIN, ratingstablename,
+                             None, [(i, table, None, None, counts.get(table)) for i, table in enumerate(tables)])
+    QUERY_CACHE.invalidatetable(ratingstablename)  # cached for the old layout, never hit again
 
 
 def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection):
@@ -181,13 +795,23 @@ def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection):
         return
     n = int(n)
 
-    numberofratings = RatingsDAO.numberofratings(openconnection, ratingstablename)
-    partitionindex = (numberofratings + 1) % n
+    if isnativelypartitioned(openconnection, ratingstablename, PARTITION_SCHEME_RROBIN):
+        # PostgreSQL routes the rating into its partition
+        RatingsDAO.insert([(userid, itemid, rating)], openconnection, ratingstablename)
+        QUERY_CACHE.invalidate(RROBIN_PARTITION_TABLE_PREFIX + str(i) for i in range(0, n))
+        return
+
+    # position of the rating in the round robin order. The sequence hands out every position exactly once, even
+    # to concurrent clients, and it costs the same at any table size unlike counting the ratings
+    position = MetaDataDAO.nextval(openconnection, ratingstablename + RROBIN_SEQUENCE_SUFFIX)
+    partitionindex = position % n
     destinationtable = RROBIN_PARTITION_TABLE_PREFIX + str(partitionindex)
-    RatingsDAO.insert([(userid, itemid, rating)], openconnection, destinationtable)
-    # also insert into the ratings table as we are using computing partition index based on number of
-    # rows in ratings table above
-    RatingsDAO.insert([(userid, itemid, rating)], openconnection, ratingstablename)
+    # the zone map is widened first, so that it covers the rating as soon as queries can see it
+    ZoneMapDAO.widen(openconnection, [ZoneMapDAO.Zone(destinationtable, 1, userid, userid, itemid, itemid, rating,
+                                                      rating, ZoneMapDAO.ratingbit(rating))])
+    # also insert into the ratings table, so that it keeps all the ratings
+    RatingsDAO.insertintotables([(userid, itemid, rating)], openconnection, [destinationtable, ratingstablename])
+    QUERY_CACHE.invalidate([destinationtable])
     if Globals.DEBUG: Globals.printinfo(
         'Inserted rating (UserID: {0}, MovieID: {1}, Rating: {2}), to "{3}" table'.format(userid, itemid, rating,
                                                                                           destinationtable))
@@ -204,17 +828,210 @@ def rangeinsert(ratingstablename, userid, itemid, rating, openconnection):
     :return:None
     """
     if not validaterating(rating): return
-    n = MetaDataDAO.select(openconnection, Globals.RANGE_PARTITIONS_KEY)
-    if n is None:
+    partitions = PartitionCatalogDAO.select(openconnection, RANGE_PARTITION_TABLE_PREFIX, ratingstablename, 'rating')
+    if not partitions:
         Globals.printwarning("First create the partitions and then try to insert")
         return
-    n = int(n)
 
-    partitionwidth = float(MAX_RATING) / n
-    # to handle cases when rating is 0, max function is used. Will be inserted in first patition
-    partitionindex = max(int(math.ceil(rating / partitionwidth)), 1)
-    destinationtable = RANGE_PARTITION_TABLE_PREFIX + str(partitionindex)
+    if isnativelypartitioned(openconnection, ratingstablename, PARTITION_SCHEME_RANGE):
+        # PostgreSQL routes the rating into its partition
+        RatingsDAO.insert([(userid, itemid, rating)], openconnection, ratingstablename)
+        QUERY_CACHE.invalidate(partition.tablename for partition in partitions)
+        return
+
+    # route on the bounds the partitions were filled with, zero ratings are in the first partition
+    partition = findrangepartition(partitions, rating)
+    if partition is None:
+        Globals.printwarning("No range partition holds a rating of {0}".format(rating))
+        return
+    destinationtable = partition.tablename
+    # the row count of the partition is left approximate, updating the catalog for every rating would cost more
+    # than the insert itself
     RatingsDAO.insert([(userid, itemid, rating)], openconnection, destinationtable)
+    QUERY_CACHE.invalidate([destinationtable])
+    if Globals.DEBUG: Globals.printinfo(
+        'Inserted rating (UserID: {0}, MovieID: {1}, Rating: {2}), to "{3}" table'.format(userid, itemid, rating,
+                                                                                          destinationtable))
+
+
+def toratingsblock(rows):
+    """
+    :param rows: a block of RatingsParser.RATINGS_DTYPE, or a sequence of (userid, movieid, rating) tuples
+    :return:block of RatingsParser.RATINGS_DTYPE
+    """
+    if isinstance(rows, np.ndarray) and rows.dtype.names: return rows
+    values = np.array(rows, dtype=np.float64).reshape(-1, len(RatingsDAO.COLUMNS))
+    block = np.zeros(len(values), dtype=RatingsParser.RATINGS_DTYPE)
+    for index, col in enumerate(RatingsDAO.COLUMNS):
+        block[col] = values[:, index]
+    return block
+
+
+def validratingsmask(ratings):
+    """
+    Vectorized validaterating
+    :param ratings: NumPy array of ratings
+    :return:boolean NumPy array, True for the valid ratings
+    """
+    return (ratings >= 0) & (ratings <= MAX_RATING) & (ratings * 2 == np.floor(ratings * 2))
+
+
+def rangeinsert_many(ratingstablename, rows, openconnection):
+    """
+    Inserts a batch of ratings into range based partitioned tables. The whole batch is validated and routed at once
+    with searchsorted over the saved partition boundaries, then written with one COPY per target partition, in a
+    single transaction. Invalid ratings are skipped with a warning
+    :param rows: a block of RatingsParser.RATINGS_DTYPE, or a sequence of (userid, movieid, rating) tuples
+    :param openconnection: open connection to DB
+    :return:number of ratings inserted
+    """
+    # the layout is read before the transaction starts
+    partitions = PartitionCatalogDAO.select(openconnection, RANGE_PARTITION_TABLE_PREFIX, ratingstablename, 'rating')
+    if not partitions:
+        Globals.printwarning("First create the partitions and then try to insert")
+        return 0
+    native = isnativelypartitioned(openconnection, ratingstablename, PARTITION_SCHEME_RANGE)
+
+    block = toratingsblock(rows)
+    valid = validratingsmask(block['rating'])
+    if not valid.all():
+        Globals.printwarning('Skipping {0} ratings which are not one of {1}'.format(len(block) - valid.sum(),
+                                                                                   VALID_RATINGS))
+        block = block[valid]
+    if len(block) == 0: return 0
+
+    with ConnectionUtils.transaction(openconnection):
+        if native:
+            # PostgreSQL routes the ratings into their partitions
+            loadblock(block, openconnection, ratingstablename)
+            touched = [partition.tablename for partition in partitions]
+        else:
+            upper_bounds = np.array([float(partition.upperbound) for partition in partitions])
+            # index of the first upper bound >= rating, zero ratings falling into the first partition
+            indices = np.minimum(np.searchsorted(upper_bounds, block['rating'], side='left'), len(partitions) - 1)
+            counts = {}
+            for i in np.unique(indices):
+                table = partitions[i].tablename
+                counts[table] = loadblock(block[indices == i], openconnection, table)
+            PartitionCatalogDAO.addrows(openconnection, counts)
+            touched = counts.keys()
+    QUERY_CACHE.invalidate(touched)
+    if Globals.DEBUG: Globals.printinfo('Inserted {0} ratings into range partitions'.format(len(block)))
+    return len(block)
+
+
+def hashbucket(columnname, numberofpartitions):
+    """
+    :return:SQL expression of the hash partition of a row, value modulo numberofpartitions. Negative values are
+    wrapped like Python's % operator and NULLs go to partition 0
+    """
+    return 'COALESCE(mod(mod({0}, {1}) + {1}, {1}), 0)'.format(columnname, numberofpartitions)
+
+
+def inserthashpartition(conn, sourcetable, cols, condition, partition_tablename):
+    """
+    Copies the rows of the source table matching the partition condition into an existing partition table
+    :return:number of rows saved
+    """
+    return RatingsDAO.insertwithcondition(condition, cols, partition_tablename, conn, sourcetable)
+
+
+def hashpartitiongeneric(tablename, columnname, numberofpartitions, openconnection,
+                         tableprefix=HASH_PARTITION_TABLE_PREFIX, workers=1):
+    """
+    Partitions a table on the value of an integer column modulo the number of partitions, so that the rows of the
+    same key always land in the same partition. Partitions will be zero indexed and have all the columns of the table.
+    Eg: N = 3 partitions, on movieid
+    Partition 0: movieid = [3,6,9..]
+    Partition 1: movieid = [1,4,7...]
+    Partition 2: movieid = [2,5,8...]
+    The table is scanned only once for all the partitions, like scanandroute
+    :param columnname: integer column to partition on
+    :param numberofpartitions: Number of partitions
+    :param openconnection: open connection to DB
+    :param tableprefix: prefix of the partition tables
+    :param workers: number of partitions filled concurrently, each on a connection of its own
+    :return:dict of partition table name to number of rows saved into it
+    """
+    if numberofpartitions <= 0 or not isinstance(numberofpartitions, int): raise AttributeError(
+        "Number of partitions should be a positive integer")
+    if RatingsDAO.get_column_type(openconnection, tablename, columnname) not in HASH_COLUMN_TYPES:
+        raise AttributeError('"{0}.{1}" should be a column of one of the types {2}'.format(
+            tablename, columnname, list(HASH_COLUMN_TYPES)))
+
+    tables = [tableprefix + str(i) for i in range(0, numberofpartitions)]
+    for table in tables:
+        RatingsDAO.createfromschema(openconnection, tablename, table)
+    cols = RatingsDAO.get_column_names(openconnection, tablename)
+    bucket = hashbucket(columnname, numberofpartitions)
+    if workers == 1:
+        query = 'SELECT {0} AS bucket, {1} FROM {2}'.format(bucket, ','.join(cols), tablename)
+        counts = spoolandcopy(openconnection, query, tables, cols)
+    else:
+        tasks = [(inserthashpartition, (tablename, cols, '{0} = {1}'.format(bucket, i), table))
+                 for i, table in enumerate(tables)]
+        counts = dict(zip(tables, ConnectionUtils.runparallel(openconnection, tasks, workers)))
+    if Globals.DEBUG: Globals.printinfo('Saved rows of "{0}" into hash partitions => {1}'.format(tablename, counts))
+
+    # save the partitioning in the catalog
+    PartitionCatalogDAO.save(openconnection, tableprefix, PARTITION_SCHEME_HASH, tablename, columnname,
+                             [(i, table, None, None, counts[table]) for i, table in enumerate(tables)])
+    return counts
+
+
+def gethashpartitioning(openconnection, tableprefix=HASH_PARTITION_TABLE_PREFIX):
+    """
+    Fetches the partitioning saved by hashpartitiongeneric from the catalog
+    :param openconnection: open connection to DB
+    :param tableprefix: prefix of the partition tables
+    :return:(table name, column name, number of partitions), None if there are no such partitions
+    """
+    partitions = PartitionCatalogDAO.select(openconnection, tableprefix)
+    if not partitions: return None
+    return partitions[0].sourcetable, partitions[0].columnname, len(partitions)
+
+
+def hashpartition(ratingstablename, columnname, numberofpartitions, openconnection, workers=1):
+    """
+    Partition the ratings table into 'numberofpartitions' pieces on a key column, see hashpartitiongeneric.
+    Joins and group bys on the key can work partition by partition, Eg: parallel_join with PARTITION_SCHEME_HASH
+    :param columnname: 'userid' or 'movieid'
+    :param numberofpartitions: Number of partitions
+    :param openconnection: open connection to DB
+    :param workers: number of partitions filled concurrently, each on a connection of its own
+    :return:None
+    """
+    if columnname not in ('userid', 'movieid'): raise AttributeError("Column should be one of ['userid', 'movieid']")
+    hashpartitiongeneric(ratingstablename, columnname, numberofpartitions, openconnection,
+                         HASH_PARTITION_TABLE_PREFIX, workers)
+
+
+def hashinsert(ratingstablename, userid, itemid, rating, openconnection):
+    """
+    Insert a new rating into hash based partitioned tables, and into the ratings table
+    An error is thrown if this method is called without creating hash based pratition tables
+    :param openconnection: open connection to DB
+    :param userid: 1st column of ratings table, User ID
+    :param itemid: 2nd column of ratings table, Movie ID
+    :param rating: 3rd column of ratings table, Rating
+    :return:None
+    """
+    if not validaterating(rating): return
+    partitioning = gethashpartitioning(openconnection)
+    if partitioning is None:
+        Globals.printwarning("First create the partitions and then try to insert")
+        return
+    sourcetable, columnname, n = partitioning
+    if sourcetable != ratingstablename:
+        Globals.printwarning('The hash partitions are not built from "{0}"'.format(ratingstablename))
+        return
+
+    key = userid if columnname == 'userid' else itemid
+    if not isinstance(key, (int, long)): raise AttributeError("{0} should be an integer".format(
+        'User ID' if columnname == 'userid' else 'Movie ID'))
+    destinationtable = HASH_PARTITION_TABLE_PREFIX + str(key % n)
+    # the partition gets the ID generated by the ratings table
+    RatingsDAO.insertandcopy([(userid, itemid, rating)], openconnection, ratingstablename, destinationtable)
     if Globals.DEBUG: Globals.printinfo(
         'Inserted rating (UserID: {0}, MovieID: {1}, Rating: {2}), to "{3}" table'.format(userid, itemid, rating,
                                                                                           destinationtable))
@@ -222,7 +1039,7 @@ def rangeinsert(ratingstablename, userid, itemid, rating, openconnection):
 
 def deletepartitions(ratingstablename, openconnection):
     """
-    Deletes the partitions and the meta data table. Does NOT drop the Ratings table as per requirement
+    Deletes the partitions, the meta data table and the catalog. Does NOT drop the Ratings table as per requirement
     :param ratingstablename: name of the ratings table
     :param openconnection: open connection with DB
     :return:None
@@ -234,41 +1051,267 @@ def deletepartitions(ratingstablename, openconnection):
         rangepartitions = 0 if temp is None else int(temp)
         temp = MetaDataDAO.select(openconnection, Globals.RROBIN_PARTITIONS_KEY)
         robinpartitions = 0 if temp is None else int(temp)
+        prefixes = [RANGE_PARTITION_TABLE_PREFIX, RROBIN_PARTITION_TABLE_PREFIX, HASH_PARTITION_TABLE_PREFIX,
+                    SORT_PARTITION_TABLE_PREFIX]
+        tables = [partition.tablename for prefix in prefixes
+                  for partition in PartitionCatalogDAO.select(openconnection, prefix)]
 
+        if RatingsDAO.ispartitioned(openconnection, ratingstablename):
+            # native partitions are dropped while the ratings are moved back into a plain table
+            with ConnectionUtils.transaction(openconnection):
+                RatingsDAO.unpartition(openconnection, ratingstablename)
+
+        MetaDataDAO.dropsequence(openconnection, ratingstablename + RROBIN_SEQUENCE_SUFFIX)
         queries = []
         for i in range(0, robinpartitions):
             queries.append('DROP TABLE IF EXISTS {0}{1}'.format(RROBIN_PARTITION_TABLE_PREFIX, i))
         for i in range(1, rangepartitions + 1):
             queries.append('DROP TABLE IF EXISTS {0}{1}'.format(RANGE_PARTITION_TABLE_PREFIX, i))
-        cur.execute('; '.join(queries))
+        for table in tables:
+            queries.append('DROP TABLE IF EXISTS {0}'.format(table))
+        if queries: cur.execute('; '.join(queries))
         # Delete MetaData table
         MetaDataDAO.drop(openconnection)
-        if Globals.DEBUG: Globals.printinfo('Deleted partitions and Meta Data table')
+        PartitionCatalogDAO.drop(openconnection)
+        ZoneMapDAO.drop(openconnection)
+        QUERY_CACHE.invalidatetable(ratingstablename)
+        if Globals.DEBUG: Globals.printinfo('Deleted partitions, Meta Data table, catalog and zone maps')
+
+
+# Assignment 2
+
+def overlaps(partition, minvalue, maxvalue):
+    """
+    :param partition: a range Partition of the catalog, holding the values of (lowerbound, upperbound]
+    :return:True if the partition can hold values of [minvalue, maxvalue]
+    """
+    if partition.lowerbound is not None and maxvalue <= comparablebound(partition.lowerbound, maxvalue): return False
+    if partition.upperbound is not None and minvalue > comparablebound(partition.upperbound, minvalue): return False
+    return True
+
+
+def zonematches(zone, bounds):
+    """
+    :param zone: ZoneMapDAO.Zone of a partition
+    :param bounds: dict of column name to (inclusive lower bound, inclusive upper bound)
+    :return:False if the partition cannot hold a row within the bounds
+    """
+    if zone.rowcount == 0: return False
+    for col, (lower_bound, upper_bound) in bounds.items():
+        minvalue, maxvalue = getattr(zone, 'min' + col), getattr(zone, 'max' + col)
+        if minvalue is not None and upper_bound < minvalue: return False
+        if maxvalue is not None and lower_bound > maxvalue: return False
+    if 'rating' in bounds and zone.ratingbitmap is not None:
+        lower_bound, upper_bound = bounds['rating']
+        steps = range(max(int(math.ceil(lower_bound * ZoneMapDAO.RATING_STEPS)), 0),
+                      min(int(math.floor(upper_bound * ZoneMapDAO.RATING_STEPS)),
+                          ZoneMapDAO.MAX_RATING * ZoneMapDAO.RATING_STEPS) + 1)
+        if not any(zone.ratingbitmap & (1 << step) for step in steps): return False
+    return True
+
+
+def blockzone(table, block):
+    """
+    :param table: name of the table the block is added to
+    :param block: non empty array of RatingsParser.RATINGS_DTYPE
+    :return:ZoneMapDAO.Zone of the block
+    """
+    steps = block['rating'] * ZoneMapDAO.RATING_STEPS
+    bitmap = None
+    if (steps == np.floor(steps)).all() and validratingsmask(block['rating']).all():
+        bitmap = int(np.bitwise_or.reduce(np.left_shift(1, steps.astype(np.int64))))
+    return ZoneMapDAO.Zone(table, len(block), int(block['userid'].min()), int(block['userid'].max()),
+                           int(block['movieid'].min()), int(block['movieid'].max()), float(block['rating'].min()),
+                           float(block['rating'].max()), bitmap)
+
+
+def scanpartition(conn, partition_tablename, bounds):
+    """
+    Task of the queries, fetches the ratings within the bounds from one partition
+    :return:(partition table name, userid, movieid, rating) tuples using yield
+    """
+    for row in RatingsDAO.selectrange(conn, partition_tablename, bounds):
+        yield (partition_tablename,) + tuple(row)
+
+
+def cachestream(stream, key, ratingstablename, partitions, generation):
+    """
+    Passes the rows of a query through, and caches them once the stream is fully consumed. Results above the memory
+    cap of the cache are not kept
+    :return:rows using yield
+    """
+    rows, size = [], 0
+    for row in stream:
+        if rows is not None:
+            rows.append(row)
+            size += QueryCache.rowsize(row)
+            if size > QUERY_CACHE.maxbytes: rows = None
+        yield row
+    if rows is not None: QUERY_CACHE.put(key, rows, ratingstablename, partitions, generation)
+
+
+def scanpartitions(openconnection, ratingstablename, partitions, bounds, workers):
+    """
+    Scans the partitions concurrently, each on a connection of its own. Round robin partitions whose zone map cannot
+    match the bounds are skipped. Results are served from QUERY_CACHE when the same query was run on the same
+    partition layout, and no write touched its partitions since
+    :param partitions: Partitions of the catalog to scan
+    :param bounds: dict of column name to (inclusive lower bound, inclusive upper bound)
+    :param workers: number of partitions scanned at once, defaults to the number of CPUs
+    :return:iterator of (partition table name, userid, movieid, rating) tuples, in no particular order
+    """
+    if workers is None: workers = multiprocessing.cpu_count()
+    if workers <= 0 or not isinstance(workers, int): raise AttributeError(
+        "Number of workers should be a positive integer")
+
+    key = querykey(openconnection, ratingstablename, bounds)
+    generation = QUERY_CACHE.generation
+    if key is not None:
+        rows = QUERY_CACHE.get(key)
+        if rows is not None: return iter(rows)
+
+    tables = prunepartitions(openconnection, partitions, bounds)
+    tasks = [(scanpartition, (table, bounds)) for table in tables]
+    stream = ConnectionUtils.streamparallel(openconnection, tasks, workers)
+    if key is None: return stream
+    # skipped partitions count too, an insert can make them match
+    return cachestream(stream, key, ratingstablename, [partition.tablename for partition in partitions], generation)
+
+
+def querykey(openconnection, ratingstablename, bounds):
+    """
+    :param bounds: dict of column name to (inclusive lower bound, inclusive upper bound)
+    :return:key of the query in QUERY_CACHE, None if it cannot be cached, Eg: in a transaction. The key holds the
+    meta data version of the database, which tells the partition layouts apart whatever the connection
+    """
+    version = MetaDataDAO.version(openconnection)
+    if version is None: return None
+    return ratingstablename, tuple(sorted(bounds.items())), version
+
+
+def prunepartitions(openconnection, partitions, bounds):
+    """
+    :param partitions: Partitions of the catalog
+    :param bounds: dict of column name to (inclusive lower bound, inclusive upper bound)
+    :return:names of the partition tables to scan, round robin partitions whose zone map cannot match the bounds
+    are left out
+    """
+    zones = ZoneMapDAO.select(openconnection, [partition.tablename for partition in partitions
+                                               if partition.scheme == PARTITION_SCHEME_RROBIN])
+    tables = [partition.tablename for partition in partitions
+              if partition.tablename not in zones or zonematches(zones[partition.tablename], bounds)]
+    if Globals.DEBUG: Globals.printinfo('Scanning partitions {0} for {1}'.format(tables, bounds))
+    return tables
+
+
+def rangequery(ratingstablename, ratingminvalue, ratingmaxvalue, openconnection, workers=None):
+    """
+    Fetches the ratings of [ratingminvalue, ratingmaxvalue] from the range and the round robin partitions of the
+    ratings table. Range partitions which cannot hold such ratings are skipped, using their bounds in the catalog.
+    Round robin partitions are skipped using their zone maps. Partitions are scanned concurrently, each on a
+    connection of its own, and their rows are streamed as they arrive
+    :param ratingminvalue: inclusive lower bound on the rating
+    :param ratingmaxvalue: inclusive upper bound on the rating
+    :param openconnection: open connection to DB
+    :param workers: number of partitions scanned at once, defaults to the number of CPUs
+    :return:iterator of (partition table name, userid, movieid, rating) tuples, in no particular order
+    """
+    partitions = rangequerypartitions(ratingstablename, ratingminvalue, ratingmaxvalue, openconnection)
+    return scanpartitions(openconnection, ratingstablename, partitions, {'rating': (ratingminvalue, ratingmaxvalue)},
+                          workers)
+
+
+def rangequerypartitions(ratingstablename, ratingminvalue, ratingmaxvalue, openconnection):
+    """
+    :return:the range Partitions which can hold ratings of [ratingminvalue, ratingmaxvalue] followed by all the
+    round robin Partitions of the ratings table
+    """
+    if ratingminvalue > ratingmaxvalue: raise AttributeError("Minimum rating should not be above the maximum rating")
+
+    partitions = [partition for partition in PartitionCatalogDAO.select(openconnection, RANGE_PARTITION_TABLE_PREFIX,
+                                                                        ratingstablename, 'rating')
+                  if overlaps(partition, ratingminvalue, ratingmaxvalue)]
+    partitions += [partition for partition in PartitionCatalogDAO.select(openconnection, RROBIN_PARTITION_TABLE_PREFIX)
+                   if partition.sourcetable == ratingstablename]
+    return partitions
+
+
+def pointquery(ratingstablename, ratingvalue, openconnection, workers=None):
+    """
+    Fetches the ratings equal to ratingvalue from the range and the round robin partitions, see rangequery
+    :param ratingvalue: rating to look for
+    :param openconnection: open connection to DB
+    :param workers: number of partitions scanned at once, defaults to the number of CPUs
+    :return:iterator of (partition table name, userid, movieid, rating) tuples, in no particular order
+    """
+    return rangequery(ratingstablename, ratingvalue, ratingvalue, openconnection, workers)
+
+
+def keyquery(ratingstablename, openconnection, userid=None, movieid=None, workers=None):
+    """
+    Fetches the ratings of a user and / or a movie from the round robin partitions, which together hold all the
+    ratings. Partitions whose zone map cannot hold the keys are skipped, which works best when the partitions were
+    built in load order
+    :param openconnection: open connection to DB
+    :param userid: User ID to look for, None for any
+    :param movieid: Movie ID to look for, None for any
+    :param workers: number of partitions scanned at once, defaults to the number of CPUs
+    :return:iterator of (partition table name, userid, movieid, rating) tuples, in no particular order
+    """
+    bounds = {}
+    if userid is not None: bounds['userid'] = (userid, userid)
+    if movieid is not None: bounds['movieid'] = (movieid, movieid)
+    if not bounds: raise AttributeError("Give a user id, a movie id or both")
+
+    partitions = [partition for partition in PartitionCatalogDAO.select(openconnection, RROBIN_PARTITION_TABLE_PREFIX)
+                  if partition.sourcetable == ratingstablename]
+    return scanpartitions(openconnection, ratingstablename, partitions, bounds, workers)
 
 
 # Assignment 3
 
-def createrangepartitionandinsertgeneric(conn, col, lower_bound, partition_index, upper_bound, ratingstablename,
-                                         dropifexists=True, table_prefix=RANGE_PARTITION_TABLE_PREFIX):
+def quantilesplitpoints(tablename, columnname, numberofpartitions, openconnection, min_value, max_value,
+                        samplepercent=None):
     """
-    Creates a new partition table and calls INSERT method of DAO to insert the data
-    :param conn: open connection to DB
-    :param lower_bound: lower bound on the rating
-    :param partition_index: table number. As single single table is split into parts
-    :param upper_bound: inclusive upper bound on the rating to insert in the new table
-    :param dropifexists: drops the table if exists
-    :return:None
+    Computes split points which leave about the same number of rows in every partition, using percentile_disc
+    :param numberofpartitions: Number of partitions
+    :param min_value: first split point
+    :param max_value: last split point
+    :param samplepercent: if given, percentiles are computed on a TABLESAMPLE of this percentage of the table
+    :return:list of numberofpartitions + 1 non decreasing split points
     """
-    partition_tablename = '{0}{1}'.format(table_prefix, partition_index)
-    RatingsDAO.createfromschema(conn, ratingstablename, partition_tablename, dropifexists)
-    RatingsDAO.insertwithselectgeneric(col, RatingsDAO.get_column_names(conn, ratingstablename), lower_bound,
-                                       upper_bound, partition_tablename, conn, ratingstablename)
-    if Globals.DEBUG: Globals.printinfo(
-        'Partition {2}: saved values => ({0}, {1}]'.format(lower_bound, upper_bound, partition_index))
+    fractions = [float(i) / numberofpartitions for i in range(1, numberofpartitions)]
+    percentiles = RatingsDAO.get_percentiles(openconnection, columnname, tablename, fractions, samplepercent)
+    if len(percentiles) != len(fractions): raise ValueError('Could not compute percentiles of "{0}.{1}"'.format(
+        tablename, columnname))
+    # a sample or the other table of a join can have values outside [min_value, max_value]
+    return [min_value] + [min(max(value, min_value), max_value) for value in percentiles] + [max_value]
+
+
+def formatboundary(value):
+    """
+    :param value: a split point
+    :return:string which can be parsed back into the same value
+    """
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def getrangeboundaries(openconnection, tableprefix):
+    """
+    Fetches the split points of range partitions from the catalog
+    :param openconnection: open connection to DB
+    :param tableprefix: prefix of the partition tables
+    :return:list of split points as Decimals, the lower bound of the first partition followed by the upper bounds of
+    all the partitions. None for no bound. None if there are no such partitions
+    """
+    partitions = PartitionCatalogDAO.select(openconnection, tableprefix)
+    if not partitions: return None
+    return [partitions[0].lowerbound] + [partition.upperbound for partition in partitions]
 
 
 def rangepartitiongeneric(tablename, columnname, numberofpartitions, openconnection,
-                          tableprefix=RANGE_PARTITION_TABLE_PREFIX, min_value=None, max_value=None):
+                          tableprefix=RANGE_PARTITION_TABLE_PREFIX, min_value=None, max_value=None,
+                          split=RANGE_SPLIT_EQUIWIDTH, samplepercent=None, splitpoints=None, workers=1):
     """
     Partitions the ratings table in to the given number of partition using Range based partitioning scheme
     Partitioned table names will be starting from 1. If the number of partitions are N, the range of Rating values,
@@ -279,95 +1322,347 @@ def rangepartitiongeneric(tablename, columnname, numberofpartitions, openconnect
     Partition 3: all movies with a rating => (2, 3]
     Partition 4: all movies with a rating => (3, 4]
     Partition 5: all movies with a rating => (4, 5]
-    As shown, movies with zero rating will be placed in the first partition
+    As shown, movies with zero rating will be placed in the first partition.
+    With RANGE_SPLIT_QUANTILE the split points are percentiles of the column instead, so that skewed columns
+    still give partitions of about the same size. Heavily repeated values can leave some partitions empty.
+    The bounds and row counts of the partitions are saved in the catalog, see getrangeboundaries.
+    The table is scanned only once for all the partitions, see scanandroute
     :param numberofpartitions: Number of partitions
     :param openconnection: open connection to DB
-    :return:None
+    :param split: RANGE_SPLIT_EQUIWIDTH or RANGE_SPLIT_QUANTILE
+    :param samplepercent: with RANGE_SPLIT_QUANTILE, computes the percentiles on a TABLESAMPLE of this percentage
+    :param splitpoints: explicit list of numberofpartitions + 1 non decreasing split points. Overrides split
+    :param workers: number of partitions filled concurrently, each on a connection of its own, see fillpartitions
+    :return:[min_value, max_value]
     """
     if numberofpartitions <= 0 or not isinstance(numberofpartitions, int): raise AttributeError(
         "Number of partitions should be a positive integer")
-
-    if min_value is None or max_value is None:
+    if split not in (RANGE_SPLIT_EQUIWIDTH, RANGE_SPLIT_QUANTILE): raise AttributeError(
+        "Split should be one of {0}".format([RANGE_SPLIT_EQUIWIDTH, RANGE_SPLIT_QUANTILE]))
+    if splitpoints is not None and len(splitpoints) != numberofpartitions + 1: raise AttributeError(
+        "Expected {0} split points".format(numberofpartitions + 1))
+
+    if splitpoints is not None:
+        min_value, max_value = splitpoints[0], splitpoints[-1]
+    elif min_value is None or max_value is None:
         min_max = RatingsDAO.get_min_max(openconnection, columnname, tablename)
         min_value = min_max[0]
         max_value = min_max[1]
 
-    inc = (max_value - min_value) / numberofpartitions  # This devision doesnt leave any reminder is the assumption
-    lower_bound = min_value
-    upper_bound = lower_bound + inc
+    if splitpoints is not None:
+        boundaries = zip(splitpoints, splitpoints[1:])
+    elif split == RANGE_SPLIT_QUANTILE:
+        splitpoints = quantilesplitpoints(tablename, columnname, numberofpartitions, openconnection, min_value,
+                                          max_value, samplepercent)
+        boundaries = zip(splitpoints, splitpoints[1:])
+    else:
+        boundaries = rangeboundaries(numberofpartitions, min_value, max_value)
+        splitpoints = [min_value] + [upper_bound for _, upper_bound in boundaries]
 
+    partitions = []
     partition_index = 1
-    for i in range(0, numberofpartitions):
-        createrangepartitionandinsertgeneric(openconnection, columnname, lower_bound, partition_index, upper_bound,
-                                             tablename, True, tableprefix)
-        lower_bound += inc
-        upper_bound += inc
+    for lower_bound, upper_bound in boundaries:
+        partition_tablename = '{0}{1}'.format(tableprefix, partition_index)
+        RatingsDAO.createfromschema(openconnection, tablename, partition_tablename)
+        partitions.append((lower_bound, upper_bound, partition_tablename))
         partition_index += 1
 
     # save the rows with min value of sort column in the first partition
-    createrangepartitionandinsert(openconnection, min_value - 1, 1, min_value, tablename, False)
+    partitions.append((min_value - 1, min_value, '{0}{1}'.format(tableprefix, 1)))
 
-    # save the number of partitions in the meta data table
-    MetaDataDAO.create(openconnection)  # Create if the table doesnt exist
-    MetaDataDAO.upsert(openconnection, Globals.RANGE_PARTITIONS_KEY, numberofpartitions)
+    counts = fillpartitions(openconnection, tablename, columnname, partitions,
+                            RatingsDAO.get_column_names(openconnection, tablename), workers)
+    if Globals.DEBUG: Globals.printinfo('Saved rows of "{0}" into range partitions => {1}'.format(tablename, counts))
+
+    # save the partitions in the catalog, and their number in the meta data table if they are the ratings ones
+    PartitionCatalogDAO.save(openconnection, tableprefix, PARTITION_SCHEME_RANGE, tablename, columnname,
+                             rangecatalog(tableprefix, partitions, counts))
+    if tableprefix == RANGE_PARTITION_TABLE_PREFIX:
+        MetaDataDAO.create(openconnection)  # Create if the table doesnt exist
+        MetaDataDAO.upsert(openconnection, Globals.RANGE_PARTITIONS_KEY, numberofpartitions)
 
     return [min_value, max_value]
 
 
-def parallel_sort(table, sorting_column_name, output_table, openconnection):
-    number_of_partitions = 5  # also dictates the number of threads
+def samplesortpartition(tablename, columnname, numberofpartitions, openconnection,
+                        tableprefix=SORT_PARTITION_TABLE_PREFIX, samplesize=None):
+    """
+    Splits a table into partitions of about the same number of rows, ordered on a column, as the planner of a sample
+    sort. A TABLESAMPLE of the table is sorted on (column, ctid) and numberofpartitions - 1 evenly spaced rows of it
+    are the splitters. Ties on the column are broken by ctid, so even a single heavily repeated value is spread over
+    several partitions. Partition i holds the rows of (splitter i - 1, splitter i], NULLs being in the last one, so
+    that concatenating the sorted partitions sorts the table in ascending order, NULLs last like every sort engine
+    puts them, see RatingsDAO.sortkey. The table is scanned once, see spoolandcopy, and the
+    partitions are saved in the catalog with their exact row counts and no bounds.
+    Partitioned table names start from 1
+    :param numberofpartitions: Number of partitions
+    :param openconnection: open connection to DB
+    :param samplesize: number of rows to sample, defaults to SORT_SAMPLE_PER_PARTITION per partition
+    :return:dict of partition table name to number of rows saved into it
+    """
+    if numberofpartitions <= 0 or not isinstance(numberofpartitions, int): raise AttributeError(
+        "Number of partitions should be a positive integer")
+    if samplesize is None: samplesize = SORT_SAMPLE_PER_PARTITION * numberofpartitions
+
+    rows = RatingsDAO.numberofratings(openconnection, tablename)
+    samplepercent = min(100.0, 100.0 * samplesize / max(rows, 1))
+    sample = RatingsDAO.get_sample(openconnection, columnname, tablename, samplepercent)
+    splitters = [sample[len(sample) * i // numberofpartitions] for i in range(1, numberofpartitions)] if sample else []
+    if Globals.DEBUG: Globals.printinfo('Sampled {0} rows of "{1}", splitters => {2}'.format(
+        len(sample), tablename, splitters))
+
+    tables = ['{0}{1}'.format(tableprefix, i) for i in range(1, numberofpartitions + 1)]
+    for table in tables:
+        RatingsDAO.createfromschema(openconnection, tablename, table)
+    cols = RatingsDAO.get_column_names(openconnection, tablename)
+    with openconnection.cursor() as cur:
+        cases = ' '.join(cur.mogrify('WHEN ({0}, ctid) <= (%s, %s::tid) THEN {1}'.format(columnname, i), splitter)
+                         for i, splitter in enumerate(splitters))
+    bucket = 'CASE {0} ELSE {1} END'.format(cases, len(splitters)) if splitters else '0'
+    query = 'SELECT {0} AS bucket, {1} FROM {2}'.format(bucket, ','.join(cols), tablename)
+    counts = spoolandcopy(openconnection, query, tables, cols)
+    if Globals.DEBUG: Globals.printinfo('Saved rows of "{0}" into sample sort partitions => {1}'.format(
+        tablename, counts))
+
+    PartitionCatalogDAO.save(openconnection, tableprefix, PARTITION_SCHEME_SAMPLE, tablename, columnname,
+                             [(i + 1, table, None, None, counts[table]) for i, table in enumerate(tables)])
+    return counts
+
+
+_sortconnection = None  # connection of a parallel_sort worker process
+
+
+def initsortworker(connectionparams):
+    """
+    Initializer of the parallel_sort worker processes, opens the connection the process keeps for all its tasks
+    :param connectionparams: dict returned by ConnectionUtils.getconnectionparams
+    :return:None
+    """
+    global _sortconnection
+    _sortconnection = ConnectionUtils.getconnection(connectionparams)
+
+
+def sortpartition(args):
+    """
+    Worker process body of parallel_sort with SORT_EXECUTOR_PROCESSES, sorts one partition into the output table
+    on the connection of the process
+    :param args: tuple of (engine, runsize, sorting column, tuple order start, partition table name, output table)
+    :return:(number of rows saved, start time, wall time, CPU time), see Job.timed
+    """
+    engine, runsize, sorting_column_name, tuple_order_index, partition_tablename, output_table = args
+    if engine == SORT_ENGINE_EXTERNAL:
+        result = timed(RatingsDAO.sort_rows_and_save_external, _sortconnection, sorting_column_name, 'ASC',
+                       tuple_order_index, partition_tablename, output_table, runsize)
+    elif engine == SORT_ENGINE_SERVER:
+        result = timed(RatingsDAO.insert_sorted, _sortconnection, sorting_column_name, 'ASC', tuple_order_index,
+                       partition_tablename, output_table)
+    else:
+        result = timed(RatingsDAO.sort_rows_and_save, _sortconnection, sorting_column_name, 'ASC', tuple_order_index,
+                       partition_tablename, output_table)
+    if Globals.DEBUG: Globals.printinfo('Sorted partition {0}'.format(partition_tablename))
+    return result
+
+
+def sortinprocesses(job, tasks, workers, connectionparams):
+    """
+    Drives the worker processes of parallel_sort, reporting every partition to the job as it ends
+    :param job: Job with a task per partition table name
+    :param tasks: list of arguments of sortpartition
+    :param workers: number of worker processes
+    :param connectionparams: dict returned by ConnectionUtils.getconnectionparams
+    :return:None
+    """
+    pool = multiprocessing.Pool(processes=workers, initializer=initsortworker, initargs=(connectionparams,))
+    try:
+        results = []
+        for task in tasks:
+            partition_tablename = task[4]
+            job.submitted(partition_tablename)
+            results.append((partition_tablename, pool.apply_async(
+                sortpartition, (task,), callback=lambda result, name=partition_tablename: job.finish(name, *result))))
+        for partition_tablename, result in results:
+            try:
+                result.get()
+            except Exception:
+                job.finish(partition_tablename, error=sys.exc_info())
+    finally:
+        pool.close()
+        pool.join()
+    Globals.printinfo('Sorted {0} partitions in {1} processes'.format(len(tasks), workers))
+
+
+def parallel_sort(table, sorting_column_name, output_table, openconnection, split=RANGE_SPLIT_EQUIWIDTH,
+                  engine=SORT_ENGINE_MEMORY, runsize=ExternalSort.SORT_RUN_SIZE, executor=SORT_EXECUTOR_THREADS,
+                  workers=None):
+    """
+    Sorts the table on a column into the output table, numbering the rows in a 'tupleorder' column. The table is
+    range partitioned and every partition is sorted by its own thread or process. The partitions have their own
+    SORT_PARTITION_TABLE_PREFIX, so that they never replace the range partitions of the ratings
+    :param split: RANGE_SPLIT_EQUIWIDTH or RANGE_SPLIT_QUANTILE, see rangepartitiongeneric, or RANGE_SPLIT_SAMPLE
+    which balances the partitions even on heavily repeated values, see samplesortpartition
+    :param engine: SORT_ENGINE_MEMORY sorts every partition in memory, SORT_ENGINE_EXTERNAL streams it through an
+    external merge sort and COPYs the result, so that memory is bounded by runsize whatever the partition size.
+    SORT_ENGINE_SERVER numbers the rows of every partition with row_number() in a single INSERT ... SELECT, so rows
+    never leave the database. SORT_ENGINE_SINGLE_STATEMENT does not partition the table and creates the output table
+    with one CREATE TABLE AS, which PostgreSQL can run with parallel query workers
+    :param runsize: rows sorted in memory at once by SORT_ENGINE_EXTERNAL
+    :param executor: SORT_EXECUTOR_THREADS sorts 5 partitions on threads, each with a connection of its own, see
+    ConnectionUtils.runparallel. SORT_EXECUTOR_PROCESSES sorts one partition per worker process, each with a
+    connection of its own, so that sorting scales with the cores
+    :param workers: number of worker processes and partitions for SORT_EXECUTOR_PROCESSES. Defaults to the number
+    of cores
+    :return:Job with a task per partition, returned once partitioning is done and the sorting has started. Its wait
+    returns when the output table is complete, see Job
+    """
+    engines = [SORT_ENGINE_MEMORY, SORT_ENGINE_EXTERNAL, SORT_ENGINE_SERVER, SORT_ENGINE_SINGLE_STATEMENT]
+    if engine not in engines: raise AttributeError("Sort engine should be one of {0}".format(engines))
+    executors = [SORT_EXECUTOR_THREADS, SORT_EXECUTOR_PROCESSES]
+    if executor not in executors: raise AttributeError("Sort executor should be one of {0}".format(executors))
+    if workers is None: workers = multiprocessing.cpu_count()
+    if workers <= 0 or not isinstance(workers, int): raise AttributeError(
+        "Number of workers should be a positive integer")
+
+    if engine == SORT_ENGINE_SINGLE_STATEMENT:
+        job = Job(output_table, [table])
+        Globals.printinfo('Sorting table, {0} in a single statement'.format(table))
+        # on an auto commit connection of its own, openconnection stays free for the caller
+        tasks = [(job.wrap(table, RatingsDAO.create_sorted), (sorting_column_name, 'ASC', table, output_table))]
+        return job.start(ConnectionUtils.runparallel, openconnection, tasks, 1)
+
+    # also dictates the number of threads or processes
+    number_of_partitions = workers if executor == SORT_EXECUTOR_PROCESSES else 5
     Globals.printinfo(
         'Creating Range partitions on table, {0} into {1} partitions'.format(table, number_of_partitions))
-    rangepartitiongeneric(table, sorting_column_name, number_of_partitions, openconnection)
+    tableprefix = SORT_PARTITION_TABLE_PREFIX
+    if split == RANGE_SPLIT_SAMPLE:
+        samplesortpartition(table, sorting_column_name, number_of_partitions, openconnection, tableprefix)
+    else:
+        # RANGE_SPLIT_QUANTILE gives every thread about the same number of rows on skewed columns
+        rangepartitiongeneric(table, sorting_column_name, number_of_partitions, openconnection, tableprefix,
+                              split=split)
 
     # output table to save the sorted tuples
     RatingsDAO.createfromschema(openconnection, table, output_table)
     RatingsDAO.addcolumn(openconnection, output_table, 'tupleorder', 'NUMERIC')
 
-    tuple_order_indices = [1]  # starting tuple order index for each partition
-    for i in range(1, number_of_partitions):
-        tuple_order_indices.append(
-            tuple_order_indices[i - 1] + RatingsDAO.numberofratings(openconnection,
-                                                                    RANGE_PARTITION_TABLE_PREFIX + str(
-                                                                        i)))
+    # starting tuple order index for each partition, from the row counts of the catalog
+    partitions = PartitionCatalogDAO.select(openconnection, tableprefix)
+    tuple_order_indices = [1]
+    for partition in partitions[:-1]:
+        tuple_order_indices.append(tuple_order_indices[-1] + partition.rowcount)
+    job = Job(output_table, [partition.tablename for partition in partitions])
+
+    if executor == SORT_EXECUTOR_PROCESSES:
+        openconnection.commit()  # workers have to see the tables, if the connection is not in auto commit mode
+        tasks = [(engine, runsize, sorting_column_name, tuple_order_index, partition.tablename, output_table)
+                 for partition, tuple_order_index in zip(partitions, tuple_order_indices)]
+        Globals.printinfo('Sorting {0} partitions in {1} processes'.format(len(tasks), number_of_partitions))
+        return job.start(sortinprocesses, job, tasks, number_of_partitions,
+                         ConnectionUtils.getconnectionparams(openconnection))
+
+    # Create 'number_of_partitions' threads and sort in parallel. Every thread has a connection of its own, as the
+    # server side cursors of the sort hold their connection until all the rows are read
+    openconnection.commit()  # workers have to see the tables, if the connection is not in auto commit mode
+    tasks = []
+    for partition, tuple_order_index in zip(partitions, tuple_order_indices):
+        args = (sorting_column_name, 'ASC', tuple_order_index, partition.tablename, output_table)
+        if engine == SORT_ENGINE_EXTERNAL:
+            tasks.append((job.wrap(partition.tablename, RatingsDAO.sort_rows_and_save_external), args + (runsize,)))
+        elif engine == SORT_ENGINE_SERVER:
+            tasks.append((job.wrap(partition.tablename, RatingsDAO.insert_sorted), args))
+        else:
+            tasks.append((job.wrap(partition.tablename, RatingsDAO.sort_rows_and_save), args))
 
-    # Create 'number_of_partitions' threads and sort in parallel
-    pool = ThreadPool(processes=number_of_partitions)
-    for i in range(1, number_of_partitions + 1):
-        pool.apply_async(RatingsDAO.sort_rows_and_save,
-                         (openconnection, sorting_column_name, 'ASC', tuple_order_indices[i - 1],
-                          RANGE_PARTITION_TABLE_PREFIX + str(i), output_table))
+    Globals.printinfo('Launched asynchronous threads for sorting, wait on the returned job for the output table')
+    return job.start(ConnectionUtils.runparallel, openconnection, tasks, number_of_partitions)
 
-    Globals.printinfo('Launched asynchronous threads for sorting. I am done!')
 
+def hashpartitionforjoin(tablename, columnname, numberofpartitions, openconnection, tableprefix):
+    """
+    Hash partitions one side of a join, unless hashpartition already partitioned the table on the join column.
+    Those partitions are reused only if they still hold as many rows as the table, as rows written to the table
+    since, Eg: by roundrobininsert or by a new load, are not in them
+    :return:(prefix of the partition tables, number of partitions)
+    """
+    partitioning = gethashpartitioning(openconnection)
+    if partitioning is not None and partitioning[:2] == (tablename, columnname):
+        tables = [partition.tablename for partition in
+                  PartitionCatalogDAO.select(openconnection, HASH_PARTITION_TABLE_PREFIX)]
+        if RatingsDAO.numberofrows(openconnection, tables) == RatingsDAO.numberofratings(openconnection, tablename):
+            Globals.printinfo('Reusing the hash partitions of table, {0} on {1}'.format(tablename, columnname))
+            return HASH_PARTITION_TABLE_PREFIX, partitioning[2]
+        Globals.printinfo('The hash partitions of table, {0} on {1} are out of date'.format(tablename, columnname))
+    Globals.printinfo(
+        'Creating Hash partitions on table, {0} into {1} partitions'.format(tablename, numberofpartitions))
+    hashpartitiongeneric(tablename, columnname, numberofpartitions, openconnection, tableprefix)
+    return tableprefix, numberofpartitions
 
-def parallel_join(table1, table2, joincol1, joincol2, output_table, openconnection):
-    number_of_partitions = 5  # also dictates the number of threads
-    min_max_table1 = RatingsDAO.get_min_max(openconnection, joincol1, table1)
-    min_max_table2 = RatingsDAO.get_min_max(openconnection, joincol2, table2)
-    min_value = min(min_max_table1[0], min_max_table2[0])  # Pick the min of the minimums
-    max_value = max(min_max_table1[1], min_max_table2[1])  # Pick the max of the maximums
 
-    Globals.printinfo(
-        'Creating Range partitions on table, {0} into {1} partitions'.format(table1, number_of_partitions))
-    rangepartitiongeneric(table1, joincol1, number_of_partitions, openconnection, 'range_tbl1_part', min_value,
-                          max_value)
+def parallel_join(table1, table2, joincol1, joincol2, output_table, openconnection, split=RANGE_SPLIT_EQUIWIDTH,
+                  scheme=PARTITION_SCHEME_RANGE):
+    """
+    Joins two tables on equal join columns. Both tables are partitioned the same way on their join column, so that
+    matching rows land in partitions of the same number, and the pairs of partitions are joined in parallel
+    :param split: with PARTITION_SCHEME_RANGE, RANGE_SPLIT_EQUIWIDTH or RANGE_SPLIT_QUANTILE
+    :param scheme: PARTITION_SCHEME_RANGE or PARTITION_SCHEME_HASH. Hash partitioning needs integer join columns and
+    reuses the partitions of hashpartition when they are on a join column
+    :return:Job with a task per partition of table1, returned once partitioning is done and the joins have
+    started. Its wait returns when the output table is complete, see Job
+    """
+    if scheme not in (PARTITION_SCHEME_RANGE, PARTITION_SCHEME_HASH): raise AttributeError(
+        "Scheme should be one of {0}".format([PARTITION_SCHEME_RANGE, PARTITION_SCHEME_HASH]))
+    number_of_partitions = 5  # also dictates the number of threads
 
-    Globals.printinfo(
-        'Creating Range partitions on table, {0} into {1} partitions'.format(table2, number_of_partitions))
-    rangepartitiongeneric(table2, joincol2, number_of_partitions, openconnection, 'range_tbl2_part', min_value,
-                          max_value)
+    if scheme == PARTITION_SCHEME_HASH:
+        prefix1, number_of_partitions = hashpartitionforjoin(table1, joincol1, number_of_partitions, openconnection,
+                                                             'hash_tbl1_part')
+        if (table2, joincol2) == (table1, joincol1):
+            prefix2 = prefix1
+        else:
+            prefix2, partitions2 = hashpartitionforjoin(table2, joincol2, number_of_partitions, openconnection,
+                                                        'hash_tbl2_part')
+            if partitions2 != number_of_partitions:
+                # the partitions of hashpartition do not line up with the ones of table1
+                hashpartitiongeneric(table2, joincol2, number_of_partitions, openconnection, 'hash_tbl2_part')
+                prefix2 = 'hash_tbl2_part'
+    else:
+        min_max_table1 = RatingsDAO.get_min_max(openconnection, joincol1, table1)
+        min_max_table2 = RatingsDAO.get_min_max(openconnection, joincol2, table2)
+        min_value = min(min_max_table1[0], min_max_table2[0])  # Pick the min of the minimums
+        max_value = max(min_max_table1[1], min_max_table2[1])  # Pick the max of the maximums
+
+        # both tables have to be split at the same points, quantiles are taken from the first table
+        splitpoints = None
+        if split == RANGE_SPLIT_QUANTILE:
+            splitpoints = quantilesplitpoints(table1, joincol1, number_of_partitions, openconnection, min_value,
+                                              max_value)
+
+        prefix1, prefix2 = 'range_tbl1_part', 'range_tbl2_part'
+        Globals.printinfo(
+            'Creating Range partitions on table, {0} into {1} partitions'.format(table1, number_of_partitions))
+        rangepartitiongeneric(table1, joincol1, number_of_partitions, openconnection, prefix1, min_value,
+                              max_value, splitpoints=splitpoints)
+
+        Globals.printinfo(
+            'Creating Range partitions on table, {0} into {1} partitions'.format(table2, number_of_partitions))
+        rangepartitiongeneric(table2, joincol2, number_of_partitions, openconnection, prefix2, min_value,
+                              max_value, splitpoints=splitpoints)
 
     # Drop output table if exists
     # RatingsDAO.drop_table(openconnection, output_table)
     RatingsDAO.create_join_table(openconnection, table1, joincol1, table2, joincol2, output_table)
 
-    # Create 'number_of_partitions' threads and sort in parallel
-    for i in range(1, number_of_partitions + 1):
-        thread.start_new_thread(RatingsDAO.join_tables,
-                                (openconnection, table1, joincol1, table2, joincol2, output_table))
+    # join the pairs of partitions of the same number in parallel, each on a connection of its own
+    partitions2 = dict((partition.partitionindex, partition.tablename)
+                       for partition in PartitionCatalogDAO.select(openconnection, prefix2))
+    partitions1 = PartitionCatalogDAO.select(openconnection, prefix1)
+    job = Job(output_table, [partition.tablename for partition in partitions1])
+    tasks = [(job.wrap(partition.tablename, RatingsDAO.join_tables),
+              (partition.tablename, joincol1, partitions2[partition.partitionindex], joincol2, output_table))
+             for partition in partitions1]
 
-    Globals.printinfo('Launched asynchronous threads for join. I am done!')
+    Globals.printinfo('Joining {0} pairs of partitions into {1}'.format(len(tasks), output_table))
+    return job.start(ConnectionUtils.runparallel, openconnection, tasks, number_of_partitions)
 
 
 # Assignment 3 ends
@@ -391,31 +1686,14 @@ def createrangepartitionandinsert(conn, lower_bound, partition_index, upper_boun
         'Partition {2}: saved values => ({0}, {1}]'.format(lower_bound, upper_bound, partition_index))
 
 
-def createrobinpartitionandinsert(conn, sno, ids, ratingstablename, dropifexists=True):
-    """
-    Creates a new partition table and calls INSERT method of DAO to insert the data
-    :param conn: open connection to DB
-    :param sno: table number. As single single table is split into parts
-    :param ids: IDs of the ratings to insert
-    :param dropifexists: drops the table if exists
-    :return:None
-    """
-    partition_tablename = '{0}{1}'.format(RROBIN_PARTITION_TABLE_PREFIX, sno)
-    RatingsDAO.create(conn, partition_tablename, dropifexists)
-    RatingsDAO.insertids(conn, ids, partition_tablename, ratingstablename)
-    if Globals.DEBUG: Globals.printinfo(
-        'Partition {0}: saved {1} ratings => {2}...'.format(sno, len(ids), ids[0:6]))
-
-
 def validaterating(rating):
     # validate rating
     # 1) Should be a positive value and less than or equal to 5.
     # 2) Should have increments of 0.5
-    validratings = list(Globals.drange(0, 5.1, 0.5))
-    if rating not in validratings:
+    if rating not in VALID_RATINGS:
         print(
             'Rating should be a positive value, less than or equal to 5. It should be one of {0}\n'.format(
-                validratings))
+                VALID_RATINGS))
         return False
     return True
 
@@ -481,11 +1759,11 @@ def deletepartitionshelper(conn):
 
 # Assignment 3 helpers
 def parallel_sort_helper(conn):
-    parallel_sort('ratings', 'rating', 'ABC', conn)
+    parallel_sort('ratings', 'rating', 'ABC', conn).wait()
 
 
 def parallel_join_helper(conn):
-    parallel_join('ratings', 'ratings', 'movieid', 'movieid', 'joined_ratings', conn)
+    parallel_join('ratings', 'ratings', 'movieid', 'movieid', 'joined_ratings', conn).wait()
 
 
 # Middleware
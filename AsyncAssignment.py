@@ -0,0 +1,237 @@
+"""
+Non blocking front end of the load, partition, insert and query operations of Assignment
+
+Python 2 has no asyncio, so the front end is built on the asynchronous connections of psycopg2 instead, see
+ConnectionUtils.AsyncPool. Every function queues its statements on the pool and returns an AsyncStatement right
+away, so that a single thread can keep many operations in flight, Eg: a service fanning out partition lookups for
+its requests. AsyncPool.run drives them all, then AsyncStatement.result gives the value of each operation.
+Meta data, catalog and zone maps are still read and written on the blocking connection, mostly from its cache.
+Only the manual partition backend is supported for partitioning
+"""
+
+import os
+
+import Assignment
+import Globals
+import MetaDataDAO
+import PartitionCatalogDAO
+import RatingsDAO
+import ZoneMapDAO
+from ConnectionUtils import AsyncStatement
+
+
+def completed(value=None):
+    """
+    :return:AsyncStatement already complete with the value, for operations which have nothing to send
+    """
+    statement = AsyncStatement()
+    statement.complete(value)
+    return statement
+
+
+def loadratings(ratingstablename, ratingsfilepath, openconnection, pool):
+    """
+    Loads the file into DB with multi row INSERTs of MAX_LINES_COUNT_READ lines, sent concurrently on the
+    connections of the pool. The file is read as the statements are sent, so memory does not grow with its size.
+    IDs of the ratings do not follow the order of the file.
+    Asynchronous connections cannot COPY, so unlike Assignment.loadratings the lines are split in Python and sent as
+    text, without the NumPy parser and its checks, and no load watermark is saved: a failed load cannot be resumed
+    :param ratingsfilepath: relative or abs path of the file to load
+    :param openconnection: open connection to DB
+    :param pool: ConnectionUtils.AsyncPool
+    :return:AsyncStatement with the number of ratings loaded as value
+    """
+    ratingsfilepath = os.path.abspath(ratingsfilepath)
+    MetaDataDAO.create(openconnection)  # Create if the table doesnt exist
+    RatingsDAO.create(openconnection, ratingstablename)
+    openconnection.commit()  # the pool has to see the table, if the connection is not in auto commit mode
+
+    def statements():
+        for lines in Assignment.getnextchunk(ratingsfilepath):
+            ratings = [line.split('::')[0:3] for line in lines if line.strip()]
+            if ratings: yield RatingsDAO.insertquery(ratings, [ratingstablename])
+
+    def loaded(statement):
+        Assignment.QUERY_CACHE.invalidatetable(ratingstablename)
+        if Globals.DEBUG: Globals.printinfo('Loaded {0} ratings into DB'.format(statement.value))
+        return statement.value
+
+    return pool.executeall(statements()).then(loaded)
+
+
+def rangepartition(ratingstablename, numberofpartitions, openconnection, pool):
+    """
+    Range partitions the ratings table like Assignment.rangepartition, every partition being filled by its own
+    INSERT ... SELECT on the pool
+    :param numberofpartitions: Number of partitions
+    :param openconnection: open connection to DB
+    :param pool: ConnectionUtils.AsyncPool
+    :return:AsyncStatement with a dict of partition table name to number of rows saved as value
+    """
+    if numberofpartitions <= 0 or not isinstance(numberofpartitions, int): raise AttributeError(
+        "Number of partitions should be a positive integer")
+    Assignment.validatebackend(Assignment.PARTITION_BACKEND_MANUAL, ratingstablename, openconnection)
+
+    partitions = Assignment.createrangepartitions(numberofpartitions, openconnection)
+    openconnection.commit()  # the pool has to see the partition tables
+    statements = [pool.execute(RatingsDAO.insertwithselectquery(
+        'rating', RatingsDAO.COLUMNS, Assignment.formatboundary(lower_bound), Assignment.formatboundary(upper_bound),
+        table, ratingstablename)) for lower_bound, upper_bound, table in partitions]
+
+    def save(group):
+        counts = {}
+        for (_, _, table), count in zip(partitions, group.value):
+            counts[table] = counts.get(table, 0) + count
+        Assignment.saverangepartitioning(ratingstablename, numberofpartitions, openconnection, partitions, counts)
+        if Globals.DEBUG: Globals.printinfo('Saved ratings into range partitions => {0}'.format(counts))
+        return counts
+
+    return AsyncStatement.gather(statements).then(save)
+
+
+def roundrobinpartition(ratingstablename, numberofpartitions, openconnection, pool):
+    """
+    Round robin partitions the ratings table like Assignment.roundrobinpartition, every partition being filled by
+    its own INSERT ... SELECT on the pool
+    :param numberofpartitions: Number of partitions
+    :param openconnection: open connection to DB
+    :param pool: ConnectionUtils.AsyncPool
+    :return:AsyncStatement with a dict of partition table name to number of rows saved as value
+    """
+    if numberofpartitions <= 0 or not isinstance(numberofpartitions, int): raise AttributeError(
+        "Number of partitions should be a positive integer")
+    Assignment.validatebackend(Assignment.PARTITION_BACKEND_MANUAL, ratingstablename, openconnection)
+
+    tables = [Assignment.RROBIN_PARTITION_TABLE_PREFIX + str(i) for i in range(0, numberofpartitions)]
+    for table in tables:
+        RatingsDAO.create(openconnection, table)
+    openconnection.commit()  # the pool has to see the partition tables
+    statements = [pool.execute(RatingsDAO.insertroundrobinquery(table, numberofpartitions, i, ratingstablename))
+                  for i, table in enumerate(tables)]
+
+    def save(group):
+        counts = dict(zip(tables, group.value))
+        ZoneMapDAO.compute(openconnection, tables)
+        # the position of the next inserted rating decides its partition, see roundrobininsert
+        MetaDataDAO.createsequence(openconnection, ratingstablename + Assignment.RROBIN_SEQUENCE_SUFFIX,
+                                   sum(counts.values()) + 1)
+        Assignment.saverobinpartitioning(ratingstablename, openconnection, tables, counts)
+        if Globals.DEBUG: Globals.printinfo('Saved ratings into round robin partitions => {0}'.format(counts))
+        return counts
+
+    return AsyncStatement.gather(statements).then(save)
+
+
+def rangeinsert(ratingstablename, userid, itemid, rating, openconnection, pool):
+    """
+    Inserts a new rating into its range partition, see Assignment.rangeinsert
+    :param openconnection: open connection to DB
+    :param pool: ConnectionUtils.AsyncPool
+    :return:AsyncStatement with the name of the table the rating was inserted into as value, None if it was not
+    """
+    if not Assignment.validaterating(rating): return completed()
+    partitions = PartitionCatalogDAO.select(openconnection, Assignment.RANGE_PARTITION_TABLE_PREFIX, ratingstablename,
+                                            'rating')
+    if not partitions:
+        Globals.printwarning("First create the partitions and then try to insert")
+        return completed()
+
+    if Assignment.isnativelypartitioned(openconnection, ratingstablename, Assignment.PARTITION_SCHEME_RANGE):
+        # PostgreSQL routes the rating into its partition
+        destinationtable, touched = ratingstablename, [partition.tablename for partition in partitions]
+    else:
+        partition = Assignment.findrangepartition(partitions, rating)
+        if partition is None:
+            Globals.printwarning("No range partition holds a rating of {0}".format(rating))
+            return completed()
+        destinationtable = partition.tablename
+        touched = [destinationtable]
+
+    def inserted(_):
+        Assignment.QUERY_CACHE.invalidate(touched)
+        return destinationtable
+
+    query, params = RatingsDAO.insertquery([(userid, itemid, rating)], [destinationtable])
+    return pool.execute(query, params).then(inserted)
+
+
+def roundrobininsert(ratingstablename, userid, itemid, rating, openconnection, pool):
+    """
+    Inserts a new rating into its round robin partition, see Assignment.roundrobininsert. The position of the rating
+    and the insert are sent one after the other, without blocking
+    :param openconnection: open connection to DB
+    :param pool: ConnectionUtils.AsyncPool
+    :return:AsyncStatement with the name of the partition the rating was inserted into as value, None if it was not
+    """
+    if not Assignment.validaterating(rating): return completed()
+    n = MetaDataDAO.select(openconnection, Globals.RROBIN_PARTITIONS_KEY)
+    if n is None:
+        Globals.printwarning("First create the partitions and then try to insert")
+        return completed()
+    n = int(n)
+
+    if Assignment.isnativelypartitioned(openconnection, ratingstablename, Assignment.PARTITION_SCHEME_RROBIN):
+        # PostgreSQL routes the rating into its partition
+        query, params = RatingsDAO.insertquery([(userid, itemid, rating)], [ratingstablename])
+        tables = [Assignment.RROBIN_PARTITION_TABLE_PREFIX + str(i) for i in range(0, n)]
+        return pool.execute(query, params).then(lambda _: Assignment.QUERY_CACHE.invalidate(tables))
+
+    def insert(statement):
+        destinationtable = Assignment.RROBIN_PARTITION_TABLE_PREFIX + str(statement.value[0][0] % n)
+        # zone map and partition are updated by the same implicit transaction, see Assignment.roundrobininsert
+        zonequery, zoneparams = ZoneMapDAO.widenquery([ZoneMapDAO.Zone(
+            destinationtable, 1, userid, userid, itemid, itemid, rating, rating, ZoneMapDAO.ratingbit(rating))])
+        query, params = RatingsDAO.insertquery([(userid, itemid, rating)], [destinationtable, ratingstablename])
+
+        def inserted(_):
+            Assignment.QUERY_CACHE.invalidate([destinationtable])
+            return destinationtable
+
+        return pool.execute(zonequery + '; ' + query, zoneparams + params).then(inserted)
+
+    return pool.execute('SELECT nextval(%s)', (ratingstablename + Assignment.RROBIN_SEQUENCE_SUFFIX,)).then(insert)
+
+
+def rangequery(ratingstablename, ratingminvalue, ratingmaxvalue, openconnection, pool):
+    """
+    Fetches the ratings of [ratingminvalue, ratingmaxvalue] from the range and the round robin partitions, see
+    Assignment.rangequery. Every partition which is not skipped is queried by its own statement on the pool, and
+    results are cached in Assignment.QUERY_CACHE
+    :param ratingminvalue: inclusive lower bound on the rating
+    :param ratingmaxvalue: inclusive upper bound on the rating
+    :param openconnection: open connection to DB
+    :param pool: ConnectionUtils.AsyncPool
+    :return:AsyncStatement with a list of (partition table name, userid, movieid, rating) tuples as value
+    """
+    partitions = Assignment.rangequerypartitions(ratingstablename, ratingminvalue, ratingmaxvalue, openconnection)
+    bounds = {'rating': (ratingminvalue, ratingmaxvalue)}
+    key = Assignment.querykey(openconnection, ratingstablename, bounds)
+    generation = Assignment.QUERY_CACHE.generation
+    if key is not None:
+        rows = Assignment.QUERY_CACHE.get(key)
+        if rows is not None: return completed(rows)
+
+    statements = []
+    for table in Assignment.prunepartitions(openconnection, partitions, bounds):
+        query, params = RatingsDAO.selectrangequery(table, bounds)
+        statements.append(pool.execute(query, params).then(
+            lambda statement, table=table: [(table,) + tuple(row) for row in statement.value]))
+
+    def merge(group):
+        rows = [row for rows in group.value for row in rows]
+        if key is not None: Assignment.QUERY_CACHE.put(key, rows, ratingstablename,
+                                                       [partition.tablename for partition in partitions], generation)
+        return rows
+
+    return AsyncStatement.gather(statements).then(merge)
+
+
+def pointquery(ratingstablename, ratingvalue, openconnection, pool):
+    """
+    Fetches the ratings equal to ratingvalue from the range and the round robin partitions, see rangequery
+    :param ratingvalue: rating to look for
+    :param openconnection: open connection to DB
+    :param pool: ConnectionUtils.AsyncPool
+    :return:AsyncStatement with a list of (partition table name, userid, movieid, rating) tuples as value
+    """
+    return rangequery(ratingstablename, ratingvalue, ratingvalue, openconnection, pool)
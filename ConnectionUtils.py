@@ -0,0 +1,439 @@
+"""
+Helpers to open more connections to the database an existing connection points to, so that work can be spread
+over several threads or processes, each with a connection of its own
+"""
+
+from collections import deque
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+import Queue
+import select
+import sys
+import threading
+
+import psycopg2
+from psycopg2.pool import ThreadedConnectionPool
+
+DEFAULT_USER = 'postgres'
+DEFAULT_PASSWORD = '1234'
+DEFAULT_HOST = 'localhost'
+STREAM_BATCH_SIZE = 1000  # rows handed over at once by the tasks of streamparallel
+STREAM_QUEUE_SIZE = 64  # batches waiting to be consumed, before the tasks of streamparallel block
+ASYNC_POOL_SIZE = 32  # connections of an AsyncPool, the number of statements it keeps in flight
+
+
+def getdsn(user=DEFAULT_USER, password=DEFAULT_PASSWORD, dbname='postgres'):
+    """
+    Builds the connection string used by every connection of the project
+    :return: DSN string
+    """
+    return "dbname='" + dbname + "' user='" + user + "' host='" + DEFAULT_HOST + "' password='" + password + "'"
+
+
+def getconnectionparams(openconnection):
+    """
+    Fetches the parameters needed to open another connection to the same database as the same user, on the same
+    server. libpq leaves the password out of the DSN parameters, so it is read from the connection info, which
+    needs psycopg2 2.8. Older versions fall back to DEFAULT_PASSWORD.
+    The returned dict is picklable, so it can be handed over to worker processes
+    :param openconnection: open connection to DB
+    :return: dict of libpq connection parameters, Eg: dbname, user, host, port and password
+    """
+    params = dict((key, value) for key, value in openconnection.get_dsn_parameters().items() if value)
+    password = openconnection.info.password if hasattr(openconnection, 'info') else DEFAULT_PASSWORD
+    if password: params['password'] = password
+    return params
+
+
+def getparamsdsn(connectionparams):
+    """
+    Builds the connection string of the parameters of a connection
+    :param connectionparams: dict returned by getconnectionparams
+    :return: DSN string
+    """
+    return psycopg2.extensions.make_dsn(**connectionparams)
+
+
+def getconnection(connectionparams):
+    """
+    Opens a new auto commit connection, the same way the main connection of the project is set up
+    :param connectionparams: dict returned by getconnectionparams
+    :return: Open DB connection
+    """
+    conn = psycopg2.connect(getparamsdsn(connectionparams))
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    return conn
+
+
+@contextmanager
+def transaction(conn):
+    """
+    Runs the statements of the with block in a single transaction, even if the connection is in auto commit mode.
+    On an auto commit connection, commits at the end of the block and rolls back if an exception is raised. Otherwise
+    the block is part of the transaction of the caller, who commits or rolls it back
+    :param conn: open connection to DB
+    :return: the same connection
+    """
+    if not conn.autocommit:
+        # autocommit cannot be set while a transaction is open, even to the same value
+        yield conn
+        return
+    conn.autocommit = False
+    try:
+        yield conn
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = True
+
+
+def runparallel(openconnection, tasks, workers):
+    """
+    Runs the tasks concurrently on at most 'workers' threads. Each running task borrows a connection of its own from
+    a pool of auto commit connections to the database of openconnection
+    :param openconnection: open connection to DB
+    :param tasks: list of (function, args) tuples. Each function is called as function(conn, *args)
+    :param workers: maximum number of tasks running at once
+    :return: list of the values returned by the tasks, in the order of the tasks
+    :throws: the exception raised by the first failing task, once all the tasks are over
+    """
+    if not tasks: return []
+    workers = min(workers, len(tasks))
+    connections = ThreadedConnectionPool(1, workers, getparamsdsn(getconnectionparams(openconnection)))
+
+    def run(function, args):
+        conn = connections.getconn()
+        try:
+            conn.autocommit = True
+            return function(conn, *args)
+        finally:
+            connections.putconn(conn)
+
+    threads = ThreadPool(processes=workers)
+    try:
+        results = [threads.apply_async(run, task) for task in tasks]
+        threads.close()
+        threads.join()
+        return [result.get() for result in results]
+    finally:
+        threads.terminate()
+        connections.closeall()
+
+
+def streamparallel(openconnection, tasks, workers):
+    """
+    Runs the tasks concurrently on at most 'workers' threads, each with a connection of its own like runparallel, and
+    merges the rows they produce into a single stream, in the order they arrive. Tasks are slowed down when the
+    consumer falls behind, and stopped when the stream is closed before its end
+    :param openconnection: open connection to DB
+    :param tasks: list of (function, args) tuples. Each function is called as function(conn, *args) and returns an
+    iterable of rows
+    :param workers: maximum number of tasks running at once
+    :return: rows using yield
+    :throws: the exception raised by the first failing task
+    """
+    if not tasks: return
+    workers = min(workers, len(tasks))
+    connections = ThreadedConnectionPool(1, workers, getparamsdsn(getconnectionparams(openconnection)))
+    batches = Queue.Queue(STREAM_QUEUE_SIZE)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def run(function, args):
+        conn = connections.getconn()
+        try:
+            conn.autocommit = True
+            batch = []
+            for row in function(conn, *args):
+                batch.append(row)
+                if len(batch) == STREAM_BATCH_SIZE:
+                    if not put(batch): return
+                    batch = []
+            if batch: put(batch)
+        except Exception:
+            put(sys.exc_info())
+        finally:
+            connections.putconn(conn)
+            put(None)  # end of the task
+
+    threads = ThreadPool(processes=workers)
+    try:
+        for task in tasks:
+            threads.apply_async(run, task)
+        threads.close()
+        running = len(tasks)
+        while running:
+            batch = batches.get()
+            if batch is None:
+                running -= 1
+            elif isinstance(batch, tuple):
+                raise batch[0], batch[1], batch[2]
+            else:
+                for row in batch:
+                    yield row
+    finally:
+        stopped.set()
+        threads.join()
+        connections.closeall()
+
+
+class AsyncStatement(object):
+    """
+    Result of a statement sent through an AsyncPool, or of statements combined with then / gather. It is complete
+    once AsyncPool.run has driven the statements it depends on
+    """
+
+    def __init__(self, query=None, params=None):
+        self.query = query
+        self.params = params
+        self.done = False
+        self.value = None  # rows fetched by a statement returning rows, its row count otherwise
+        self.error = None  # exc_info of the failure
+        self.listeners = []
+
+    def complete(self, value=None, error=None):
+        self.done, self.value, self.error = True, value, error
+        listeners, self.listeners = self.listeners, []
+        for listener in listeners:
+            listener(self)
+
+    def listen(self, listener):
+        """
+        Calls listener(statement) once the statement is complete, right away if it already is
+        """
+        if self.done:
+            listener(self)
+        else:
+            self.listeners.append(listener)
+
+    def then(self, function):
+        """
+        Chains a step after the statement, Eg: to send the next statement or to save meta data
+        :param function: called as function(statement) once the statement succeeded. It can return an
+        AsyncStatement to wait for, whose value becomes the value of the chain, or any other value
+        :return: AsyncStatement of the chain, failing with the first failing step
+        """
+        chained = AsyncStatement()
+
+        def step(statement):
+            if statement.error is not None: return chained.complete(error=statement.error)
+            try:
+                value = function(statement)
+            except Exception:
+                return chained.complete(error=sys.exc_info())
+            if isinstance(value, AsyncStatement):
+                value.listen(lambda last: chained.complete(last.value, last.error))
+            else:
+                chained.complete(value)
+
+        self.listen(step)
+        return chained
+
+    @staticmethod
+    def gather(statements):
+        """
+        :param statements: list of AsyncStatements
+        :return: AsyncStatement complete once all the statements are, with the list of their values as value.
+        It fails with the error of the first failed statement
+        """
+        group = AsyncStatement()
+        remaining = [len(statements)]
+
+        def collect(_):
+            remaining[0] -= 1
+            if remaining[0]: return
+            errors = [statement.error for statement in statements if statement.error is not None]
+            if errors: return group.complete(error=errors[0])
+            group.complete([statement.value for statement in statements])
+
+        if not statements: group.complete([])
+        for statement in statements:
+            statement.listen(collect)
+        return group
+
+    def result(self):
+        """
+        :return: value of the statement
+        :throws: the exception the statement failed with
+        """
+        if not self.done: raise AttributeError("Statement is not complete, run the AsyncPool first")
+        if self.error is not None: raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+
+class AsyncPool(object):
+    """
+    Pool of asynchronous connections to the database of an open connection. Statements are queued with execute and
+    sent as soon as a connection is free, and a single select() loop in run drives all of them at once. Asynchronous
+    connections are always in auto commit mode and cannot COPY or use server side cursors. A connection lost by a
+    statement is opened again. If no connection is left, the queued statements fail with the last connection error
+    """
+
+    def __init__(self, openconnection, size=ASYNC_POOL_SIZE):
+        """
+        :param openconnection: open connection to DB
+        :param size: number of connections, the number of statements in flight at once
+        """
+        if size <= 0 or not isinstance(size, int): raise AttributeError("Pool size should be a positive integer")
+        self.dsn = getparamsdsn(getconnectionparams(openconnection))
+        self.idle = []
+        self.busy = {}  # connection to (cursor, AsyncStatement), both None while connecting
+        self.pending = deque()
+        self.error = None  # exc_info of the last connection failure
+        try:
+            for _ in range(size):
+                self.connect()
+            self.run()
+            if not self.idle: raise self.error[0], self.error[1], self.error[2]
+        except Exception:
+            self.close()
+            raise
+
+    def connect(self):
+        try:
+            self.busy[psycopg2.connect(self.dsn, async_=1)] = (None, None)
+        except Exception:
+            self.error = sys.exc_info()
+
+    def execute(self, query, params=None):
+        """
+        Queues a statement, sent by run
+        :param query: SQL statement, or several separated with semicolons
+        :param params: optional parameters of the query
+        :return: AsyncStatement
+        """
+        statement = AsyncStatement(query, params)
+        self.pending.append(statement)
+        return statement
+
+    def executeall(self, queries, inflight=None):
+        """
+        Sends a stream of statements, keeping at most 'inflight' of them queued or running. Queries are consumed
+        lazily, so they can come from a generator larger than memory
+        :param queries: iterable of (query, params) tuples
+        :param inflight: maximum number of statements queued at once, defaults to the number of connections
+        :return: AsyncStatement with the total row count of the statements as value, failing with the first error.
+        No statement is sent after an error
+        """
+        if inflight is None: inflight = max(len(self.idle) + len(self.busy), 1)
+        queries = iter(queries)
+        group = AsyncStatement()
+        state = {'running': 0, 'rowcount': 0, 'error': None, 'exhausted': False}
+
+        def send():
+            while not state['exhausted'] and state['error'] is None and state['running'] < inflight:
+                try:
+                    query, params = next(queries)
+                except StopIteration:
+                    state['exhausted'] = True
+                    break
+                except Exception:
+                    state['error'] = sys.exc_info()
+                    break
+                state['running'] += 1
+                self.execute(query, params).listen(sent)
+            if state['running'] == 0 and not group.done:
+                group.complete(state['rowcount'], state['error'])
+
+        def sent(statement):
+            state['running'] -= 1
+            if statement.error is not None:
+                if state['error'] is None: state['error'] = statement.error
+            elif statement.value is not None:
+                state['rowcount'] += statement.value if isinstance(statement.value, (int, long)) else len(
+                    statement.value)
+            send()
+
+        send()
+        return group
+
+    def run(self):
+        """
+        Sends the queued statements and drives the connections until every statement is complete, including the
+        statements queued meanwhile by listeners. Failures are kept in the statements, see AsyncStatement.result
+        :return: None
+        """
+        while True:
+            self.dispatch()
+            if not self.busy:
+                # statements left pending have no connection to run on
+                error = self.error
+                if self.pending and error is None:
+                    try:
+                        raise psycopg2.OperationalError('No connection left in the pool')
+                    except psycopg2.OperationalError:
+                        error = sys.exc_info()
+                while self.pending:
+                    self.pending.popleft().complete(error=error)
+                return
+            readers, writers = [], []
+            for conn in self.busy.keys():
+                try:
+                    state = conn.poll()
+                except Exception:
+                    self.release(conn, sys.exc_info())
+                    continue
+                if state == psycopg2.extensions.POLL_OK:
+                    self.release(conn)
+                elif state == psycopg2.extensions.POLL_READ:
+                    readers.append(conn)
+                elif state == psycopg2.extensions.POLL_WRITE:
+                    writers.append(conn)
+            if readers or writers: select.select(readers, writers, [])
+
+    def dispatch(self):
+        while self.pending and self.idle:
+            conn, statement = self.idle.pop(), self.pending.popleft()
+            cur = conn.cursor()
+            try:
+                cur.execute(statement.query, statement.params)
+            except Exception:
+                self.busy[conn] = (cur, statement)
+                self.release(conn, sys.exc_info())
+                continue
+            self.busy[conn] = (cur, statement)
+
+    def release(self, conn, error=None):
+        cur, statement = self.busy.pop(conn)
+        if statement is None:
+            # connecting, a connection which cannot be opened is given up
+            if error is None:
+                self.idle.append(conn)
+            else:
+                self.error = error
+                conn.close()
+            return
+        value = None
+        if error is None:
+            try:
+                value = cur.fetchall() if cur.description is not None else cur.rowcount
+            except Exception:
+                error = sys.exc_info()
+        cur.close()
+        if not conn.closed:
+            self.idle.append(conn)
+        else:
+            if error is not None: self.error = error
+            self.connect()
+        statement.complete(value, error)
+
+    def close(self):
+        for conn in self.idle + self.busy.keys():
+            conn.close()
+        self.idle, self.busy = [], {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
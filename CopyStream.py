@@ -0,0 +1,73 @@
+"""
+File like wrapper over an iterator of lines, so that rows can be streamed into PostgreSQL with COPY ... FROM STDIN
+without building the whole payload in memory
+"""
+
+COPY_ESCAPES = [('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r')]
+
+
+def copyline(values):
+    """
+    Formats a row for COPY in text format
+    :param values: tuple of column values, None for NULL
+    :return: tab separated line, terminated by a new line character
+    """
+    fields = []
+    for value in values:
+        if value is None:
+            fields.append('\\N')
+        elif isinstance(value, float):
+            fields.append(repr(value))
+        else:
+            field = str(value)
+            for char, escape in COPY_ESCAPES:
+                field = field.replace(char, escape)
+            fields.append(field)
+    return '\t'.join(fields) + '\n'
+
+
+class CopyStream(object):
+    def __init__(self, lines):
+        """
+        :param lines: any iterable of COPY formatted lines, each terminated by a new line character
+        """
+        self.lines = iter(lines)
+        self.buffer = ''
+        self.rows = 0  # number of lines pulled from the iterator so far
+
+    def read(self, size=-1):
+        """
+        Reads at most 'size' bytes from the stream. Lines are pulled from the iterator only when required
+        :param size: number of bytes to read. Reads everything if negative
+        :return: string, empty when the stream is exhausted
+        """
+        pieces = [self.buffer]
+        buffered = len(self.buffer)
+        while size < 0 or buffered < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            pieces.append(line)
+            buffered += len(line)
+            self.rows += 1
+        data = ''.join(pieces)
+        if size < 0: size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
+
+    def readline(self, size=-1):
+        """
+        Reads the next line from the stream
+        :param size: ignored, present for file API compatibility
+        :return: next line, empty string when the stream is exhausted
+        """
+        index = self.buffer.find('\n')
+        if index == -1:
+            line = next(self.lines, None)
+            if line is not None:
+                self.rows += 1
+                self.buffer += line
+            index = self.buffer.find('\n')
+        if index == -1: index = len(self.buffer) - 1
+        line, self.buffer = self.buffer[:index + 1], self.buffer[index + 1:]
+        return line
@@ -0,0 +1,108 @@
+"""
+External merge sort, for rows which do not fit in memory
+
+Rows are sorted in runs of at most 'runsize' rows, every run is spilled into a temporary file with pickle, and the
+runs are merged with heapq.merge, which holds a single row per run at a time. Peak memory is set by runsize, not by
+the number of rows. The sort is stable, like sorted
+"""
+
+import cPickle as pickle
+import heapq
+import tempfile
+
+SORT_RUN_SIZE = 100000  # rows sorted in memory at once
+
+
+class Reversed(object):
+    """
+    Wraps a sort key so that it compares in the reverse order, as heapq.merge has no reverse argument in Python 2
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+
+def spill(rows):
+    """
+    :param rows: iterable of picklable rows
+    :return:temporary file holding the rows, rewound
+    """
+    f = tempfile.TemporaryFile()
+    for row in rows:
+        pickle.dump(row, f, pickle.HIGHEST_PROTOCOL)
+    f.flush()
+    f.seek(0)
+    return f
+
+
+def readrun(f):
+    """
+    :param f: file written by spill
+    :return:its rows using yield
+    """
+    while True:
+        try:
+            yield pickle.load(f)
+        except EOFError:
+            return
+
+
+def externalsorted(rows, key, reverse=False, runsize=SORT_RUN_SIZE):
+    """
+    Sorts rows like sorted(rows, key=key, reverse=reverse), holding at most 'runsize' of them in memory.
+    All the rows are read and spilled before the function returns, so the source of the rows is free again by the
+    time the sorted rows are consumed, Eg: a connection used for both
+    :param rows: iterable of picklable rows, Eg: RatingsDAO.iterrows
+    :param key: function returning the sort key of a row
+    :param reverse: sort in descending order
+    :param runsize: number of rows sorted in memory at once
+    :return:iterator of the sorted rows
+    """
+    if runsize <= 0 or not isinstance(runsize, int): raise AttributeError("Run size should be a positive integer")
+    runs = []
+    try:
+        run = []
+        for row in rows:
+            run.append(row)
+            if len(run) == runsize:
+                runs.append(spill(sorted(run, key=key, reverse=reverse)))
+                run = []
+        if not runs: return iter(sorted(run, key=key, reverse=reverse))  # a single run, nothing to merge
+        if run: runs.append(spill(sorted(run, key=key, reverse=reverse)))
+    except:
+        for f in runs:
+            f.close()
+        raise
+    return merge(runs, key, reverse)
+
+
+def merge(runs, key, reverse):
+    """
+    k-way merge of sorted runs, closing their files at the end
+    :param runs: files written by spill, each holding rows sorted on key
+    :return:sorted rows using yield
+    """
+    # entries are (key, run number, row): equal keys are taken in the order of the runs, which keeps the sort
+    # stable, and rows themselves are never compared
+    wrap = Reversed if reverse else lambda value: value
+
+    def entries(i, f):
+        for row in readrun(f):
+            yield wrap(key(row)), i, row
+
+    try:
+        for _, _, row in heapq.merge(*[entries(i, f) for i, f in enumerate(runs)]):
+            yield row
+    finally:
+        for f in runs:
+            f.close()
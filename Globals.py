@@ -8,6 +8,8 @@ DATABASE_QUERIES_DEBUG = False
 RANGE_PARTITIONS_KEY = 'rangepartitions'
 RROBIN_PARTITIONS_KEY = 'robinpartitions'
 RROBIN_LAST_INSERT_PARTITION_KEY = 'robinlastinsertpartitionindex'
+LOAD_OFFSET_KEY = 'loadoffset'  # suffixed with the ratings table name
+LOAD_ROWS_KEY = 'loadrows'  # suffixed with the ratings table name
 # #################
 
 import datetime
@@ -0,0 +1,207 @@
+"""
+Handles of the parallel_sort and parallel_join runs
+
+A Job tracks one task per partition: its state, the number of rows it wrote, and its wall and CPU time, so that
+callers can wait for the output table, follow the progress and find straggler partitions. CPU time is the one of the
+client thread which ran the task, the work done by PostgreSQL is not included
+"""
+
+from collections import OrderedDict
+import copy
+import resource
+import sys
+import threading
+import time
+
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', 1)  # not defined by Python 2, 1 on Linux
+
+TASK_PENDING = 'pending'
+TASK_RUNNING = 'running'
+TASK_DONE = 'done'
+TASK_FAILED = 'failed'
+
+
+class JobTimeout(Exception):
+    """
+    Raised by Job.wait when the job is not over before the timeout
+    """
+
+
+def threadcputime():
+    """
+    :return:CPU time used by the calling thread in seconds, None if the platform cannot tell
+    """
+    try:
+        usage = resource.getrusage(RUSAGE_THREAD)
+    except (ValueError, resource.error):
+        return None
+    return usage.ru_utime + usage.ru_stime
+
+
+def timed(function, *args):
+    """
+    Runs function(*args) and measures it, Eg: in a worker process which reports back to its Job
+    :return:(value returned by the function, start time, wall time, CPU time)
+    """
+    cpu = threadcputime()
+    started = time.time()
+    value = function(*args)
+    wall = time.time() - started
+    if cpu is not None: cpu = threadcputime() - cpu
+    return value, started, wall, cpu
+
+
+class Task(object):
+    def __init__(self, name):
+        self.name = name  # Eg: partition table name
+        self.state = TASK_PENDING
+        self.rows = None  # rows written, if the task reported them
+        self.started = None
+        self.wall = None  # seconds
+        self.cpu = None  # seconds
+        self.error = None  # exc_info of the failure
+
+    def __repr__(self):
+        return 'Task({0}, {1}, rows={2}, wall={3}, cpu={4})'.format(self.name, self.state, self.rows, self.wall,
+                                                                   self.cpu)
+
+
+class Job(object):
+    def __init__(self, name, tasknames):
+        """
+        :param name: name of the job, Eg: its output table
+        :param tasknames: names of the tasks, Eg: partition table names
+        """
+        self.name = name
+        self.tasks = OrderedDict((taskname, Task(taskname)) for taskname in tasknames)
+        self.started = time.time()
+        self.finished = None
+        self.error = None  # exc_info of a failure outside of the tasks, Eg: of the thread started by start
+        self.condition = threading.Condition()
+        with self.condition:
+            self.checkfinished()  # a job without tasks is over
+
+    def wrap(self, taskname, function):
+        """
+        :return:function running function(*args) as the task, to hand over to thread pools. Exceptions are
+        recorded and raised again
+        """
+        task = self.tasks[taskname]
+
+        def run(*args):
+            with self.condition:
+                task.state, task.started = TASK_RUNNING, time.time()
+            cpu = threadcputime()
+            try:
+                value = function(*args)
+            except Exception:
+                self.finish(taskname, None, task.started, time.time() - task.started, None, sys.exc_info())
+                raise
+            if cpu is not None: cpu = threadcputime() - cpu
+            self.finish(taskname, value, task.started, time.time() - task.started, cpu)
+            return value
+
+        return run
+
+    def submitted(self, taskname):
+        """
+        Marks a task handed over to another process as running
+        """
+        with self.condition:
+            task = self.tasks[taskname]
+            task.state, task.started = TASK_RUNNING, time.time()
+
+    def finish(self, taskname, value=None, started=None, wall=None, cpu=None, error=None):
+        """
+        Records the end of a task
+        :param value: value returned by the task, its number of rows written if it is an integer
+        :param error: exc_info of the failure, None if the task succeeded
+        """
+        with self.condition:
+            task = self.tasks[taskname]
+            task.state = TASK_DONE if error is None else TASK_FAILED
+            if isinstance(value, (int, long)): task.rows = value
+            task.started, task.wall, task.cpu, task.error = started or task.started, wall, cpu, error
+            self.checkfinished()
+
+    def start(self, function, *args):
+        """
+        Runs function(*args) in a background thread, Eg: a pool driving the tasks. A failure ends the job
+        :return:the job
+        """
+
+        def run():
+            try:
+                function(*args)
+            except Exception:
+                with self.condition:
+                    if self.error is None: self.error = sys.exc_info()
+                    self.checkfinished()
+
+        thread = threading.Thread(target=run, name='Job {0}'.format(self.name))
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def checkfinished(self):
+        # call with the condition held
+        if self.finished is not None: return
+        if self.error is not None or all(task.state in (TASK_DONE, TASK_FAILED) for task in self.tasks.values()):
+            self.finished = time.time()
+            self.condition.notify_all()
+
+    def done(self):
+        """
+        :return:True once every task is over, or the job failed
+        """
+        with self.condition:
+            return self.finished is not None
+
+    def wait(self, timeout=None):
+        """
+        Waits for the end of the job
+        :param timeout: seconds to wait at most, None to wait for ever
+        :return:number of rows written
+        :throws: the exception of the first failed task or of the job. JobTimeout if the timeout expires
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.finished is None:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0: raise JobTimeout(
+                    'Job {0} is not done after {1}s'.format(self.name, timeout))
+                # waiting with a timeout keeps the main thread responsive to KeyboardInterrupt
+                self.condition.wait(1.0 if remaining is None else min(remaining, 1.0))
+            errors = [task.error for task in self.tasks.values() if task.error is not None]
+            if self.error is not None: errors.append(self.error)
+        if errors: raise errors[0][0], errors[0][1], errors[0][2]
+        return self.rowswritten()
+
+    def progress(self):
+        """
+        :return:dict of task name to its state, Eg: TASK_RUNNING
+        """
+        with self.condition:
+            return OrderedDict((taskname, task.state) for taskname, task in self.tasks.items())
+
+    def rowswritten(self):
+        """
+        :return:number of rows written by the tasks over so far
+        """
+        with self.condition:
+            return sum(task.rows for task in self.tasks.values() if task.rows is not None)
+
+    def stats(self):
+        """
+        :return:list of copies of the Tasks, in the order of their names. Compare their wall times to find
+        stragglers
+        """
+        with self.condition:
+            return [copy.copy(task) for task in self.tasks.values()]
+
+    def elapsed(self):
+        """
+        :return:wall time of the job in seconds, so far if it is not over
+        """
+        with self.condition:
+            return (self.finished or time.time()) - self.started
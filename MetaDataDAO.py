@@ -1,60 +1,229 @@
 """
 Has the MetaData about the partitioning
+
+Values are cached in memory, per connection. Every change of the table is announced with NOTIFY on the CHANNEL, and
+connections LISTENing on it drop their cache when they see a change made by another session. Caching is used only
+on auto commit connections, as the changes of a transaction are announced only when it commits.
+The VERSION_KEY row is incremented by every upsert and by every change of the partitions in the catalog, so it is
+the same for all the connections to the database, see version
 """
 
+import weakref
+
 import Globals
 
 TABLENAME = 'patitionmeta'
+CHANNEL = TABLENAME  # notification channel for changes of the meta data
+VERSION_KEY = 'metadataversion'
+BUMP_VERSION = "UPDATE {0} SET VALUE = (VALUE::BIGINT + 1)::TEXT WHERE KEY = '{1}'".format(TABLENAME, VERSION_KEY)
+
+
+class _Cache(object):
+    def __init__(self, conn):
+        self.values = None  # key to value dict, None until loaded
+        self.pid = conn.get_backend_pid()
+
+
+_caches = weakref.WeakKeyDictionary()  # connection to _Cache
+
+
+def getcache(conn):
+    """
+    Fetches the cache of a connection, after applying the notifications received since the last call.
+    Notifications are read from the socket without a round trip to the server
+    :param conn: open connection to DB
+    :return:_Cache of the connection, None if the connection is not in auto commit mode
+    """
+    if not conn.autocommit: return None
+    cache = _caches.get(conn)
+    if cache is None:
+        cache = _caches[conn] = _Cache(conn)
+        with conn.cursor() as cur:
+            cur.execute('LISTEN {0}'.format(CHANNEL))
+    conn.poll()
+    while conn.notifies:
+        notify = conn.notifies.pop(0)
+        if notify.channel == CHANNEL and notify.pid != cache.pid: cache.values = None
+    return cache
+
+
+def invalidate(conn):
+    """
+    Drops the cached values of a connection, they are loaded again by the next select
+    :param conn: open connection to DB
+    :return:None
+    """
+    cache = _caches.get(conn)
+    if cache is not None: cache.values = None
+
+
+def version(conn):
+    """
+    Version of the meta data and of the partition catalog, kept in the database. It changes whenever a value or the
+    partitions of the catalog change, by any session, though not with row counts. It is never reused, so it can be
+    used to tell if anything derived from the partition layout is still valid, even across connections. Read from
+    the cache of the connection
+    :param conn: open connection to DB
+    :return:integer version, None if the connection is not in auto commit mode or the table does not exist
+    """
+    if not conn.autocommit: return None
+    value = select(conn, VERSION_KEY)
+    return None if value is None else int(value)
+
+
+def bump(conn):
+    """
+    Increments the version, if the table exists. Changes made with a single statement include BUMP_VERSION instead
+    :param conn: open connection to DB
+    :return:None
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (TABLENAME,))
+        if not cur.fetchone()[0]: return
+        cur.execute(BUMP_VERSION)
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+    invalidate(conn)
+
+
+def iscreated(conn):
+    """
+    Checks if create already ran on the table, the VERSION_KEY row being inserted last
+    :param conn: open connection to DB
+    :return:True if the table exists and is up to date
+    """
+    if getcache(conn) is None:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL", (TABLENAME,))
+            if not cur.fetchone()[0]: return False
+    return select(conn, VERSION_KEY) is not None
 
 
 def create(conn):
     """
-    Create a MetaData table if it does not exist
+    Create a MetaData table if it does not exist, and migrates a table of an older version. Does nothing if the table
+    is already up to date, which costs a lookup in the cache on auto commit connections
     :param conn: open connection to DB
     :return:None
     """
+    if iscreated(conn): return
     with conn.cursor() as cur:
         cur.execute("""
             CREATE TABLE IF NOT EXISTS {0}(
               KEY VARCHAR(50),
-              VALUE VARCHAR(50)
+              VALUE TEXT
             )
         """.format(TABLENAME))
         if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        # values used to be limited to 50 characters, too short for lists like range boundaries
+        cur.execute("SELECT atttypid = 'text'::regtype FROM pg_attribute WHERE attrelid = %s::regclass AND "
+                    "attname = 'value'", (TABLENAME,))
+        if not cur.fetchone()[0]:
+            cur.execute('ALTER TABLE {0} ALTER COLUMN VALUE TYPE TEXT'.format(TABLENAME))
+        # the version starts from the clock, so that it does not go back to a value already used when the table is
+        # dropped and created again
+        cur.execute("""
+            INSERT INTO {0} (KEY, VALUE)
+            SELECT %(key)s, (extract(epoch FROM clock_timestamp()) * 1000000)::BIGINT::TEXT
+            WHERE NOT EXISTS (SELECT 1 FROM {0} WHERE KEY = %(key)s)
+        """.format(TABLENAME), {'key': VERSION_KEY})
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+    invalidate(conn)  # the table may have been missing from the cache
 
 
 def upsert(conn, key, value):
     """
-    Inserts a given (key, value) pair into meta data table if not present, else updates the value of the key
+    Inserts a given (key, value) pair into meta data table if not present, else updates the value of the key.
+    Runs in a single round trip, increments the version and notifies the other sessions
     :param conn: open connection to DB
     :param key: Key to insert / update
     :param value: Value to insert / update
     :return:None
     """
+    value = str(value)
     with conn.cursor() as cur:
-        cur.execute("SELECT value FROM {0} WHERE KEY = '{1}'".format(TABLENAME, key))
-        keyvalue = cur.fetchone()
-        if keyvalue is None:
-            cur.execute("INSERT INTO {0} VALUES ('{1}', '{2}')".format(TABLENAME, key, value))
-            if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
-        else:
-            cur.execute("UPDATE {0} SET VALUE = '{1}' WHERE KEY = '{2}'".format(TABLENAME, value, key))
-            if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        cur.execute("""
+            WITH updated AS (UPDATE {0} SET VALUE = %(value)s WHERE KEY = %(key)s RETURNING KEY)
+            INSERT INTO {0} (KEY, VALUE) SELECT %(key)s, %(value)s WHERE NOT EXISTS (SELECT 1 FROM updated);
+            {1};
+            SELECT pg_notify(%(channel)s, %(key)s);
+            SELECT VALUE FROM {0} WHERE KEY = %(versionkey)s;
+        """.format(TABLENAME, BUMP_VERSION), {'key': key, 'value': value, 'channel': CHANNEL,
+                                               'versionkey': VERSION_KEY})
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        row = cur.fetchone()
+
+    cache = getcache(conn)
+    if cache is None:
+        invalidate(conn)  # a transaction may still be rolled back
+    elif cache.values is not None:
+        cache.values[key] = value
+        if row is not None: cache.values[VERSION_KEY] = row[0]
 
 
 def select(conn, key):
     """
-    Fetches the value of a given key from meta data table
+    Fetches the value of a given key from meta data table. The whole table is loaded into the cache of the
+    connection on the first call, later calls do not go to the database until the meta data changes
     :param conn: open connection to DB
     :param key: Key to fetch
     :return:value of key if present, else None
     """
+    cache = getcache(conn)
+    if cache is None:
+        with conn.cursor() as cur:
+            cur.execute('SELECT value FROM {0} WHERE KEY = %s'.format(TABLENAME), (key,))
+            if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+            keyvalue = cur.fetchone()
+            if keyvalue is not None: return keyvalue[0]
+            return None
+
+    if cache.values is None:
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL", (TABLENAME,))
+            if not cur.fetchone()[0]:
+                cache.values = {}  # loaded again by create or by a notification
+            else:
+                cur.execute('SELECT KEY, VALUE FROM {0}'.format(TABLENAME))
+                if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+                cache.values = dict(cur.fetchall())
+    return cache.values.get(key)
+
+
+def createsequence(conn, name, start):
+    """
+    (Re)creates a sequence. Sequence values are handed out atomically, even to concurrent sessions
+    :param conn: open connection to DB
+    :param name: name of the sequence
+    :param start: first value of the sequence
+    :return:None
+    """
+    with conn.cursor() as cur:
+        cur.execute('DROP SEQUENCE IF EXISTS {0}; CREATE SEQUENCE {0} START WITH {1} CACHE 1'.format(name, start))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+
+
+def nextval(conn, name):
+    """
+    Advances a sequence
+    :param conn: open connection to DB
+    :param name: name of the sequence
+    :return:next value of the sequence
+    """
     with conn.cursor() as cur:
-        cur.execute("SELECT value FROM {0} WHERE KEY = '{1}'".format(TABLENAME, key))
+        cur.execute('SELECT nextval(%s)', (name,))
         if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
-        keyvalue = cur.fetchone()
-        if keyvalue is not None: return keyvalue[0]
-        return None
+        return cur.fetchone()[0]
+
+
+def dropsequence(conn, name):
+    """
+    Drops a sequence if it exists
+    :param conn: open connection to DB
+    :param name: name of the sequence
+    :return:None
+    """
+    with conn.cursor() as cur:
+        cur.execute('DROP SEQUENCE IF EXISTS {0}'.format(name))
 
 
 def drop(conn):
@@ -64,4 +233,6 @@ def drop(conn):
     :return:None
     """
     with conn.cursor() as cur:
-        cur.execute('drop table if exists {0};'.format(TABLENAME))
\ No newline at end of file
+        cur.execute("drop table if exists {0}; SELECT pg_notify(%s, '');".format(TABLENAME), (CHANNEL,))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+    invalidate(conn)
@@ -0,0 +1,171 @@
+"""
+Catalog of the partitions, one row per partition table
+
+Every partitioning is identified by the prefix of its partition tables, Eg: 'range_part'. The catalog records its
+scheme, the table and column it was built from, and for every partition its number, table name, bounds and
+approximate number of rows. Range partitions hold the values of (lowerbound, upperbound], the other schemes have no
+bounds. Row counts are set when the partitions are filled and added to by loads and batch inserts, NULL if unknown.
+Single row inserts do not update them, so they are approximate once ratings are inserted one by one. A prefix holds a
+single partitioning, so partitioning another table with the same prefix replaces it. Lookups routing the rows of a
+table should check its source table and column, see select.
+
+Catalogs are cached per connection, along with the meta data. Changes increment MetaDataDAO.version, or the
+ROWCOUNTS_KEY meta data for row counts, and are announced on MetaDataDAO.CHANNEL, so the cache is dropped whenever
+either changes
+"""
+
+from collections import namedtuple
+import weakref
+
+import Globals
+import MetaDataDAO
+
+TABLENAME = 'partitioncatalog'
+ROWCOUNTS_KEY = 'catalogrowcounts'  # meta data incremented by addrows
+
+Partition = namedtuple('Partition', ['prefix', 'scheme', 'sourcetable', 'columnname', 'partitionindex', 'tablename',
+                                     'lowerbound', 'upperbound', 'rowcount'])
+
+# connection to ((meta data version, ROWCOUNTS_KEY value), dict of prefix to list of Partitions)
+_caches = weakref.WeakKeyDictionary()
+
+
+def create(conn):
+    """
+    Create the catalog table if it does not exist
+    :param conn: open connection to DB
+    :return:None
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS {0}(
+              PREFIX VARCHAR(63) NOT NULL,
+              SCHEME VARCHAR(20) NOT NULL,
+              SOURCETABLE VARCHAR(63) NOT NULL,
+              COLUMNNAME VARCHAR(63),
+              PARTITIONINDEX INTEGER NOT NULL,
+              TABLENAME VARCHAR(63) NOT NULL,
+              LOWERBOUND NUMERIC,
+              UPPERBOUND NUMERIC,
+              ROWCOUNT BIGINT,
+              PRIMARY KEY (PREFIX, PARTITIONINDEX)
+            )
+        """.format(TABLENAME))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+
+
+def save(conn, prefix, scheme, sourcetable, columnname, partitions):
+    """
+    Replaces the catalog of a partitioning, in a single round trip, increments the meta data version and notifies
+    the other sessions
+    :param conn: open connection to DB
+    :param prefix: prefix of the partition tables
+    :param scheme: partitioning scheme, Eg: Assignment.PARTITION_SCHEME_RANGE
+    :param sourcetable: table the partitions were built from
+    :param columnname: column the partitions were built on, None for round robin
+    :param partitions: list of (partition index, table name, lower bound, upper bound, row count) tuples.
+    Bounds are numbers or strings of numbers, None if the scheme has no bounds
+    :return:None
+    """
+    create(conn)
+    MetaDataDAO.create(conn)  # holds the version
+    with conn.cursor() as cur:
+        values = ','.join(
+            cur.mogrify('(%s,%s,%s,%s,%s,%s,%s::numeric,%s::numeric,%s)',
+                        (prefix, scheme, sourcetable, columnname, index, table,
+                         None if lowerbound is None else str(lowerbound),
+                         None if upperbound is None else str(upperbound), rowcount))
+            for index, table, lowerbound, upperbound, rowcount in partitions)
+        query = 'DELETE FROM {0} WHERE PREFIX = %(prefix)s; '.format(TABLENAME)
+        if values: query += 'INSERT INTO {0} VALUES {1}; '.format(TABLENAME, values.replace('%', '%%'))
+        cur.execute(query + MetaDataDAO.BUMP_VERSION + '; SELECT pg_notify(%(channel)s, %(prefix)s);',
+                    {'prefix': prefix, 'channel': MetaDataDAO.CHANNEL})
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+    MetaDataDAO.invalidate(conn)
+
+
+def select(conn, prefix, sourcetable=None, columnname=None):
+    """
+    Fetches the catalog of a partitioning, from the cache of the connection when it is still valid
+    :param conn: open connection to DB
+    :param prefix: prefix of the partition tables
+    :param sourcetable: if given, the partitioning has to be built from this table
+    :param columnname: if given, the partitioning has to be built on this column
+    :return:list of Partitions ordered by partition index, empty if there is no such partitioning
+    """
+    partitions = _select(conn, prefix)
+    if sourcetable is not None and any(partition.sourcetable != sourcetable for partition in partitions): return []
+    if columnname is not None and any(partition.columnname != columnname for partition in partitions): return []
+    return partitions
+
+
+def _select(conn, prefix):
+    # select, whatever the source table
+    version = MetaDataDAO.version(conn)
+    if version is not None: version = (version, MetaDataDAO.select(conn, ROWCOUNTS_KEY))
+    cached = _caches.get(conn)
+    if version is not None and cached is not None and cached[0] == version and prefix in cached[1]:
+        return cached[1][prefix]
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (TABLENAME,))
+        if not cur.fetchone()[0]: return []
+        cur.execute("""
+            SELECT PREFIX, SCHEME, SOURCETABLE, COLUMNNAME, PARTITIONINDEX, TABLENAME, LOWERBOUND, UPPERBOUND, ROWCOUNT
+            FROM {0} WHERE PREFIX = %s ORDER BY PARTITIONINDEX
+        """.format(TABLENAME), (prefix,))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        partitions = [Partition(*row) for row in cur.fetchall()]
+
+    if version is not None:
+        if cached is None or cached[0] != version: cached = _caches[conn] = (version, {})
+        cached[1][prefix] = partitions
+    return partitions
+
+
+def addrows(conn, counts):
+    """
+    Adds to the row counts of partitions after a load or a batch of inserts, and notifies the other sessions. Every
+    call drops the catalog caches, so it is not meant for single row inserts. Call it in the transaction of the
+    inserts. The meta data table should exist
+    :param conn: open connection to DB
+    :param counts: dict of partition table name to number of rows added
+    :return:None
+    """
+    counts = dict((table, count) for table, count in counts.items() if count)
+    if not counts: return
+    with conn.cursor() as cur:
+        values = ','.join(cur.mogrify('(%s,%s)', (table, int(count))) for table, count in counts.items())
+        cur.execute("""
+            UPDATE {0} SET ROWCOUNT = ROWCOUNT + V.N FROM (VALUES {1}) AS V(T, N) WHERE TABLENAME = V.T;
+            WITH updated AS (UPDATE {2} SET VALUE = (VALUE::BIGINT + 1)::TEXT WHERE KEY = %(key)s RETURNING KEY)
+            INSERT INTO {2} (KEY, VALUE) SELECT %(key)s, '1' WHERE NOT EXISTS (SELECT 1 FROM updated);
+            SELECT pg_notify(%(channel)s, %(key)s);
+        """.format(TABLENAME, values.replace('%', '%%'), MetaDataDAO.TABLENAME),
+                    {'key': ROWCOUNTS_KEY, 'channel': MetaDataDAO.CHANNEL})
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+    _caches.pop(conn, None)  # the meta data of this session is not reloaded, it keeps matching the catalog cache
+
+
+def delete(conn, prefix):
+    """
+    Deletes the catalog of a partitioning, if the catalog table exists
+    :param conn: open connection to DB
+    :param prefix: prefix of the partition tables
+    :return:None
+    """
+    if not select(conn, prefix): return
+    save(conn, prefix, None, None, None, [])
+
+
+def drop(conn):
+    """
+    Drops the table
+    :param conn: open connection to DB
+    :return:None
+    """
+    with conn.cursor() as cur:
+        cur.execute('drop table if exists {0}; SELECT pg_notify(%s, %s);'.format(TABLENAME),
+                    (MetaDataDAO.CHANNEL, TABLENAME))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+    MetaDataDAO.bump(conn)
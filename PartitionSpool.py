@@ -0,0 +1,45 @@
+"""
+File like sink for COPY ... TO STDOUT which splits the rows it receives into one temporary file per partition.
+Every row has to start with the partition number followed by a tab, Eg: SELECT bucket, userid, movieid, rating
+"""
+
+import tempfile
+
+
+class PartitionSpool(object):
+    def __init__(self, numberofpartitions):
+        """
+        :param numberofpartitions: rows are expected to carry partition numbers from 0 to numberofpartitions - 1
+        """
+        self.files = [tempfile.TemporaryFile() for _ in range(0, numberofpartitions)]
+        self.rows = [0] * numberofpartitions
+        self.remainder = ''  # incomplete line of the previous write
+
+    def write(self, data):
+        """
+        Routes the complete lines of data into the file of their partition, without the partition number
+        :param data: COPY text, not necessarily cut at line boundaries
+        :return:None
+        """
+        lines = (self.remainder + data).split('\n')
+        self.remainder = lines.pop()
+        for line in lines:
+            partition, _, row = line.partition('\t')
+            partition = int(partition)
+            self.files[partition].write(row + '\n')
+            self.rows[partition] += 1
+
+    def open(self, partition):
+        """
+        Rewinds the file of a partition so that it can be read, Eg: by RatingsDAO.copyfrom
+        :param partition: partition number
+        :return: file like object
+        """
+        f = self.files[partition]
+        f.flush()
+        f.seek(0)
+        return f
+
+    def close(self):
+        for f in self.files:
+            f.close()
@@ -0,0 +1,122 @@
+"""
+Bounded LRU cache of query results, kept in the memory of the process
+
+Every entry remembers the partitions its query depends on, so that writes into a partition drop only the entries
+which could have changed. Changes of the partition layout are expected to be part of the key, Eg: through
+MetaDataDAO.version. Writes made by other processes are not seen, they have to invalidate the cache themselves
+"""
+
+from collections import OrderedDict
+import sys
+import threading
+
+
+class QueryCache(object):
+    def __init__(self, maxbytes):
+        """
+        :param maxbytes: approximate memory the cached rows may take, least recently used entries are evicted first
+        """
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()  # key to (rows, size in bytes, ratings table, partitions), least recent first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0  # incremented by every invalidation, see put
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def rowsize(row):
+        """
+        :return:approximate number of bytes taken by a tuple
+        """
+        return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+
+    @staticmethod
+    def sizeof(rows):
+        """
+        :return:approximate number of bytes taken by a list of tuples
+        """
+        return sys.getsizeof(rows) + sum(QueryCache.rowsize(row) for row in rows)
+
+    def get(self, key):
+        """
+        :param key: hashable key of the query
+        :return:the cached rows, None on a miss
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry  # most recently used
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, rows, ratingstablename, partitions, generation=None):
+        """
+        Caches the rows of a query, unless they alone are above the memory cap
+        :param key: hashable key of the query
+        :param rows: list of result tuples
+        :param ratingstablename: table the query was run on
+        :param partitions: names of the partition tables the result depends on
+        :param generation: value of self.generation when the query started. If anything was invalidated since, the
+        rows may be stale and are not cached
+        :return:None
+        """
+        size = self.sizeof(rows)
+        if size > self.maxbytes: return
+        with self.lock:
+            if generation is not None and generation != self.generation: return
+            self.discard(key)
+            self.entries[key] = (rows, size, ratingstablename, frozenset(partitions))
+            self.size += size
+            while self.size > self.maxbytes:
+                self.discard(next(iter(self.entries)))
+                self.evictions += 1
+
+    def discard(self, key):
+        # call with the lock held
+        entry = self.entries.pop(key, None)
+        if entry is not None: self.size -= entry[1]
+
+    def invalidate(self, partitions):
+        """
+        Drops the entries depending on any of the given partitions, call it when rows of the partitions change
+        :param partitions: names of partition tables
+        :return:None
+        """
+        partitions = frozenset(partitions)
+        with self.lock:
+            self.generation += 1
+            for key in [key for key, entry in self.entries.items() if entry[3] & partitions]:
+                self.discard(key)
+                self.invalidations += 1
+
+    def invalidatetable(self, ratingstablename):
+        """
+        Drops the entries of the queries run on a table, Eg: when its partitions are deleted
+        :param ratingstablename: table the queries were run on
+        :return:None
+        """
+        with self.lock:
+            self.generation += 1
+            for key in [key for key, entry in self.entries.items() if entry[2] == ratingstablename]:
+                self.discard(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """
+        :return:dict of the counters of the cache, to help sizing it
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'entries': len(self.entries), 'bytes': self.size,
+                    'maxbytes': self.maxbytes}
@@ -6,9 +6,18 @@ Else use the default tablename always! Don't mix and match by passing a name dur
 default name while inserting data.
 """
 
+import itertools
+
+import ConnectionUtils
+from CopyStream import CopyStream, copyline
+import ExternalSort
 import Globals
 
 TABLENAME = 'ratings'
+COLUMNS = ('userid', 'movieid', 'rating')  # columns filled by the application, id is generated
+ITERSIZE = 2000  # rows fetched per round trip by the server side cursors of iterrows
+
+_cursornames = itertools.count()  # suffixes of the names of the server side cursors
 
 
 def create(conn, table=TABLENAME, dropifexists=True):
@@ -48,6 +57,80 @@ def insert(ratings, conn, table=TABLENAME):
         if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
 
 
+def insertintotables(ratings, conn, tables):
+    """
+    Insert passed ratings into several tables with the Ratings schema, in a single round trip and transaction
+    :param ratings: list of ratings to insert
+    :param conn: open connection to DB
+    :param tables: names of the tables to insert into
+    :return:None
+    """
+    with conn.cursor() as cur:
+        values = ','.join(cur.mogrify("(%s,%s,%s)", rating) for rating in ratings)
+        cur.execute('; '.join('INSERT INTO {0} (userid, movieid, rating) VALUES {1}'.format(table, values)
+                              for table in tables))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+
+
+def insertquery(ratings, tables=(TABLENAME,)):
+    """
+    Builds the statements inserting ratings into tables with the Ratings schema, as a query with placeholders and its
+    parameters, Eg: for ConnectionUtils.AsyncPool
+    :param ratings: non empty list of (userid, movieid, rating) tuples
+    :param tables: names of the tables to insert into
+    :return:(query, list of parameters)
+    """
+    values = ','.join(['(%s,%s,%s)'] * len(ratings))
+    params = [value for rating in ratings for value in rating]
+    return ('; '.join('INSERT INTO {0} (userid, movieid, rating) VALUES {1}'.format(table, values) for table in tables),
+            params * len(tables))
+
+
+def insertandcopy(ratings, conn, table, copytable):
+    """
+    Insert passed ratings into a table and copies the inserted rows, generated IDs included, into another table of
+    the same columns, in a single statement
+    :param ratings: list of ratings to insert
+    :param conn: open connection to DB
+    :param table: table to insert the ratings into
+    :param copytable: table to copy the inserted rows into, Eg: a partition of table
+    :return:None
+    """
+    with conn.cursor() as cur:
+        values = ','.join(cur.mogrify("(%s,%s,%s)", rating) for rating in ratings)
+        cur.execute("""WITH inserted AS (
+          INSERT INTO {0} (userid, movieid, rating) VALUES {2} RETURNING *
+        ) INSERT INTO {1} SELECT * FROM inserted;""".format(table, copytable, values))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+
+
+def copyfrom(stream, conn, table=TABLENAME, cols=COLUMNS):
+    """
+    Bulk loads rows into Ratings table using COPY ... FROM STDIN, without building any SQL text for the rows
+    :param stream: file like object with tab separated rows, one per line, in the order of cols
+    :param conn: open connection to DB
+    :param table: name of the table to insert into. Default will be 'ratings'
+    :param cols: columns present in each row of the stream
+    :return:None
+    """
+    with conn.cursor() as cur:
+        cur.copy_expert('COPY {0} ({1}) FROM STDIN'.format(table, ','.join(cols)), stream)
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+
+
+def copyto(query, stream, conn):
+    """
+    Streams the result of a query to a file like object using COPY ... TO STDOUT, in COPY text format
+    :param query: SELECT statement without the trailing semicolon
+    :param stream: file like object with a write method
+    :param conn: open connection to DB
+    :return:None
+    """
+    with conn.cursor() as cur:
+        cur.copy_expert('COPY ({0}) TO STDOUT'.format(query), stream)
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+
+
 def insertwithselect(lowerbound, upperbound, desttable, conn, ratingstable=TABLENAME):
     """
     Inserts data from Master Ratings table to a given table after filtering based on lower and upper bounds
@@ -80,22 +163,156 @@ def numberofratings(conn, table=TABLENAME):
         return cur.fetchone()[0]
 
 
-def insertids(conn, ids, desttable, ratingstable=TABLENAME):
+def numberofrows(conn, tables):
+    """
+    Computes the number of records in a set of tables, in a single round trip
+    :param conn: open connection to DB
+    :param tables: names of the tables
+    :return:An integer, total number of records in the tables
+    """
+    if not tables: return 0
+    with conn.cursor() as cur:
+        cur.execute('SELECT {0};'.format(' + '.join('(SELECT COUNT(*) FROM {0})'.format(table) for table in tables)))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        return cur.fetchone()[0]
+
+
+def insertroundrobin(conn, desttable, numberofpartitions, partition, ratingstable=TABLENAME):
     """
-    Insert the given IDs from ratings table into a partition (desttable) table
+    Insert the ratings of a round robin partition into a partition (desttable) table, reading the ratings table
+    directly. Ratings are numbered from 1 in the order of their IDs, the k-th rating belongs to partition
+    k % numberofpartitions. IDs may have gaps. The numbering follows the primary key index, so it needs no sort
     :param conn: open connection to DB
-    :param ids: Rating IDs to be inserted into desttable
     :param desttable: destination table into which these ratings have to be inserted
+    :param numberofpartitions: total number of round robin partitions
+    :param partition: partition number of the ratings to insert
     :param ratingstable: source table from which ratings are to be picked
-    :return:None
+    :return:number of rows inserted
     """
     with conn.cursor() as cur:
-        cur.execute("""INSERT INTO {0} (userid, movieid, rating) (
+        cur.execute(insertroundrobinquery(desttable, numberofpartitions, partition, ratingstable))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        return cur.rowcount
+
+
+def insertroundrobinquery(desttable, numberofpartitions, partition, ratingstable=TABLENAME):
+    """
+    :return:the statement of insertroundrobin
+    """
+    return """INSERT INTO {0} (userid, movieid, rating) (
           SELECT userid, movieid, rating
-          FROM {1}
-          WHERE id IN ({2})
-        );""".format(desttable, ratingstable, ','.join(str(id) for id in ids)))
+          FROM (SELECT userid, movieid, rating, row_number() OVER (ORDER BY id) AS position FROM {1}) AS T
+          WHERE position % {2} = {3}
+        );""".format(desttable, ratingstable, numberofpartitions, partition)
+
+
+def createpartitioned(conn, table, partitionby, partitions):
+    """
+    Turns the Ratings table into a natively partitioned parent table of the same name, holding the same rows.
+    Partitions are created as tables attached to the parent. Run it in a transaction
+    :param conn: open connection to DB
+    :param table: name of the Ratings table
+    :param partitionby: partitioning clause, Eg: 'HASH (id)'
+    :param partitions: list of (partition table name, bound clause) tuples, Eg: ('rrobin_part0',
+    'WITH (MODULUS 3, REMAINDER 0)')
+    :return:None
+    """
+    unpartitioned = table + '_unpartitioned'
+    with conn.cursor() as cur:
+        cur.execute('ALTER TABLE {0} RENAME TO {1}'.format(table, unpartitioned))
+        # primary key of a partitioned table has to include the partition key, so there is none
+        cur.execute("""
+        CREATE TABLE {0}(
+          id BIGSERIAL,
+          userid INTEGER,
+          movieid INTEGER,
+          rating NUMERIC
+        ) PARTITION BY {1};
+        """.format(table, partitionby))
+        for partition, bounds in partitions:
+            cur.execute('DROP TABLE IF EXISTS {0}'.format(partition))
+            cur.execute('CREATE TABLE {0} PARTITION OF {1} FOR VALUES {2}'.format(partition, table, bounds))
+        movetable(cur, unpartitioned, table)
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+
+
+def unpartition(conn, table):
+    """
+    Turns a natively partitioned Ratings table back into a plain table of the same name, holding the same rows.
+    The partitions are dropped. Run it in a transaction
+    :param conn: open connection to DB
+    :param table: name of the Ratings table
+    :return:None
+    """
+    unpartitioned = table + '_unpartitioned'
+    create(conn, unpartitioned)
+    with conn.cursor() as cur:
+        movetable(cur, table, unpartitioned)
+        cur.execute('ALTER TABLE {0} RENAME TO {1}'.format(unpartitioned, table))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+
+
+def movetable(cur, source, dest):
+    """
+    Moves all the rows of source into dest keeping their IDs, moves the ID sequence of dest past them and drops
+    source
+    :param cur: open cursor
+    :param source: table to move the rows from, it is dropped
+    :param dest: table with the Ratings schema to move the rows into
+    :return:None
+    """
+    cur.execute('INSERT INTO {0} (id, userid, movieid, rating) SELECT id, userid, movieid, rating FROM {1}'.format(
+        dest, source))
+    cur.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), COALESCE(MAX(id), 0) + 1, false) FROM {0}".format(
+        dest), (dest,))
+    cur.execute('DROP TABLE {0}'.format(source))
+
+
+def replacetable(conn, source, dest):
+    """
+    Replaces a Ratings table by another one, renamed along with its ID sequence and primary key. Run it in a
+    transaction, so that the dest table is never seen missing
+    :param conn: open connection to DB
+    :param source: Ratings table taking the place of dest
+    :param dest: Ratings table to drop
+    :return:None
+    """
+    with conn.cursor() as cur:
+        cur.execute('DROP TABLE IF EXISTS {1}; ALTER TABLE {0} RENAME TO {1}; '
+                    'ALTER SEQUENCE {0}_id_seq RENAME TO {1}_id_seq; ALTER INDEX {0}_pkey RENAME TO {1}_pkey'.format(
+                        source, dest))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+
+
+def ispartitioned(conn, table=TABLENAME):
+    """
+    Checks if a table is natively partitioned
+    :param conn: open connection to DB
+    :param table: name of the table
+    :return:True if the table is a partitioned parent table
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT relkind FROM pg_class WHERE relname = %s AND pg_table_is_visible(oid)", (table,))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        relkind = cur.fetchone()
+        return relkind is not None and relkind[0] == 'p'
+
+
+def partitionstrategy(conn, table=TABLENAME):
+    """
+    Fetches the native partitioning strategy of a table
+    :param conn: open connection to DB
+    :param table: name of the table
+    :return:'r' for RANGE, 'h' for HASH, 'l' for LIST, None if the table is not natively partitioned
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT partstrat FROM pg_partitioned_table P JOIN pg_class C ON C.oid = P.partrelid
+            WHERE C.relname = %s AND pg_table_is_visible(C.oid)
+        """, (table,))
         if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        strategy = cur.fetchone()
+        return None if strategy is None else strategy[0]
 
 
 # Assignment 3
@@ -111,13 +328,11 @@ def createfromschema(conn, source, dest, dropifexists=True):
     """
     with conn.cursor() as cur:
         if dropifexists: cur.execute('DROP TABLE IF EXISTS {0}'.format(dest))
-        # Clone the table
+        # Clone the columns only, without reading the rows of the source table
         cur.execute("""
             CREATE TABLE {0} AS
-            TABLE {1};
+            TABLE {1} WITH NO DATA;
         """.format(dest, source))
-        # Delete the records in the new table
-        cur.execute('DELETE FROM {0}'.format(dest))
         if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
 
 
@@ -135,15 +350,63 @@ def insertwithselectgeneric(selectcol, allcols, lowerbound, upperbound, desttabl
     :param desttable: destination table name to copy data into
     :param conn: open database connection
     :param tablename: name of ratings table
-    :return:None
+    :return:number of rows inserted
     """
     with conn.cursor() as cur:
-        cur.execute("""INSERT INTO {0} ({1}) (
+        cur.execute(insertwithselectquery(selectcol, allcols, lowerbound, upperbound, desttable, tablename))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        return cur.rowcount
+
+
+def insertwithselectquery(selectcol, allcols, lowerbound, upperbound, desttable, tablename=TABLENAME):
+    """
+    :return:the statement of insertwithselectgeneric
+    """
+    return """INSERT INTO {0} ({1}) (
           SELECT {1}
           FROM {2}
           WHERE {3} > {4} AND {3} <= {5}
-        );""".format(desttable, ','.join(allcols), tablename, selectcol, lowerbound, upperbound))
+        );""".format(desttable, ','.join(allcols), tablename, selectcol, lowerbound, upperbound)
+
+
+def insertrouted(conn, query, tables, cols):
+    """
+    Routes the rows of a query into partition tables with a single statement: the query is run once, as a common
+    table expression referenced by one INSERT per partition, so no row travels to the client
+    :param conn: open connection to DB
+    :param query: SELECT returning the partition number, an index into tables, followed by the columns
+    :param tables: partition table names, the tables should already exist
+    :param cols: columns returned by the query after the partition number
+    :return:dict of partition table name to number of rows saved into it
+    """
+    cols = ','.join(cols)
+    inserts = ''.join(', p{0} AS (INSERT INTO {1} ({2}) SELECT {2} FROM routed WHERE bucket = {0} RETURNING 1)'.format(
+        i, table, cols) for i, table in enumerate(tables))
+    counts = ', '.join('(SELECT count(*) FROM p{0})'.format(i) for i in range(len(tables)))
+    with conn.cursor() as cur:
+        cur.execute('WITH routed AS ({0}){1} SELECT {2}'.format(query, inserts, counts))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        return dict(zip(tables, cur.fetchone()))
+
+
+def insertwithcondition(condition, allcols, desttable, conn, tablename=TABLENAME):
+    """
+    Inserts the rows of a table which satisfy a condition into another table
+    :param condition: SQL condition of the WHERE clause
+    :param allcols: columns to copy
+    :param desttable: destination table name to copy data into
+    :param conn: open database connection
+    :param tablename: name of source table
+    :return:number of rows inserted
+    """
+    with conn.cursor() as cur:
+        cur.execute("""INSERT INTO {0} ({1}) (
+          SELECT {1}
+          FROM {2}
+          WHERE {3}
+        );""".format(desttable, ','.join(allcols), tablename, condition))
         if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        return cur.rowcount
 
 
 def create2(conn, table=TABLENAME, dropifexists=True):
@@ -192,6 +455,32 @@ def get_column_names(conn, table):
     return ratings_cols
 
 
+def get_column_type(conn, table, col):
+    """
+    :return: SQL data type of the column, Eg: 'integer', None if the column does not exist
+    """
+    with conn.cursor() as cur:
+        cur.execute('select data_type from information_schema.columns where table_name=%s and column_name=%s;',
+                    (table, col))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        row = cur.fetchone()
+    return None if row is None else row[0]
+
+
+def sortkey(index):
+    """
+    Sort key on a column which orders NULLs like PostgreSQL does: last in ascending order and first in descending
+    order, while Python 2 puts None before any value
+    :param index: index of the column in the rows
+    :return:function returning the sort key of a row
+    """
+
+    def key(item):
+        return item[index] is None, item[index]
+
+    return key
+
+
 def sort_rows_and_save(conn, col, order, tuple_order_start, sourcetable, desttable):
     """
     get a list of rows from 'sourcetable' sorted by 'col'
@@ -201,31 +490,143 @@ def sort_rows_and_save(conn, col, order, tuple_order_start, sourcetable, desttab
     :param tuple_order_start: This is the starting value for tuple order column while saving the sorted tuples
     :param sourcetable: name of the sourcetable to get data from
     :param desttable: name of the table to save the sorted data
-    :return: None as this method generally runs in a thread
+    :return: number of rows saved
+    :throws: ValueError if column is not found
+    """
+    # Get the list of columns in the given table
+    ratings_cols = get_column_names(conn, sourcetable)
+    index = ratings_cols.index(col)  # find the index of the sort column in the table
+    ratings = sorted(selectall(conn, sourcetable), key=sortkey(index), reverse=(order == 'DESC'))
+    ratings_cols.append('tupleorder')
+
+    # saved in batches, so that no single statement holds the whole partition
+    for start in range(0, len(ratings), ITERSIZE):
+        res = []
+        for t in ratings[start:start + ITERSIZE]:
+            res.append(t + (tuple_order_start,))  # TODO: Have to ignore the id column before insert if present
+            tuple_order_start += 1
+        insert2(res, conn, ratings_cols, desttable)
+    return len(ratings)
+
+
+def sort_rows_and_save_external(conn, col, order, tuple_order_start, sourcetable, desttable,
+                                runsize=ExternalSort.SORT_RUN_SIZE):
+    """
+    Same as sort_rows_and_save, with bounded memory: the rows of 'sourcetable' are streamed from a server side cursor
+    into an external merge sort, see ExternalSort, and the merged rows are streamed into 'desttable' with COPY
+    :param runsize: number of rows sorted in memory at once
+    :return: number of rows saved
     :throws: ValueError if column is not found
     """
+    ratings_cols = get_column_names(conn, sourcetable)
+    index = ratings_cols.index(col)  # find the index of the sort column in the table
+    ratings = ExternalSort.externalsorted(selectall(conn, sourcetable),
+                                          key=sortkey(index), reverse=(order == 'DESC'), runsize=runsize)
+    lines = (copyline(t + (tuple_order,)) for tuple_order, t in enumerate(ratings, tuple_order_start))
+    stream = CopyStream(lines)
+    copyfrom(stream, conn, desttable, ratings_cols + ['tupleorder'])
+    return stream.rows
+
+
+def insert_sorted(conn, col, order, tuple_order_start, sourcetable, desttable):
+    """
+    Saves the rows of 'sourcetable' into 'desttable' numbered in the order of 'col', with row_number() in a single
+    INSERT ... SELECT, so that no row travels to the client
+    :param conn: open connection to db
+    :param col: column to sort on
+    :param order: 'ASC' or 'DESC' for ascending or descending order
+    :param tuple_order_start: tuple order of the first row
+    :param sourcetable: name of the sourcetable to get data from
+    :param desttable: name of the table to save the sorted data, with the columns of sourcetable and 'tupleorder'
+    :return: number of rows saved
+    """
+    cols = ','.join(get_column_names(conn, sourcetable))
     with conn.cursor() as cur:
-        cur.execute('SELECT * FROM {0};'.format(sourcetable))
+        cur.execute("""INSERT INTO {0} ({1}, tupleorder)
+          SELECT {1}, row_number() OVER (ORDER BY {2} {3}) + %s
+          FROM {4}""".format(desttable, cols, col, order, sourcetable), (tuple_order_start - 1,))
         if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
-        ratings = cur.fetchall()
+        return cur.rowcount
 
-        # Get the list of columns in the given table
-        ratings_cols = get_column_names(conn, sourcetable)
-        index = ratings_cols.index(col)  # find the index of the sort column in the table
 
-        def sort_key(item):
-            return item[index]
+def create_sorted(conn, col, order, sourcetable, desttable):
+    """
+    Creates 'desttable' with the rows of 'sourcetable' numbered from 1 in the order of 'col' in a 'tupleorder'
+    column, in a single CREATE TABLE AS which PostgreSQL can run with parallel query workers
+    :param conn: open connection to db
+    :param col: column to sort on
+    :param order: 'ASC' or 'DESC' for ascending or descending order
+    :param sourcetable: name of the sourcetable to get data from
+    :param desttable: name of the table to create, dropped first if it exists
+    :return: number of rows saved
+    """
+    cols = ','.join(get_column_names(conn, sourcetable))
+    with conn.cursor() as cur:
+        cur.execute('DROP TABLE IF EXISTS {0}'.format(desttable))
+        cur.execute("""CREATE TABLE {0} AS
+          SELECT {1}, (row_number() OVER (ORDER BY {2} {3}))::NUMERIC AS tupleorder
+          FROM {4}""".format(desttable, cols, col, order, sourcetable))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        return cur.rowcount
 
-        res = []
-        for t in sorted(ratings, key=sort_key, reverse=(order == 'DESC')):
-            res.append(t + (tuple_order_start,))  # TODO: Have to ignore the id column before insert if present
-            tuple_order_start += 1
 
-        # if Globals.DEBUG: Globals.printinfo(res)
+def selectrange(conn, table, bounds):
+    """
+    Fetches the ratings of a table whose column values are within the given bounds
+    :param conn: open connection to DB
+    :param table: table with the Ratings schema
+    :param bounds: dict of column name to (inclusive lower bound, inclusive upper bound)
+    :return: (userid, movieid, rating) tuples using yield, see iterrows
+    """
+    query, params = selectrangequery(table, bounds)
+    return iterrows(conn, query, params)
 
-        ratings_cols.append('tupleorder')
 
-        insert2(res, conn, ratings_cols, desttable)
+def selectrangequery(table, bounds):
+    """
+    :return:(query, list of parameters) of selectrange
+    """
+    cols = sorted(bounds)
+    conditions = ' AND '.join('{0} >= %s AND {0} <= %s'.format(col) for col in cols)
+    return ('SELECT userid, movieid, rating FROM {0} WHERE {1}'.format(table, conditions),
+            [bound for col in cols for bound in bounds[col]])
+
+
+def selectall(conn, table, cols=None, orderby=None, itersize=ITERSIZE):
+    """
+    Fetches the rows of a table, Eg: to sort a partition, see iterrows
+    :param conn: open connection to DB
+    :param table: name of the table
+    :param cols: columns to fetch, all of them by default
+    :param orderby: optional ORDER BY clause, Eg: 'rating DESC'
+    :param itersize: number of rows fetched per round trip
+    :return: rows using yield
+    """
+    query = 'SELECT {0} FROM {1}'.format('*' if cols is None else ','.join(cols), table)
+    if orderby is not None: query += ' ORDER BY {0}'.format(orderby)
+    return iterrows(conn, query, itersize=itersize)
+
+
+def iterrows(conn, query, params=None, itersize=ITERSIZE):
+    """
+    Runs a query through a named, server side cursor and yields its rows, fetching 'itersize' rows per round trip.
+    Only that many rows are held by the client at once, so results larger than its memory can be processed.
+    In auto commit mode the cursor lives in a read transaction opened for it, rather than being declared WITH HOLD,
+    which would make the server compute the whole result before the first row. Closing the generator before its end
+    closes the cursor
+    :param conn: open connection to DB, not to be used for anything else until the generator is exhausted or closed
+    :param query: SELECT query
+    :param params: optional parameters of the query
+    :param itersize: number of rows fetched per round trip
+    :return: rows using yield
+    """
+    with ConnectionUtils.transaction(conn):
+        with conn.cursor('ratings_cursor_{0}'.format(next(_cursornames))) as cur:
+            cur.itersize = itersize
+            cur.execute(query, params)
+            if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+            for row in cur:
+                yield row
 
 
 def get_min_max(conn, col, tablename):
@@ -235,6 +636,41 @@ def get_min_max(conn, col, tablename):
         return cur.fetchone()
 
 
+def get_percentiles(conn, col, tablename, fractions, samplepercent=None):
+    """
+    Computes the values of a column at the given fractions of its sorted order, with percentile_disc
+    :param conn: open connection to DB
+    :param col: column to compute the percentiles of
+    :param tablename: name of the table
+    :param fractions: list of fractions between 0 and 1
+    :param samplepercent: if given, percentiles are computed on a TABLESAMPLE SYSTEM sample of this percentage
+    of the table instead of the whole table
+    :return:list of values, one per fraction, in the type of the column
+    """
+    sample = '' if samplepercent is None else ' TABLESAMPLE SYSTEM ({0})'.format(float(samplepercent))
+    with conn.cursor() as cur:
+        cur.execute('SELECT percentile_disc(%s::float8[]) WITHIN GROUP (ORDER BY {0}) FROM {1}{2};'.format(
+            col, tablename, sample), (list(fractions),))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        return cur.fetchone()[0] or []
+
+
+def get_sample(conn, col, tablename, samplepercent):
+    """
+    Draws a TABLESAMPLE BERNOULLI sample of the non NULL values of a column, with the ctid of their rows
+    :param conn: open connection to DB
+    :param col: column to sample
+    :param tablename: name of the table
+    :param samplepercent: percentage of the rows to sample
+    :return:list of (value, ctid) tuples sorted on value then ctid
+    """
+    with conn.cursor() as cur:
+        cur.execute('SELECT {0}, ctid FROM {1} TABLESAMPLE BERNOULLI (%s) WHERE {0} IS NOT NULL ORDER BY {0}, ctid'
+                    .format(col, tablename), (float(samplepercent),))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        return cur.fetchall()
+
+
 def drop_table(conn, tablename):
     with conn.cursor() as cur:
         cur.execute('DROP TABLE IF EXISTS {0}'.format(tablename))
@@ -261,4 +697,5 @@ def join_tables(conn, table1, col1, table2, col2, outputtable):
         join_clause = "SELECT * FROM {0} t1, {1} t2 WHERE t1.{2} = t2.{3}".format(table1, table2, col1, col2)
         query = "INSERT into {0} ({1}) {2};".format(outputtable, ','.join(cols), join_clause)
         cur.execute(query)
-        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
\ No newline at end of file
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        return cur.rowcount
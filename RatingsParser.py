@@ -0,0 +1,106 @@
+"""
+Memory mapped parser for the ratings file, UserID::MovieID::Rating::Timestamp
+
+The file is decoded in blocks of about BLOCK_SIZE bytes, always cut at line boundaries, straight into NumPy
+structured arrays of RATINGS_DTYPE. Columns of a block are accessed by name, Eg: block['rating']
+"""
+
+from cStringIO import StringIO
+import mmap
+import os
+import string
+
+import numpy as np
+
+BLOCK_SIZE = 8 * 1024 * 1024  # Number of bytes of the file decoded at once
+RATINGS_DTYPE = np.dtype([('userid', np.int32), ('movieid', np.int32), ('rating', np.float64),
+                          ('timestamp', np.int64)])
+RATINGS_COLUMNS = ('userid', 'movieid', 'rating')  # columns saved in the ratings table
+FIELD_SEPARATOR = '::'
+
+_SEPARATORS = string.maketrans(':\r\n', '   ')
+
+
+def parseblock(data):
+    """
+    Decodes complete lines of the ratings file into a structured array
+    :param data: string holding complete lines of the ratings file
+    :return: NumPy array of RATINGS_DTYPE with one element per line
+    :throws: ValueError if a line does not have exactly the four columns
+    """
+    values = np.fromstring(data.translate(_SEPARATORS), dtype=np.float64, sep=' ')
+    lines = countfields(data)
+    if (lines != len(RATINGS_DTYPE.names) - 1).any() or len(values) != len(RATINGS_DTYPE.names) * len(lines):
+        bad = np.flatnonzero(lines != len(RATINGS_DTYPE.names) - 1)
+        raise ValueError('Malformed ratings data{0}, every line should be UserID::MovieID::Rating::Timestamp'.format(
+            ' at line {0} of the block'.format(bad[0] + 1) if len(bad) else ''))
+    values = values.reshape(-1, len(RATINGS_DTYPE.names))
+    block = np.empty(len(values), dtype=RATINGS_DTYPE)
+    for index, name in enumerate(RATINGS_DTYPE.names):
+        block[name] = values[:, index]
+    return block
+
+
+def countfields(data):
+    """
+    Counts the field separators of every line, vectorized over the bytes of the data
+    :param data: string holding complete lines of the ratings file
+    :return: NumPy array with the number of '::' separators of every line which is not blank
+    """
+    if not data: return np.zeros(0)
+    chars = np.frombuffer(data, dtype=np.uint8)
+    newlines = np.flatnonzero(chars == ord('\n'))
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.concatenate((newlines, [len(chars)]))
+    # a separator is two colons, the line of a colon is the number of newlines before it
+    colons = np.searchsorted(newlines, np.flatnonzero(chars == ord(':')))
+    separators = np.bincount(colons, minlength=len(starts)) / float(len(FIELD_SEPARATOR))
+    lengths = ends - starts
+    blank = (lengths == 0) | ((lengths == 1) & (chars[np.minimum(starts, len(chars) - 1)] == ord('\r')))
+    return separators[~blank]
+
+
+def iterblocks(filepath, start=0, end=None, blocksize=BLOCK_SIZE):
+    """
+    Memory maps the file and decodes the byte range [start, end) block by block.
+    start and end are expected to be at line boundaries, like the ranges of Assignment.splitfile
+    :param filepath: relative or abs path of the ratings file
+    :param start: byte offset to start decoding from
+    :param end: exclusive byte offset to stop at. Defaults to the end of the file
+    :param blocksize: approximate number of bytes decoded into each block
+    :return: (block, offset) tuples using yield, offset being the byte offset right after the block
+    """
+    size = os.path.getsize(filepath)
+    if end is None or end > size: end = size
+    if start >= end: return
+
+    with open(filepath, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            position = start
+            while position < end:
+                stop = min(position + blocksize, end)
+                if stop < end:
+                    # cut the block after the last complete line, or after the first one if a line is too long
+                    newline = mm.rfind('\n', position, stop)
+                    if newline == -1: newline = mm.find('\n', stop, end)
+                    stop = end if newline == -1 else newline + 1
+                yield parseblock(mm[position:stop]), stop
+                position = stop
+        finally:
+            mm.close()
+
+
+def tocopystream(block, cols=RATINGS_COLUMNS):
+    """
+    Formats the given columns of a block as tab separated rows, ready for RatingsDAO.copyfrom. Columns are converted
+    to text and joined column by column with NumPy, rather than row by row
+    :param block: array of RATINGS_DTYPE
+    :param cols: columns to write, in order
+    :return: file like object positioned at the start
+    """
+    if not len(block): return StringIO()
+    lines = block[cols[0]].astype(str)
+    for col in cols[1:]:
+        lines = np.char.add(np.char.add(lines, '\t'), block[col].astype(str))
+    return StringIO('\n'.join(lines.tolist()) + '\n')
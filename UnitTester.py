@@ -0,0 +1,308 @@
+#!/usr/bin/python2.7
+#
+# Unit tests of the helpers which do not need a database: file parsing, COPY streams, spooling, sorting, caching
+# and partition routing. Run with: python UnitTester.py
+#
+
+import decimal
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+
+import Assignment
+import ExternalSort
+import PartitionCatalogDAO
+import RatingsParser
+from CopyStream import CopyStream, copyline
+from PartitionSpool import PartitionSpool
+from QueryCache import QueryCache
+
+
+def writetempfile(data):
+    """
+    :return:path of a new temporary file holding data, delete it once done
+    """
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    return path
+
+
+class RatingsParserTest(unittest.TestCase):
+    def test_parseblock(self):
+        block = RatingsParser.parseblock('1::122::5::838985046\n2::185::4.5::838983525\n')
+        self.assertEqual(block['userid'].tolist(), [1, 2])
+        self.assertEqual(block['movieid'].tolist(), [122, 185])
+        self.assertEqual(block['rating'].tolist(), [5.0, 4.5])
+        self.assertEqual(block['timestamp'].tolist(), [838985046, 838983525])
+
+    def test_parseblock_skips_blank_lines_and_carriage_returns(self):
+        block = RatingsParser.parseblock('1::122::5::838985046\r\n\r\n\n2::185::4.5::838983525')
+        self.assertEqual(block['movieid'].tolist(), [122, 185])
+
+    def test_parseblock_empty(self):
+        self.assertEqual(len(RatingsParser.parseblock('')), 0)
+
+    def test_parseblock_rejects_missing_field(self):
+        with self.assertRaises(ValueError) as context:
+            RatingsParser.parseblock('1::122::5::838985046\n2::185::4.5\n')
+        self.assertIn('line 2', str(context.exception))
+
+    def test_parseblock_rejects_extra_field(self):
+        self.assertRaises(ValueError, RatingsParser.parseblock, '1::122::5::838985046::7\n')
+
+    def test_parseblock_rejects_fields_moved_across_lines(self):
+        # same number of values in total, but not four on every line
+        self.assertRaises(ValueError, RatingsParser.parseblock, '1::2::3\n4::5::6::7::8\n')
+
+    def test_countfields(self):
+        self.assertEqual(RatingsParser.countfields('1::2::3::4\n\n1::2\n').tolist(), [3, 1])
+
+    def test_iterblocks_cuts_at_line_boundaries(self):
+        lines = ['{0}::{1}::{2}::{3}\n'.format(i, i * 7, (i % 10) / 2.0, 1000 + i) for i in range(1, 200)]
+        path = writetempfile(''.join(lines))
+        try:
+            blocks = list(RatingsParser.iterblocks(path, blocksize=64))
+            self.assertGreater(len(blocks), 1)
+            self.assertEqual(np.concatenate([block['userid'] for block, _ in blocks]).tolist(), range(1, 200))
+            size = os.path.getsize(path)
+            self.assertEqual(blocks[-1][1], size)
+            with open(path, 'rb') as f:
+                data = f.read()
+            for _, offset in blocks[:-1]:
+                self.assertEqual(data[offset - 1], '\n')
+        finally:
+            os.remove(path)
+
+    def test_iterblocks_range(self):
+        path = writetempfile('1::1::1::1\n2::2::2::2\n3::3::3::3\n')
+        try:
+            blocks = list(RatingsParser.iterblocks(path, 11, 22))
+            self.assertEqual([block['userid'].tolist() for block, _ in blocks], [[2]])
+            self.assertEqual(list(RatingsParser.iterblocks(path, 33)), [])
+        finally:
+            os.remove(path)
+
+    def test_tocopystream(self):
+        block = RatingsParser.parseblock('1::122::5::838985046\n2::185::0.5::838983525\n')
+        self.assertEqual(RatingsParser.tocopystream(block).read(), '1\t122\t5.0\n2\t185\t0.5\n')
+        self.assertEqual(RatingsParser.tocopystream(block[:0]).read(), '')
+
+
+class CopyStreamTest(unittest.TestCase):
+    def test_copyline(self):
+        self.assertEqual(copyline((1, None, 2.5, 'a\tb\\c\nd')), '1\t\\N\t2.5\ta\\tb\\\\c\\nd\n')
+
+    def test_read_in_pieces(self):
+        lines = ['a\t1\n', 'bb\t2\n', 'ccc\t3\n']
+        stream = CopyStream(lines)
+        pieces = []
+        while True:
+            piece = stream.read(4)
+            if not piece: break
+            self.assertLessEqual(len(piece), 4)
+            pieces.append(piece)
+        self.assertEqual(''.join(pieces), ''.join(lines))
+        self.assertEqual(stream.rows, 3)
+
+    def test_read_all(self):
+        stream = CopyStream(iter(['a\n', 'b\n']))
+        self.assertEqual(stream.read(), 'a\nb\n')
+        self.assertEqual(stream.read(), '')
+
+    def test_readline(self):
+        stream = CopyStream(['a\n', 'b\n'])
+        self.assertEqual(stream.read(1), 'a')
+        self.assertEqual(stream.readline(), '\n')
+        self.assertEqual(stream.readline(), 'b\n')
+        self.assertEqual(stream.readline(), '')
+        self.assertEqual(stream.rows, 2)
+
+
+class PartitionSpoolTest(unittest.TestCase):
+    def test_rows_split_across_writes(self):
+        spool = PartitionSpool(3)
+        try:
+            data = '0\t1\t10\t4.5\n2\t2\t20\t3\n0\t3\t30\t1\n'
+            # lines cut across writes
+            for i in range(0, len(data), 5):
+                spool.write(data[i:i + 5])
+            self.assertEqual(spool.rows, [2, 0, 1])
+            self.assertEqual(spool.open(0).read(), '1\t10\t4.5\n3\t30\t1\n')
+            self.assertEqual(spool.open(1).read(), '')
+            self.assertEqual(spool.open(2).read(), '2\t20\t3\n')
+        finally:
+            spool.close()
+
+
+class ExternalSortTest(unittest.TestCase):
+    def setUp(self):
+        generator = random.Random(42)
+        # many equal keys, the position tells if the sort kept their order
+        self.rows = [(generator.randint(0, 5), position) for position in range(0, 100)]
+
+    def test_matches_sorted(self):
+        for runsize in (1, 7, 100, 1000):
+            self.assertEqual(list(ExternalSort.externalsorted(self.rows, lambda row: row[0], runsize=runsize)),
+                             sorted(self.rows, key=lambda row: row[0]))
+
+    def test_reverse_is_stable(self):
+        for runsize in (1, 7, 1000):
+            self.assertEqual(
+                list(ExternalSort.externalsorted(self.rows, lambda row: row[0], reverse=True, runsize=runsize)),
+                sorted(self.rows, key=lambda row: row[0], reverse=True))
+
+    def test_empty(self):
+        self.assertEqual(list(ExternalSort.externalsorted([], lambda row: row, runsize=3)), [])
+
+    def test_rejects_bad_run_size(self):
+        self.assertRaises(AttributeError, ExternalSort.externalsorted, self.rows, lambda row: row, False, 0)
+
+    def test_reversed(self):
+        self.assertTrue(ExternalSort.Reversed(2) < ExternalSort.Reversed(1))
+        self.assertFalse(ExternalSort.Reversed(1) < ExternalSort.Reversed(1))
+        self.assertEqual(ExternalSort.Reversed(1), ExternalSort.Reversed(1))
+
+
+class QueryCacheTest(unittest.TestCase):
+    def assertAccounted(self, cache):
+        self.assertEqual(cache.size, sum(entry[1] for entry in cache.entries.values()))
+        self.assertLessEqual(cache.size, cache.maxbytes)
+
+    def test_get_put(self):
+        cache = QueryCache(1024 * 1024)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', [(1, 2)], 'ratings', ['range_part1'])
+        self.assertEqual(cache.get('a'), [(1, 2)])
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (1, 1))
+
+    def test_evicts_least_recently_used(self):
+        rows = [(1, 2, 3.0)]
+        cache = QueryCache(QueryCache.sizeof(rows) * 2)
+        cache.put('a', rows, 'ratings', [])
+        cache.put('b', rows, 'ratings', [])
+        cache.get('a')
+        cache.put('c', rows, 'ratings', [])
+        self.assertEqual(cache.entries.keys(), ['a', 'c'])
+        self.assertEqual(cache.evictions, 1)
+        self.assertAccounted(cache)
+
+    def test_replacing_an_entry_keeps_the_size(self):
+        cache = QueryCache(1024 * 1024)
+        cache.put('a', [(1,)], 'ratings', [])
+        cache.put('a', [(1,), (2,), (3,)], 'ratings', [])
+        self.assertEqual(len(cache.entries), 1)
+        self.assertAccounted(cache)
+
+    def test_rows_above_the_cap_are_not_cached(self):
+        cache = QueryCache(10)
+        cache.put('a', [(1, 2)], 'ratings', [])
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.size, 0)
+
+    def test_invalidate_drops_dependent_entries_only(self):
+        cache = QueryCache(1024 * 1024)
+        cache.put('a', [(1,)], 'ratings', ['range_part1', 'rrobin_part0'])
+        cache.put('b', [(2,)], 'ratings', ['range_part2'])
+        cache.invalidate(['rrobin_part0'])
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), [(2,)])
+        self.assertAccounted(cache)
+
+    def test_invalidatetable(self):
+        cache = QueryCache(1024 * 1024)
+        cache.put('a', [(1,)], 'ratings', [])
+        cache.put('b', [(2,)], 'other', [])
+        cache.invalidatetable('ratings')
+        self.assertEqual(cache.entries.keys(), ['b'])
+        self.assertAccounted(cache)
+
+    def test_stale_generation_is_not_cached(self):
+        cache = QueryCache(1024 * 1024)
+        generation = cache.generation
+        cache.invalidate(['range_part1'])  # a write while the query was running
+        cache.put('a', [(1,)], 'ratings', ['range_part2'], generation)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', [(1,)], 'ratings', ['range_part2'], cache.generation)
+        self.assertEqual(cache.get('a'), [(1,)])
+
+
+class RoutingTest(unittest.TestCase):
+    def catalog(self, numberofpartitions):
+        partitions = [
+            (lower_bound, upper_bound, Assignment.RANGE_PARTITION_TABLE_PREFIX + str(i + 1))
+            for i, (lower_bound, upper_bound) in enumerate(Assignment.rangeboundaries(numberofpartitions))]
+        partitions.append((-1, 0, Assignment.RANGE_PARTITION_TABLE_PREFIX + '1'))
+        return [PartitionCatalogDAO.Partition('range_part', 'range', 'ratings', 'rating', index, table,
+                                              decimal.Decimal(lower_bound), decimal.Decimal(upper_bound), rows)
+                for index, table, lower_bound, upper_bound, rows in
+                Assignment.rangecatalog(Assignment.RANGE_PARTITION_TABLE_PREFIX, partitions)]
+
+    def test_validratingsmask(self):
+        ratings = np.array([-0.5, 0, 0.5, 1.25, 4.5, 5, 5.5])
+        self.assertEqual(Assignment.validratingsmask(ratings).tolist(),
+                         [False, True, True, False, True, True, False])
+
+    def test_rangeboundaries(self):
+        for numberofpartitions in (1, 3, 5, 7):
+            boundaries = Assignment.rangeboundaries(numberofpartitions)
+            self.assertEqual(len(boundaries), numberofpartitions)
+            self.assertEqual(boundaries[0][0], 0.0)
+            self.assertEqual(boundaries[-1][1], Assignment.MAX_RATING)
+            for (_, upper_bound), (lower_bound, _) in zip(boundaries, boundaries[1:]):
+                self.assertEqual(upper_bound, lower_bound)
+
+    def test_rangecatalog_merges_the_zero_ratings(self):
+        partitions = self.catalog(5)
+        self.assertEqual(len(partitions), 5)
+        self.assertEqual(partitions[0].lowerbound, -1)
+        self.assertEqual(partitions[0].upperbound, 1)
+
+    def test_findrangepartition(self):
+        partitions = self.catalog(5)
+        expected = {0: 'range_part1', 0.5: 'range_part1', 1: 'range_part1', 1.5: 'range_part2', 4: 'range_part4',
+                    4.5: 'range_part5', 5: 'range_part5'}
+        for rating, table in expected.items():
+            self.assertEqual(Assignment.findrangepartition(partitions, rating).tablename, table)
+            self.assertEqual(Assignment.findrangepartition(partitions, decimal.Decimal(str(rating))).tablename, table)
+        self.assertIsNone(Assignment.findrangepartition(partitions, 5.5))
+        self.assertIsNone(Assignment.findrangepartition(partitions, -1))
+
+    def test_findrangepartition_uneven_bounds(self):
+        # 5 / 3 is rounded in the catalog, values on a bound go to the partition below it
+        partitions = self.catalog(3)
+        upper_bound = partitions[0].upperbound
+        self.assertEqual(Assignment.findrangepartition(partitions, float(upper_bound)).tablename, 'range_part1')
+        self.assertEqual(Assignment.findrangepartition(partitions, 2.0).tablename, 'range_part2')
+
+    def test_findrangepartition_unbounded(self):
+        partitions = [PartitionCatalogDAO.Partition('range_part', 'range', 'ratings', 'rating', 1, 'range_part1', None,
+                                                    decimal.Decimal(2), None),
+                      PartitionCatalogDAO.Partition('range_part', 'range', 'ratings', 'rating', 2, 'range_part2',
+                                                    decimal.Decimal(2), None, None)]
+        self.assertEqual(Assignment.findrangepartition(partitions, -10).tablename, 'range_part1')
+        self.assertEqual(Assignment.findrangepartition(partitions, 10).tablename, 'range_part2')
+
+    def test_tocopyformat(self):
+        self.assertEqual(list(Assignment.tocopyformat(['1::2::3.5::4\n', '\n', '5::6::1\n', '7::8::2\r\n'])),
+                         ['1\t2\t3.5\n', '5\t6\t1\n', '7\t8\t2\n'])
+
+    def test_splitfile(self):
+        data = ''.join('{0}::1::1::1\n'.format(i) for i in range(0, 50))
+        path = writetempfile(data)
+        try:
+            ranges = Assignment.splitfile(path, 4)
+            self.assertEqual(ranges[0][0], 0)
+            self.assertEqual(ranges[-1][1], len(data))
+            for (_, end), (start, _) in zip(ranges, ranges[1:]):
+                self.assertEqual(end, start)
+                self.assertEqual(data[start - 1], '\n')
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
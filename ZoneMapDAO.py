@@ -0,0 +1,163 @@
+"""
+Zone maps of the partitions, one row per partition table
+
+A zone map records the number of rows of a partition, the min and max of its userid, movieid and rating columns, and
+a bitmap of the ratings it holds: bit k is set if a rating of k / 2.0 is present. A NULL bitmap means the ratings are
+not known to be multiples of 0.5 in [0, 5]. Zone maps only grow as rows are added, so a query can skip every
+partition whose zone map cannot match it
+"""
+
+from collections import namedtuple
+
+import Globals
+
+TABLENAME = 'zonemap'
+RATING_STEPS = 2  # bitmap has a bit for every 1 / RATING_STEPS of rating
+MAX_RATING = 5
+
+Zone = namedtuple('Zone', ['tablename', 'rowcount', 'minuserid', 'maxuserid', 'minmovieid', 'maxmovieid',
+                           'minrating', 'maxrating', 'ratingbitmap'])
+
+
+def create(conn):
+    """
+    Create the zone map table if it does not exist
+    :param conn: open connection to DB
+    :return:None
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS {0}(
+              TABLENAME VARCHAR(63) PRIMARY KEY,
+              ROWCOUNT BIGINT NOT NULL,
+              MINUSERID INTEGER,
+              MAXUSERID INTEGER,
+              MINMOVIEID INTEGER,
+              MAXMOVIEID INTEGER,
+              MINRATING FLOAT8,
+              MAXRATING FLOAT8,
+              RATINGBITMAP INTEGER
+            )
+        """.format(TABLENAME))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+
+
+def ratingbit(rating):
+    """
+    :return:bit of the rating in a rating bitmap, None if the rating has no bit
+    """
+    step = rating * RATING_STEPS
+    if step != int(step) or not 0 <= rating <= MAX_RATING: return None
+    return 1 << int(step)
+
+
+def compute(conn, tables):
+    """
+    (Re)computes the zone maps of the given tables from their rows, in a single round trip
+    :param conn: open connection to DB
+    :param tables: names of tables with the Ratings schema
+    :return:None
+    """
+    if not tables: return
+    create(conn)
+    selects = ' UNION ALL '.join("""
+        SELECT '{0}', COUNT(*), MIN(userid), MAX(userid), MIN(movieid), MAX(movieid), MIN(rating), MAX(rating),
+          CASE WHEN bool_and(rating * {1} = floor(rating * {1}) AND rating BETWEEN 0 AND {2})
+            THEN bit_or(1 << (rating * {1})::int) END
+        FROM {0}""".format(table, RATING_STEPS, MAX_RATING) for table in tables)
+    with conn.cursor() as cur:
+        cur.execute('DELETE FROM {0} WHERE TABLENAME IN %s; INSERT INTO {0} {1};'.format(TABLENAME, selects),
+                    (tuple(tables),))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+
+
+def reset(conn, tables):
+    """
+    Saves empty zone maps for the given tables, Eg: for partitions about to be filled with widen
+    :param conn: open connection to DB
+    :param tables: names of the tables
+    :return:None
+    """
+    if not tables: return
+    create(conn)
+    with conn.cursor() as cur:
+        values = ','.join(cur.mogrify('(%s, 0)', (table,)) for table in tables)
+        cur.execute('DELETE FROM {0} WHERE TABLENAME IN %s; INSERT INTO {0} (TABLENAME, ROWCOUNT) VALUES {1};'.format(
+            TABLENAME, values.replace('%', '%%')), (tuple(tables),))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+
+
+def widen(conn, zones):
+    """
+    Merges the zone maps of rows added to tables into their saved zone maps, in a single round trip.
+    Call it before the rows become visible, so that the saved zone maps always cover the rows of the tables.
+    Tables without a saved zone map are left without one
+    :param conn: open connection to DB
+    :param zones: list of Zones of the added rows
+    :return:None
+    """
+    if not zones: return
+    with conn.cursor() as cur:
+        cur.execute(*widenquery(zones))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+
+
+def widenquery(zones):
+    """
+    :param zones: non empty list of Zones
+    :return:(query, list of parameters) of widen
+    """
+    row = '(%s,%s::bigint,%s::int,%s::int,%s::int,%s::int,%s::float8,%s::float8,%s::int)'
+    return ("""
+            UPDATE {0} AS Z SET
+              MINUSERID = LEAST(Z.MINUSERID, V.MINUSERID), MAXUSERID = GREATEST(Z.MAXUSERID, V.MAXUSERID),
+              MINMOVIEID = LEAST(Z.MINMOVIEID, V.MINMOVIEID), MAXMOVIEID = GREATEST(Z.MAXMOVIEID, V.MAXMOVIEID),
+              MINRATING = LEAST(Z.MINRATING, V.MINRATING), MAXRATING = GREATEST(Z.MAXRATING, V.MAXRATING),
+              RATINGBITMAP = CASE WHEN Z.ROWCOUNT = 0 THEN V.RATINGBITMAP ELSE Z.RATINGBITMAP | V.RATINGBITMAP END,
+              ROWCOUNT = Z.ROWCOUNT + V.ROWCOUNT
+            FROM (VALUES {1}) AS V(TABLENAME, ROWCOUNT, MINUSERID, MAXUSERID, MINMOVIEID, MAXMOVIEID, MINRATING,
+                                   MAXRATING, RATINGBITMAP)
+            WHERE Z.TABLENAME = V.TABLENAME
+        """.format(TABLENAME, ','.join([row] * len(zones))), [value for zone in zones for value in zone])
+
+
+def select(conn, tables):
+    """
+    Fetches the zone maps of the given tables
+    :param conn: open connection to DB
+    :param tables: names of the tables
+    :return:dict of table name to Zone, tables without a zone map are left out
+    """
+    if not tables: return {}
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (TABLENAME,))
+        if not cur.fetchone()[0]: return {}
+        cur.execute("""
+            SELECT TABLENAME, ROWCOUNT, MINUSERID, MAXUSERID, MINMOVIEID, MAXMOVIEID, MINRATING, MAXRATING, RATINGBITMAP
+            FROM {0} WHERE TABLENAME IN %s
+        """.format(TABLENAME), (tuple(tables),))
+        if Globals.DEBUG and Globals.DATABASE_QUERIES_DEBUG: Globals.printquery(cur.query)
+        return dict((row[0], Zone(*row)) for row in cur.fetchall())
+
+
+def delete(conn, tables):
+    """
+    Deletes the zone maps of the given tables, queries will not skip them anymore
+    :param conn: open connection to DB
+    :param tables: names of the tables
+    :return:None
+    """
+    if not tables: return
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (TABLENAME,))
+        if cur.fetchone()[0]: cur.execute('DELETE FROM {0} WHERE TABLENAME IN %s'.format(TABLENAME), (tuple(tables),))
+
+
+def drop(conn):
+    """
+    Drops the table
+    :param conn: open connection to DB
+    :return:None
+    """
+    with conn.cursor() as cur:
+        cur.execute('drop table if exists {0};'.format(TABLENAME))
@@ -5,6 +5,8 @@
 
 import psycopg2
 
+import Assignment
+
 DATABASE_NAME = 'dds_assgn1'
 
 
@@ -13,11 +15,19 @@ def getopenconnection(user='postgres', password='1234', dbname='dds_assgn1'):
 
 
 def rangequery(ratingstablename, ratingminvalue, ratingmaxvalue, openconnection):
-    pass
+    """
+    Fetches the ratings of [ratingminvalue, ratingmaxvalue] from the partitions, see Assignment.rangequery
+    :return:list of (partition table name, userid, movieid, rating) tuples
+    """
+    return list(Assignment.rangequery(ratingstablename, ratingminvalue, ratingmaxvalue, openconnection))
 
 
 def pointquery(ratingstablename, ratingvalue, openconnection):
-    pass
+    """
+    Fetches the ratings equal to ratingvalue from the partitions, see Assignment.pointquery
+    :return:list of (partition table name, userid, movieid, rating) tuples
+    """
+    return list(Assignment.pointquery(ratingstablename, ratingvalue, openconnection))
 
 
 def create_db(dbname):